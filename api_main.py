@@ -4,7 +4,8 @@ import io
 import sys
 import datetime
 from aiohttp import web
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from config.settings import (
     APP_API_HOST,
     APP_API_PORT,
@@ -15,7 +16,9 @@ from config.settings import (
     PROXY_API_TOKEN,
     LOG_LEVEL,
 )
-from db.models import init_db, get_session, User, UserRole, Mode, Schedule, PaymentRequest, PaymentStatus
+from db.models import init_db, User, UserRole, Mode, Schedule, PaymentRequest, PaymentStatus
+from db.aio import get_async_session, dispose_async_engine, set_active_mode
+from db.changes import publish_port_change_async
 
 try:
     sys.stdout.reconfigure(encoding='utf-8')
@@ -32,6 +35,7 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Схема создаётся один раз при старте; запросы обработчиков идут через асинхронные сессии
 engine = init_db()
 
 async def auth(request: web.Request):
@@ -54,22 +58,22 @@ async def freerange(request: web.Request):
     err = await auth(request)
     if err:
         return err
-    db: Session = get_session(engine)
+    db: AsyncSession = get_async_session()
     try:
         start, end = DEFAULT_PORT_RANGE
-        used = {u.port for u in db.query(User).all()}
+        used = {u.port for u in (await db.scalars(select(User))).all()}
         free = [p for p in range(start, end + 1) if p not in used]
         return web.json_response({"free_ports": free})
     finally:
-        db.close()
+        await db.close()
 
 async def list_users(request: web.Request):
     err = await auth(request)
     if err:
         return err
-    db: Session = get_session(engine)
+    db: AsyncSession = get_async_session()
     try:
-        users = db.query(User).all()
+        users = (await db.scalars(select(User))).all()
         data = [
             {
                 "id": u.id,
@@ -85,7 +89,7 @@ async def list_users(request: web.Request):
         ]
         return web.json_response({"users": data})
     finally:
-        db.close()
+        await db.close()
 
 async def add_user(request: web.Request):
     err = await auth(request)
@@ -96,12 +100,12 @@ async def add_user(request: web.Request):
     username = body.get("username")
     port = int(body.get("port"))
     login = body.get("login")
-    db: Session = get_session(engine)
+    db: AsyncSession = get_async_session()
     try:
         start, end = DEFAULT_PORT_RANGE
         if not (start <= port <= end):
             return json_error("port out of range")
-        if db.query(User).filter((User.tg_id == tg_id) | (User.port == port)).first():
+        if await db.scalar(select(User).where((User.tg_id == tg_id) | (User.port == port)).limit(1)):
             return json_error("user or port exists")
         u = User(
             tg_id=tg_id,
@@ -113,7 +117,7 @@ async def add_user(request: web.Request):
             subscription_until=datetime.datetime.now().replace(microsecond=0) + datetime.timedelta(days=30),
         )
         db.add(u)
-        db.flush()
+        await db.flush()
         m = Mode(
             user_id=u.id,
             name='Sleep',
@@ -123,10 +127,13 @@ async def add_user(request: web.Request):
             is_active=1,
         )
         db.add(m)
-        db.commit()
+        await db.flush()
+        u.active_mode_id = m.id
+        await db.commit()
+        await publish_port_change_async(db, u.port)
         return web.json_response({"result": "created", "user_id": u.id})
     finally:
-        db.close()
+        await db.close()
 
 async def set_port(request: web.Request):
     err = await auth(request)
@@ -135,30 +142,23 @@ async def set_port(request: web.Request):
     body = await request.json()
     tg_id = int(body.get("tg_id"))
     new_port = int(body.get("port"))
-    db: Session = get_session(engine)
+    db: AsyncSession = get_async_session()
     try:
         start, end = DEFAULT_PORT_RANGE
         if not (start <= new_port <= end):
             return json_error("port out of range")
-        if db.query(User).filter(User.port == new_port).first():
+        if await db.scalar(select(User).where(User.port == new_port).limit(1)):
             return json_error("port busy")
-        u = db.query(User).filter(User.tg_id == tg_id).first()
+        u = await db.scalar(select(User).where(User.tg_id == tg_id).limit(1))
         if not u:
             return json_error("user not found", status=404)
         old_port = u.port
         u.port = new_port
-        db.commit()
-        try:
-            await proxy_reload_port(old_port)
-        except Exception:
-            pass
-        try:
-            await proxy_reload_port(new_port)
-        except Exception:
-            pass
+        await db.commit()
+        await publish_port_change_async(db, old_port, new_port)
         return web.json_response({"result": "updated", "old_port": old_port, "new_port": new_port})
     finally:
-        db.close()
+        await db.close()
 
 async def set_subscription(request: web.Request):
     err = await auth(request)
@@ -167,21 +167,21 @@ async def set_subscription(request: web.Request):
     body = await request.json()
     tg_id = int(body.get("tg_id"))
     date_str = body.get("date")
-    db: Session = get_session(engine)
+    db: AsyncSession = get_async_session()
     try:
         try:
             until = datetime.datetime.strptime(date_str, "%d.%m.%Y")
             until = until.replace(hour=23, minute=59, second=59, microsecond=0)
         except Exception:
             return json_error("bad date")
-        u = db.query(User).filter(User.tg_id == tg_id).first()
+        u = await db.scalar(select(User).where(User.tg_id == tg_id).limit(1))
         if not u:
             return json_error("user not found", status=404)
         u.subscription_until = until
-        db.commit()
+        await db.commit()
         return web.json_response({"result": "updated"})
     finally:
-        db.close()
+        await db.close()
 
 async def extend_subscription(request: web.Request):
     err = await auth(request)
@@ -190,9 +190,9 @@ async def extend_subscription(request: web.Request):
     body = await request.json()
     tg_id = int(body.get("tg_id"))
     months = int(body.get("months", 1))
-    db: Session = get_session(engine)
+    db: AsyncSession = get_async_session()
     try:
-        u = db.query(User).filter(User.tg_id == tg_id).first()
+        u = await db.scalar(select(User).where(User.tg_id == tg_id).limit(1))
         if not u:
             return json_error("user not found", status=404)
         base = max(u.subscription_until, datetime.datetime.now().replace(microsecond=0))
@@ -203,26 +203,26 @@ async def extend_subscription(request: web.Request):
         d = min(base.day, (datetime.date(y, m, 1).replace(day=28) + datetime.timedelta(days=4)).replace(day=1) - datetime.timedelta(days=1)).day
         new_until = base.replace(year=y, month=m, day=d, hour=23, minute=59, second=59, microsecond=0)
         u.subscription_until = new_until
-        db.commit()
+        await db.commit()
         return web.json_response({"result": "updated", "until": new_until.isoformat()})
     finally:
-        db.close()
+        await db.close()
 
 async def list_modes(request: web.Request):
     err = await auth(request)
     if err:
         return err
     tg_id = int(request.match_info["tg_id"])
-    db: Session = get_session(engine)
+    db: AsyncSession = get_async_session()
     try:
-        u = db.query(User).filter(User.tg_id == tg_id).first()
+        u = await db.scalar(select(User).where(User.tg_id == tg_id).limit(1))
         if not u:
             return json_error("user not found", status=404)
-        modes = db.query(Mode).filter(Mode.user_id == u.id).all()
+        modes = (await db.scalars(select(Mode).where(Mode.user_id == u.id))).all()
         data = [{"id": m.id, "name": m.name, "host": m.host, "port": m.port, "alias": m.alias, "is_active": int(m.is_active)} for m in modes]
         return web.json_response({"modes": data})
     finally:
-        db.close()
+        await db.close()
 
 async def set_login(request: web.Request):
     err = await auth(request)
@@ -231,16 +231,17 @@ async def set_login(request: web.Request):
     tg_id = int(request.match_info["tg_id"])
     body = await request.json()
     new_login = body.get("login")
-    db: Session = get_session(engine)
+    db: AsyncSession = get_async_session()
     try:
-        u = db.query(User).filter(User.tg_id == tg_id).first()
+        u = await db.scalar(select(User).where(User.tg_id == tg_id).limit(1))
         if not u:
             return json_error("user not found", status=404)
         u.login = new_login
-        db.commit()
+        await db.commit()
+        await publish_port_change_async(db, u.port)
         return web.json_response({"result": "updated"})
     finally:
-        db.close()
+        await db.close()
 
 async def add_mode(request: web.Request):
     err = await auth(request)
@@ -252,17 +253,17 @@ async def add_mode(request: web.Request):
     host = body.get("host")
     port = int(body.get("port"))
     alias = body.get("alias")
-    db: Session = get_session(engine)
+    db: AsyncSession = get_async_session()
     try:
-        u = db.query(User).filter(User.tg_id == tg_id).first()
+        u = await db.scalar(select(User).where(User.tg_id == tg_id).limit(1))
         if not u:
             return json_error("user not found", status=404)
         m = Mode(user_id=u.id, name=name, host=host, port=port, alias=alias, is_active=0)
         db.add(m)
-        db.commit()
+        await db.commit()
         return web.json_response({"result": "created", "mode_id": m.id})
     finally:
-        db.close()
+        await db.close()
 
 async def activate_mode(request: web.Request):
     err = await auth(request)
@@ -270,24 +271,20 @@ async def activate_mode(request: web.Request):
         return err
     tg_id = int(request.match_info["tg_id"])
     mode_id = int(request.match_info["mode_id"])
-    db: Session = get_session(engine)
+    db: AsyncSession = get_async_session()
     try:
-        u = db.query(User).filter(User.tg_id == tg_id).first()
+        u = await db.scalar(select(User).where(User.tg_id == tg_id).limit(1))
         if not u:
             return json_error("user not found", status=404)
-        m = db.query(Mode).filter(Mode.id == mode_id, Mode.user_id == u.id).first()
+        m = await db.scalar(select(Mode).where(Mode.id == mode_id, Mode.user_id == u.id).limit(1))
         if not m:
             return json_error("mode not found", status=404)
-        db.query(Mode).filter(Mode.user_id == u.id, Mode.is_active == 1).update({Mode.is_active: 0})
-        m.is_active = 1
-        db.commit()
-        try:
-            await proxy_reload_port(u.port)
-        except Exception:
-            pass
+        await set_active_mode(db, u.id, m.id)
+        await db.commit()
+        await publish_port_change_async(db, u.port)
         return web.json_response({"result": "activated"})
     finally:
-        db.close()
+        await db.close()
 
 async def delete_mode(request: web.Request):
     err = await auth(request)
@@ -295,35 +292,40 @@ async def delete_mode(request: web.Request):
         return err
     tg_id = int(request.match_info["tg_id"])
     mode_id = int(request.match_info["mode_id"])
-    db: Session = get_session(engine)
+    db: AsyncSession = get_async_session()
     try:
-        u = db.query(User).filter(User.tg_id == tg_id).first()
+        u = await db.scalar(select(User).where(User.tg_id == tg_id).limit(1))
         if not u:
             return json_error("user not found", status=404)
-        m = db.query(Mode).filter(Mode.id == mode_id, Mode.user_id == u.id).first()
+        m = await db.scalar(select(Mode).where(Mode.id == mode_id, Mode.user_id == u.id).limit(1))
         if not m:
             return json_error("mode not found", status=404)
-        db.delete(m)
-        db.commit()
+        was_active = u.active_mode_id == m.id
+        if was_active:
+            u.active_mode_id = None
+        await db.delete(m)
+        await db.commit()
+        if was_active:
+            await publish_port_change_async(db, u.port)
         return web.json_response({"result": "deleted"})
     finally:
-        db.close()
+        await db.close()
 
 async def list_schedules(request: web.Request):
     err = await auth(request)
     if err:
         return err
     tg_id = int(request.match_info["tg_id"])
-    db: Session = get_session(engine)
+    db: AsyncSession = get_async_session()
     try:
-        u = db.query(User).filter(User.tg_id == tg_id).first()
+        u = await db.scalar(select(User).where(User.tg_id == tg_id).limit(1))
         if not u:
             return json_error("user not found", status=404)
-        schedules = db.query(Schedule).filter(Schedule.user_id == u.id).all()
+        schedules = (await db.scalars(select(Schedule).where(Schedule.user_id == u.id))).all()
         data = [{"id": s.id, "mode_id": s.mode_id, "start_time": s.start_time, "end_time": s.end_time} for s in schedules]
         return web.json_response({"schedules": data})
     finally:
-        db.close()
+        await db.close()
 
 async def add_schedule(request: web.Request):
     err = await auth(request)
@@ -334,20 +336,22 @@ async def add_schedule(request: web.Request):
     mode_id = int(body.get("mode_id"))
     start_time = body.get("start_time")
     end_time = body.get("end_time")
-    db: Session = get_session(engine)
+    db: AsyncSession = get_async_session()
     try:
-        u = db.query(User).filter(User.tg_id == tg_id).first()
+        u = await db.scalar(select(User).where(User.tg_id == tg_id).limit(1))
         if not u:
             return json_error("user not found", status=404)
-        m = db.query(Mode).filter(Mode.id == mode_id, Mode.user_id == u.id).first()
+        m = await db.scalar(select(Mode).where(Mode.id == mode_id, Mode.user_id == u.id).limit(1))
         if not m:
             return json_error("mode not found", status=404)
         s = Schedule(user_id=u.id, mode_id=m.id, start_time=start_time, end_time=end_time)
         db.add(s)
-        db.commit()
+        await db.commit()
+        # Планировщик пересоберёт таймеры пользователя
+        await publish_port_change_async(db, u.port)
         return web.json_response({"result": "created", "schedule_id": s.id})
     finally:
-        db.close()
+        await db.close()
 
 async def delete_schedule(request: web.Request):
     err = await auth(request)
@@ -355,31 +359,32 @@ async def delete_schedule(request: web.Request):
         return err
     tg_id = int(request.match_info["tg_id"])
     schedule_id = int(request.match_info["schedule_id"])
-    db: Session = get_session(engine)
+    db: AsyncSession = get_async_session()
     try:
-        u = db.query(User).filter(User.tg_id == tg_id).first()
+        u = await db.scalar(select(User).where(User.tg_id == tg_id).limit(1))
         if not u:
             return json_error("user not found", status=404)
-        s = db.query(Schedule).filter(Schedule.id == schedule_id, Schedule.user_id == u.id).first()
+        s = await db.scalar(select(Schedule).where(Schedule.id == schedule_id, Schedule.user_id == u.id).limit(1))
         if not s:
             return json_error("schedule not found", status=404)
-        db.delete(s)
-        db.commit()
+        await db.delete(s)
+        await db.commit()
+        await publish_port_change_async(db, u.port)
         return web.json_response({"result": "deleted"})
     finally:
-        db.close()
+        await db.close()
 
 async def list_payments(request: web.Request):
     err = await auth(request)
     if err:
         return err
-    db: Session = get_session(engine)
+    db: AsyncSession = get_async_session()
     try:
-        prs = db.query(PaymentRequest).filter(PaymentRequest.status == PaymentStatus.PENDING).order_by(PaymentRequest.created_at.asc()).all()
+        prs = (await db.scalars(select(PaymentRequest).where(PaymentRequest.status == PaymentStatus.PENDING).order_by(PaymentRequest.created_at.asc()))).all()
         data = [{"id": pr.id, "user_id": pr.user_id, "method": getattr(pr.method, "value", str(pr.method)), "file_id": pr.file_id, "created_at": pr.created_at.isoformat()} for pr in prs]
         return web.json_response({"requests": data})
     finally:
-        db.close()
+        await db.close()
 
 async def payment_update(request: web.Request):
     err = await auth(request)
@@ -388,9 +393,9 @@ async def payment_update(request: web.Request):
     body = await request.json()
     req_id = int(body.get("id"))
     action = body.get("action")
-    db: Session = get_session(engine)
+    db: AsyncSession = get_async_session()
     try:
-        pr = db.query(PaymentRequest).filter(PaymentRequest.id == req_id).first()
+        pr = await db.scalar(select(PaymentRequest).where(PaymentRequest.id == req_id).limit(1))
         if not pr:
             return json_error("request not found", status=404)
         if action == "approve":
@@ -399,10 +404,10 @@ async def payment_update(request: web.Request):
             pr.status = PaymentStatus.REJECTED
         else:
             return json_error("bad action")
-        db.commit()
+        await db.commit()
         return web.json_response({"result": "updated"})
     finally:
-        db.close()
+        await db.close()
 
 async def proxy_reload(request: web.Request):
     err = await auth(request)
@@ -455,7 +460,11 @@ async def main():
     site = web.TCPSite(runner, APP_API_HOST, APP_API_PORT)
     await site.start()
     stop_event = asyncio.Event()
-    await stop_event.wait()
+    try:
+        await stop_event.wait()
+    finally:
+        await runner.cleanup()
+        await dispose_async_engine()
 
 if __name__ == "__main__":
     try:
@@ -4,7 +4,10 @@ from aiogram import Dispatcher, types, F
 from aiogram.filters import Command
 from aiogram.fsm.context import FSMContext
 
+from sqlalchemy import select, func
+
 from db.models import User, Mode, Schedule
+from db.aio import get_async_session
 from config.settings import PROXY_API_HOST, PROXY_API_PORT, PROXY_API_TOKEN, APP_API_HOST, APP_API_PORT, APP_API_TOKEN
 
 logger = logging.getLogger(__name__)
@@ -16,7 +19,8 @@ def _set_proxy_server(server):
     global _proxy_server
     _proxy_server = server
 
-async def _proxy_api_reload_port(port: int):
+async def _proxy_api_reload_port(port: int) -> bool:
+    """Перезагрузка порта через API прокси. Возвращает True, если конфигурация порта изменилась."""
     base = f"http://{PROXY_API_HOST}:{PROXY_API_PORT}"
     url = base + "/reload-port"
     headers = {"X-Proxy-Token": PROXY_API_TOKEN} if PROXY_API_TOKEN else {}
@@ -25,6 +29,8 @@ async def _proxy_api_reload_port(port: int):
             if resp.status >= 400:
                 text = await resp.text()
                 raise RuntimeError(f"proxy api error {resp.status}: {text}")
+            data = await resp.json()
+            return bool(data.get("changed", True))
 
 async def _api_get(path: str):
     base = f"http://{APP_API_HOST}:{APP_API_PORT}"
@@ -65,18 +71,17 @@ async def cmd_admin_help(message: types.Message):
 async def cmd_users(message: types.Message):
     """Обработчик команды /users"""
     # Получаем сессию БД
-    from db.models import init_db, get_session, UserRole
-    engine = init_db()
-    db_session = get_session(engine)
+    from db.models import UserRole
+    db_session = get_async_session()
     
     try:
         # Проверка прав администратора
-        user = db_session.query(User).filter(User.tg_id == message.from_user.id).first()
+        user = await db_session.scalar(select(User).where(User.tg_id == message.from_user.id).limit(1))
         if not user or (user.role != UserRole.ADMIN and user.role != UserRole.SUPERADMIN):
             await message.answer("У вас нет прав для выполнения этой команды.")
             return
         
-        users = db_session.query(User).all()
+        users = (await db_session.scalars(select(User))).all()
         
         if not users:
             await message.answer("Пользователи не найдены.")
@@ -89,25 +94,24 @@ async def cmd_users(message: types.Message):
         
         await message.answer(response)
     finally:
-        db_session.close()
+        await db_session.close()
 
 async def cmd_stats(message: types.Message):
     """Обработчик команды /stats"""
     # Получаем сессию БД
-    from db.models import init_db, get_session, UserRole
-    engine = init_db()
-    db_session = get_session(engine)
+    from db.models import UserRole
+    db_session = get_async_session()
     
     try:
         # Проверка прав администратора
-        user = db_session.query(User).filter(User.tg_id == message.from_user.id).first()
+        user = await db_session.scalar(select(User).where(User.tg_id == message.from_user.id).limit(1))
         if not user or (user.role != UserRole.ADMIN and user.role != UserRole.SUPERADMIN):
             await message.answer("У вас нет прав для выполнения этой команды.")
             return
         
-        users_count = db_session.query(User).count()
-        modes_count = db_session.query(Mode).count()
-        schedules_count = db_session.query(Schedule).count()
+        users_count = await db_session.scalar(select(func.count()).select_from(User))
+        modes_count = await db_session.scalar(select(func.count()).select_from(Mode))
+        schedules_count = await db_session.scalar(select(func.count()).select_from(Schedule))
         
         response = "Статистика системы:\n\n"
         response += f"Пользователей: {users_count}\n"
@@ -116,7 +120,7 @@ async def cmd_stats(message: types.Message):
         
         await message.answer(response)
     finally:
-        db_session.close()
+        await db_session.close()
 
 def _split_args(text: str):
     try:
@@ -163,11 +167,10 @@ async def cmd_setport(message: types.Message):
 async def cmd_setsub(message: types.Message):
     """Установить дату подписки: /setsub <tg_id> <DD.MM.YYYY>"""
     import datetime
-    from db.models import init_db, get_session, User, UserRole
-    engine = init_db()
-    db_session = get_session(engine)
+    from db.models import User, UserRole
+    db_session = get_async_session()
     try:
-        admin = db_session.query(User).filter(User.tg_id == message.from_user.id).first()
+        admin = await db_session.scalar(select(User).where(User.tg_id == message.from_user.id).limit(1))
         if not admin or admin.role not in (UserRole.ADMIN, UserRole.SUPERADMIN):
             await message.answer("У вас нет прав для выполнения этой команды.")
             return
@@ -183,15 +186,15 @@ async def cmd_setsub(message: types.Message):
         except Exception:
             await message.answer("Неверный формат. Ожидается дата в формате DD.MM.YYYY.")
             return
-        user = db_session.query(User).filter(User.tg_id == tg_id).first()
+        user = await db_session.scalar(select(User).where(User.tg_id == tg_id).limit(1))
         if not user:
             await message.answer("Пользователь с таким tg_id не найден.")
             return
         user.subscription_until = until
-        db_session.commit()
+        await db_session.commit()
         await message.answer(f"Подписка пользователя {user.username or tg_id} установлена до {until.strftime('%d.%m.%Y')}.")
     finally:
-        db_session.close()
+        await db_session.close()
 
 async def cmd_adduser(message: types.Message):
     """Добавить пользователя: /adduser <tg_id> <username> <port> <login>"""
@@ -208,7 +211,7 @@ async def cmd_adduser(message: types.Message):
         await message.answer(f"Пользователь добавлен: {username} (tg_id={tg_id}), порт {port}, логин {login}.")
         try:
             if _proxy_server:
-                await _proxy_server.reload_port(port)
+                await _proxy_server.request_reload(port)
             else:
                 await _proxy_api_reload_port(port)
         except Exception:
@@ -218,24 +221,23 @@ async def cmd_adduser(message: types.Message):
 
 async def cmd_payments(message: types.Message):
     """Показать заявки на оплату со статусом PENDING"""
-    from db.models import init_db, get_session, User, UserRole, PaymentRequest, PaymentStatus
+    from db.models import User, UserRole, PaymentRequest, PaymentStatus
     from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
-    engine = init_db()
-    db_session = get_session(engine)
+    db_session = get_async_session()
     try:
-        admin = db_session.query(User).filter(User.tg_id == message.from_user.id).first()
+        admin = await db_session.scalar(select(User).where(User.tg_id == message.from_user.id).limit(1))
         if not admin or admin.role not in (UserRole.ADMIN, UserRole.SUPERADMIN):
             await message.answer("У вас нет прав для выполнения этой команды.")
             return
 
-        requests = db_session.query(PaymentRequest).filter(PaymentRequest.status == PaymentStatus.PENDING).order_by(PaymentRequest.created_at.asc()).all()
+        requests = (await db_session.scalars(select(PaymentRequest).where(PaymentRequest.status == PaymentStatus.PENDING).order_by(PaymentRequest.created_at.asc()))).all()
         if not requests:
             await message.answer("Нет заявок на оплату.")
             return
 
         await message.answer(f"Найдено заявок: {len(requests)}")
         for pr in requests:
-            user = db_session.query(User).filter(User.id == pr.user_id).first()
+            user = await db_session.scalar(select(User).where(User.id == pr.user_id).limit(1))
             info = (
                 f"Заявка #{pr.id}\n"
                 f"Пользователь: {user.username or user.tg_id} (tg_id={user.tg_id})\n"
@@ -248,15 +250,14 @@ async def cmd_payments(message: types.Message):
             ])
             await message.answer(info, reply_markup=kb)
     finally:
-        db_session.close()
+        await db_session.close()
 
 async def process_pay_view(callback: types.CallbackQuery):
-    from db.models import init_db, get_session, PaymentRequest
-    engine = init_db()
-    db_session = get_session(engine)
+    from db.models import PaymentRequest
+    db_session = get_async_session()
     try:
         req_id = int(callback.data.split("_")[-1])
-        pr = db_session.query(PaymentRequest).filter(PaymentRequest.id == req_id).first()
+        pr = await db_session.scalar(select(PaymentRequest).where(PaymentRequest.id == req_id).limit(1))
         if not pr:
             await callback.message.answer("Заявка не найдена.")
             await callback.answer()
@@ -271,24 +272,23 @@ async def process_pay_view(callback: types.CallbackQuery):
                 await callback.message.answer("Не удалось показать файл/скрин. Возможно, файл удалён или недоступен.")
     finally:
         await callback.answer()
-        db_session.close()
+        await db_session.close()
 
 async def process_pay_approve(callback: types.CallbackQuery):
-    from db.models import init_db, get_session, PaymentRequest, PaymentStatus, User
-    engine = init_db()
-    db_session = get_session(engine)
+    from db.models import PaymentRequest, PaymentStatus, User
+    db_session = get_async_session()
     try:
         req_id = int(callback.data.split("_")[-1])
-        pr = db_session.query(PaymentRequest).filter(PaymentRequest.id == req_id).first()
+        pr = await db_session.scalar(select(PaymentRequest).where(PaymentRequest.id == req_id).limit(1))
         if not pr:
             await callback.message.answer("Заявка не найдена.")
             await callback.answer()
             return
         pr.status = PaymentStatus.APPROVED
-        db_session.commit()
+        await db_session.commit()
         await callback.message.answer(f"Заявка #{req_id} подтверждена.")
         try:
-            user = db_session.query(User).filter(User.id == pr.user_id).first()
+            user = await db_session.scalar(select(User).where(User.id == pr.user_id).limit(1))
             if user:
                 await callback.bot.send_message(chat_id=user.tg_id, text="✅ Ваша оплата подтверждена. Администратор продлит подписку в ближайшее время.")
         except Exception:
@@ -297,24 +297,23 @@ async def process_pay_approve(callback: types.CallbackQuery):
         await callback.message.answer("Ошибка подтверждения заявки.")
     finally:
         await callback.answer()
-        db_session.close()
+        await db_session.close()
 
 async def process_pay_reject(callback: types.CallbackQuery):
-    from db.models import init_db, get_session, PaymentRequest, PaymentStatus, User
-    engine = init_db()
-    db_session = get_session(engine)
+    from db.models import PaymentRequest, PaymentStatus, User
+    db_session = get_async_session()
     try:
         req_id = int(callback.data.split("_")[-1])
-        pr = db_session.query(PaymentRequest).filter(PaymentRequest.id == req_id).first()
+        pr = await db_session.scalar(select(PaymentRequest).where(PaymentRequest.id == req_id).limit(1))
         if not pr:
             await callback.message.answer("Заявка не найдена.")
             await callback.answer()
             return
         pr.status = PaymentStatus.REJECTED
-        db_session.commit()
+        await db_session.commit()
         await callback.message.answer(f"Заявка #{req_id} отклонена.")
         try:
-            user = db_session.query(User).filter(User.id == pr.user_id).first()
+            user = await db_session.scalar(select(User).where(User.id == pr.user_id).limit(1))
             if user:
                 await callback.bot.send_message(chat_id=user.tg_id, text="❌ Ваша оплата отклонена. Проверьте данные и попробуйте снова.")
         except Exception:
@@ -323,20 +322,19 @@ async def process_pay_reject(callback: types.CallbackQuery):
         await callback.message.answer("Ошибка отклонения заявки.")
     finally:
         await callback.answer()
-        db_session.close()
+        await db_session.close()
 
 # Новый обработчик: скрыть уведомление у админа
 async def process_pay_seen(callback: types.CallbackQuery):
-    from db.models import init_db, get_session, User, UserRole, PaymentRequest
-    engine = init_db()
-    db_session = get_session(engine)
+    from db.models import User, UserRole, PaymentRequest
+    db_session = get_async_session()
     try:
-        admin = db_session.query(User).filter(User.tg_id == callback.from_user.id).first()
+        admin = await db_session.scalar(select(User).where(User.tg_id == callback.from_user.id).limit(1))
         if not admin or admin.role not in (UserRole.ADMIN, UserRole.SUPERADMIN):
             await callback.answer("Нет прав", show_alert=True)
             return
         req_id = int(callback.data.split("_")[-1])
-        _ = db_session.query(PaymentRequest.id).filter(PaymentRequest.id == req_id).first()
+        _ = await db_session.scalar(select(PaymentRequest.id).where(PaymentRequest.id == req_id).limit(1))
         # Удаляем уведомление из чата админа
         try:
             await callback.message.delete()
@@ -348,16 +346,15 @@ async def process_pay_seen(callback: types.CallbackQuery):
                 pass
     finally:
         await callback.answer()
-        db_session.close()
+        await db_session.close()
 
 async def cmd_extendsub(message: types.Message):
     """Продлить подписку пользователю на N месяцев: /extendsub <tg_id> [months]"""
     import datetime, calendar
-    from db.models import init_db, get_session, User, UserRole
-    engine = init_db()
-    db_session = get_session(engine)
+    from db.models import User, UserRole
+    db_session = get_async_session()
     try:
-        admin = db_session.query(User).filter(User.tg_id == message.from_user.id).first()
+        admin = await db_session.scalar(select(User).where(User.tg_id == message.from_user.id).limit(1))
         if not admin or admin.role not in (UserRole.ADMIN, UserRole.SUPERADMIN):
             await message.answer("У вас нет прав для выполнения этой команды.")
             return
@@ -373,7 +370,7 @@ async def cmd_extendsub(message: types.Message):
             await message.answer("tg_id и months должны быть числами.")
             return
 
-        user = db_session.query(User).filter(User.tg_id == tg_id).first()
+        user = await db_session.scalar(select(User).where(User.tg_id == tg_id).limit(1))
         if not user:
             await message.answer("Пользователь с таким tg_id не найден.")
             return
@@ -390,10 +387,10 @@ async def cmd_extendsub(message: types.Message):
         new_until = new_until.replace(hour=23, minute=59, second=59, microsecond=0)
 
         user.subscription_until = new_until
-        db_session.commit()
+        await db_session.commit()
         await message.answer(f"Подписка пользователя {user.username or tg_id} продлена до {new_until.strftime('%d.%m.%Y')}.")
     finally:
-        db_session.close()
+        await db_session.close()
 
 def register_admin_handlers(dp: Dispatcher):
     """Регистрация обработчиков административных команд"""
@@ -412,11 +409,10 @@ def register_admin_handlers(dp: Dispatcher):
 
 async def cmd_reloadport(message: types.Message):
     """Точечная перезагрузка порта: /reloadport <port>"""
-    from db.models import init_db, get_session, User, UserRole
-    engine = init_db()
-    db_session = get_session(engine)
+    from db.models import User, UserRole
+    db_session = get_async_session()
     try:
-        admin = db_session.query(User).filter(User.tg_id == message.from_user.id).first()
+        admin = await db_session.scalar(select(User).where(User.tg_id == message.from_user.id).limit(1))
         if not admin or admin.role not in (UserRole.ADMIN, UserRole.SUPERADMIN):
             await message.answer("У вас нет прав для выполнения этой команды.")
             return
@@ -433,15 +429,18 @@ async def cmd_reloadport(message: types.Message):
 
         try:
             if _proxy_server:
-                await _proxy_server.reload_port(port)
+                changed = await _proxy_server.request_reload(port)
             else:
-                await _proxy_api_reload_port(port)
-            await message.answer(f"Порт {port} перезагружен.")
+                changed = await _proxy_api_reload_port(port)
+            if changed:
+                await message.answer(f"Порт {port} перезагружен.")
+            else:
+                await message.answer(f"Конфигурация порта {port} не изменилась, перезагрузка не требуется.")
         except Exception as e:
             logger.error(f"Ошибка перезагрузки порта {port}: {e}")
             await message.answer("Ошибка перезагрузки порта. Проверьте логи сервера.")
     finally:
-        db_session.close()
+        await db_session.close()
 
 def register_admin_handlers(dp: Dispatcher, proxy_server=None):
     """Регистрация обработчиков административных команд, с возможной передачей proxy_server"""
@@ -1,7 +1,11 @@
 from aiogram import Dispatcher, types, F
 from aiogram.fsm.context import FSMContext
 
-from db.models import User, Mode, get_session, init_db, UserRole, Device
+from sqlalchemy import select
+
+from db.models import User, Mode, UserRole, Device
+from db.aio import get_async_session
+from db.changes import publish_port_change_async
 from bot.keyboards import (
     get_pools_management_keyboard,
     get_settings_keyboard,
@@ -39,10 +43,9 @@ async def cmd_settings(message: types.Message):
 
 
 async def cmd_back(message: types.Message, state: FSMContext):
-    engine = init_db()
-    db_session = get_session(engine)
+    db_session = get_async_session()
     try:
-        user = db_session.query(User).filter(User.tg_id == message.from_user.id).first()
+        user = await db_session.scalar(select(User).where(User.tg_id == message.from_user.id).limit(1))
         is_admin = _is_admin_user(user)
         data = await state.get_data()
         dest = data.get("back_to")
@@ -52,21 +55,20 @@ async def cmd_back(message: types.Message, state: FSMContext):
         else:
             await message.answer("Главное меню:", reply_markup=get_main_keyboard(is_admin=is_admin))
     finally:
-        db_session.close()
+        await db_session.close()
 
 
 # ===== Удаление пулов с пагинацией =====
 async def cmd_delete_mode_start(message: types.Message, state: FSMContext):
-    engine = init_db()
-    db_session = get_session(engine)
+    db_session = get_async_session()
     try:
-        user = db_session.query(User).filter(User.tg_id == message.from_user.id).first()
+        user = await db_session.scalar(select(User).where(User.tg_id == message.from_user.id).limit(1))
         if not user:
             await message.answer("Вы не зарегистрированы в системе.")
             return
         # Устанавливаем контекст возврата в меню управления пулами
         await state.update_data(back_to="pools_management")
-        modes = db_session.query(Mode).filter(Mode.user_id == user.id).all()
+        modes = (await db_session.scalars(select(Mode).where(Mode.user_id == user.id))).all()
         if not modes:
             await message.answer("У вас пока нет добавленных пулов.")
             await message.answer("Для выхода нажмите Назад.", reply_markup=get_back_keyboard())
@@ -77,29 +79,33 @@ async def cmd_delete_mode_start(message: types.Message, state: FSMContext):
         # Отдельно включаем клавиатуру возврата
         await message.answer("Для выхода нажмите Назад.", reply_markup=get_back_keyboard())
     finally:
-        db_session.close()
+        await db_session.close()
 
 
 async def process_delete_mode_callback(callback: types.CallbackQuery, state: FSMContext):
-    engine = init_db()
-    db_session = get_session(engine)
+    db_session = get_async_session()
     try:
         data = callback.data  # del_mode_<id>
         mode_id = int(data.split("_")[-1])
-        user = db_session.query(User).filter(User.tg_id == callback.from_user.id).first()
+        user = await db_session.scalar(select(User).where(User.tg_id == callback.from_user.id).limit(1))
         if not user:
             await callback.message.answer("Вы не зарегистрированы в системе.")
             await callback.answer()
             return
-        mode = db_session.query(Mode).filter(Mode.id == mode_id, Mode.user_id == user.id).first()
+        mode = await db_session.scalar(select(Mode).where(Mode.id == mode_id, Mode.user_id == user.id).limit(1))
         if not mode:
             await callback.answer("Пул не найден.")
             return
-        db_session.delete(mode)
-        db_session.commit()
+        was_active = user.active_mode_id == mode.id
+        if was_active:
+            user.active_mode_id = None
+        await db_session.delete(mode)
+        await db_session.commit()
+        if was_active:
+            await publish_port_change_async(db_session, user.port)
         await callback.answer("Пул удалён.")
         # Перерисуем список с первой страницы
-        modes = db_session.query(Mode).filter(Mode.user_id == user.id).all()
+        modes = (await db_session.scalars(select(Mode).where(Mode.user_id == user.id))).all()
         if modes:
             kb = get_delete_modes_keyboard(modes, page=1, page_size=5)
             try:
@@ -121,22 +127,21 @@ async def process_delete_mode_callback(callback: types.CallbackQuery, state: FSM
         except Exception:
             pass
     finally:
-        db_session.close()
+        await db_session.close()
 
 
 async def process_delete_modes_pagination(callback: types.CallbackQuery):
-    engine = init_db()
-    db_session = get_session(engine)
+    db_session = get_async_session()
     try:
         data = callback.data  # del_next_<page> / del_prev_<page>
         parts = data.split("_")
         direction = parts[1]
         page = int(parts[2])
-        user = db_session.query(User).filter(User.tg_id == callback.from_user.id).first()
+        user = await db_session.scalar(select(User).where(User.tg_id == callback.from_user.id).limit(1))
         if not user:
             await callback.answer("Нет доступа.")
             return
-        modes = db_session.query(Mode).filter(Mode.user_id == user.id).all()
+        modes = (await db_session.scalars(select(Mode).where(Mode.user_id == user.id))).all()
         kb = get_delete_modes_keyboard(modes, page=page, page_size=5)
         try:
             await callback.message.edit_reply_markup(reply_markup=kb)
@@ -144,7 +149,7 @@ async def process_delete_modes_pagination(callback: types.CallbackQuery):
             await callback.message.answer("Список пулов:", reply_markup=kb)
         await callback.answer()
     finally:
-        db_session.close()
+        await db_session.close()
 
 
 def register_menu_handlers(dp: Dispatcher):
@@ -158,12 +163,11 @@ def register_menu_handlers(dp: Dispatcher):
     dp.message.register(cmd_addmode, F.text == "Добавить пул")
 
     async def cmd_modes_wrapper(msg: types.Message):
-        engine = init_db()
-        db_session = get_session(engine)
+        db_session = get_async_session()
         try:
             await cmd_modes(msg, db_session)
         finally:
-            db_session.close()
+            await db_session.close()
 
     dp.message.register(cmd_modes_wrapper, F.text == "Список пулов")
 
@@ -196,15 +200,14 @@ def _format_uptime(delta) -> str:
 
 async def cmd_my_devices(message: types.Message):
     """Показ списка аппаратов пользователя с статусом и аптаймом"""
-    engine = init_db()
-    db_session = get_session(engine)
+    db_session = get_async_session()
     try:
-        user = db_session.query(User).filter(User.tg_id == message.from_user.id).first()
+        user = await db_session.scalar(select(User).where(User.tg_id == message.from_user.id).limit(1))
         if not user:
             await message.answer("Вы не зарегистрированы в системе.")
             return
 
-        devices = db_session.query(Device).filter(Device.user_id == user.id).all()
+        devices = (await db_session.scalars(select(Device).where(Device.user_id == user.id))).all()
         if not devices:
             await message.answer("Пока нет подключённых аппаратов.", reply_markup=get_back_keyboard())
             return
@@ -230,4 +233,4 @@ async def cmd_my_devices(message: types.Message):
         text = "Ваши аппараты:\n" + "\n".join(lines)
         await message.answer(text, reply_markup=get_back_keyboard())
     finally:
-        db_session.close()
\ No newline at end of file
+        await db_session.close()
\ No newline at end of file
@@ -9,7 +9,11 @@ from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.filters import Command
 
-from db.models import User, Mode, Schedule, get_session, init_db, UserRole
+from sqlalchemy import select
+
+from db.models import User, Mode, Schedule, UserRole
+from db.aio import get_async_session, set_active_mode
+from db.changes import publish_port_change_async
 from bot.keyboards import (
     get_modes_keyboard,
     get_cancel_keyboard,
@@ -73,11 +77,10 @@ class PaymentState(StatesGroup):
 async def cmd_start(message: types.Message, state: FSMContext = None):
     """Обработчик команды /start"""
     # Получаем сессию БД
-    engine = init_db()
-    db_session = get_session(engine)
+    db_session = get_async_session()
     
     try:
-        user = db_session.query(User).filter(User.tg_id == message.from_user.id).first()
+        user = await db_session.scalar(select(User).where(User.tg_id == message.from_user.id).limit(1))
         is_admin = _is_admin_user(user)
         
         if user:
@@ -100,7 +103,7 @@ async def cmd_start(message: types.Message, state: FSMContext = None):
                 "Вы не зарегистрированы в системе. Обратитесь к администратору для получения доступа."
             )
     finally:
-        db_session.close()
+        await db_session.close()
     
     # Сбрасываем состояние FSM, если оно есть
     if state:
@@ -120,7 +123,7 @@ async def process_login_input(message: types.Message, state: FSMContext, db_sess
 
     # Обработка отмены прямо в обработчике ввода логина
     if new_login.lower() == "отмена":
-        user = db_session.query(User).filter(User.tg_id == message.from_user.id).first()
+        user = await db_session.scalar(select(User).where(User.tg_id == message.from_user.id).limit(1))
         is_admin = _is_admin_user(user)
         await message.answer("Действие отменено.", reply_markup=get_main_keyboard(is_admin=is_admin))
         await state.clear()
@@ -131,10 +134,11 @@ async def process_login_input(message: types.Message, state: FSMContext, db_sess
         return
     
     # Обновляем логин пользователя в БД
-    user = db_session.query(User).filter(User.tg_id == message.from_user.id).first()
+    user = await db_session.scalar(select(User).where(User.tg_id == message.from_user.id).limit(1))
     if user:
         user.login = new_login
-        db_session.commit()
+        await db_session.commit()
+        await publish_port_change_async(db_session, user.port)
         is_admin = _is_admin_user(user)
         await message.answer(
             f"Логин успешно изменен на: {new_login}",
@@ -215,7 +219,7 @@ async def process_mode_alias(message: types.Message, state: FSMContext, db_sessi
     port = data.get('port')
     
     # Создаем новый режим в БД
-    user = db_session.query(User).filter(User.tg_id == message.from_user.id).first()
+    user = await db_session.scalar(select(User).where(User.tg_id == message.from_user.id).limit(1))
     if user:
         new_mode = Mode(
             user_id=user.id,
@@ -225,7 +229,7 @@ async def process_mode_alias(message: types.Message, state: FSMContext, db_sessi
             alias=mode_alias
         )
         db_session.add(new_mode)
-        db_session.commit()
+        await db_session.commit()
         
         is_admin = _is_admin_user(user)
         await message.answer(
@@ -246,13 +250,13 @@ async def process_mode_alias(message: types.Message, state: FSMContext, db_sessi
 
 async def cmd_modes(message: types.Message, db_session):
     """Обработчик команды /modes"""
-    user = db_session.query(User).filter(User.tg_id == message.from_user.id).first()
+    user = await db_session.scalar(select(User).where(User.tg_id == message.from_user.id).limit(1))
     
     if not user:
         await message.answer("Вы не зарегистрированы в системе.")
         return
     
-    modes = db_session.query(Mode).filter(Mode.user_id == user.id).all()
+    modes = (await db_session.scalars(select(Mode).where(Mode.user_id == user.id))).all()
     
     if not modes:
         await message.answer("У вас пока нет добавленных пулов. Добавьте их с помощью кнопки Добавить пул или команды /addmode.")
@@ -268,13 +272,13 @@ async def cmd_modes(message: types.Message, db_session):
 
 async def cmd_setmode(message: types.Message, state: FSMContext, db_session):
     """Обработчик команды /setmode"""
-    user = db_session.query(User).filter(User.tg_id == message.from_user.id).first()
+    user = await db_session.scalar(select(User).where(User.tg_id == message.from_user.id).limit(1))
     
     if not user:
         await message.answer("Вы не зарегистрированы в системе.")
         return
     
-    modes = db_session.query(Mode).filter(Mode.user_id == user.id).all()
+    modes = (await db_session.scalars(select(Mode).where(Mode.user_id == user.id))).all()
     
     if not modes:
         await message.answer("У вас пока нет добавленных пулов. Добавьте их с помощью кнопки Добавить пул или команды /addmode.")
@@ -291,22 +295,22 @@ async def process_mode_callback(callback: types.CallbackQuery, state: FSMContext
     data = callback.data  # ожидаем формат: set_mode_<id>
     try:
         mode_id = int(data.split("_")[-1])
-        user = db_session.query(User).filter(User.tg_id == callback.from_user.id).first()
+        user = await db_session.scalar(select(User).where(User.tg_id == callback.from_user.id).limit(1))
         if not user:
             await callback.message.answer("Вы не зарегистрированы в системе.")
             await callback.answer()
             return
 
-        mode = db_session.query(Mode).filter(Mode.id == mode_id, Mode.user_id == user.id).first()
+        mode = await db_session.scalar(select(Mode).where(Mode.id == mode_id, Mode.user_id == user.id).limit(1))
         if not mode:
             await callback.message.answer("Пул не найден. Попробуйте еще раз.")
             await callback.answer()
             return
 
-        # Деактивируем предыдущий режим, активируем выбранный
-        db_session.query(Mode).filter(Mode.user_id == user.id, Mode.is_active == 1).update({Mode.is_active: 0})
-        mode.is_active = 1
-        db_session.commit()
+        # Переключаем активный режим на выбранный
+        await set_active_mode(db_session, user.id, mode.id)
+        await db_session.commit()
+        await publish_port_change_async(db_session, user.port)
 
         is_admin = _is_admin_user(user)
         await callback.message.answer(
@@ -324,23 +328,23 @@ async def process_mode_selection(message: types.Message, state: FSMContext, db_s
     try:
         text = message.text.strip()
         if _is_cancel_text(text):
-            user = db_session.query(User).filter(User.tg_id == message.from_user.id).first()
+            user = await db_session.scalar(select(User).where(User.tg_id == message.from_user.id).limit(1))
             is_admin = _is_admin_user(user)
             await message.answer("Действие отменено.", reply_markup=get_main_keyboard(is_admin=is_admin))
             return
         mode_id = int(text)
         
-        user = db_session.query(User).filter(User.tg_id == message.from_user.id).first()
-        mode = db_session.query(Mode).filter(Mode.id == mode_id, Mode.user_id == user.id).first()
+        user = await db_session.scalar(select(User).where(User.tg_id == message.from_user.id).limit(1))
+        mode = await db_session.scalar(select(Mode).where(Mode.id == mode_id, Mode.user_id == user.id).limit(1))
         
         if not mode:
             await message.answer("Пул не найден. Попробуйте еще раз.")
             return
         
-        # Снимаем флаг активности у предыдущего режима и активируем выбранный
-        db_session.query(Mode).filter(Mode.user_id == user.id, Mode.is_active == 1).update({Mode.is_active: 0})
-        mode.is_active = 1
-        db_session.commit()
+        # Переключаем активный режим на выбранный
+        await set_active_mode(db_session, user.id, mode.id)
+        await db_session.commit()
+        await publish_port_change_async(db_session, user.port)
         
         is_admin = _is_admin_user(user)
         await message.answer(
@@ -368,7 +372,7 @@ async def process_schedule_action(message: types.Message, state: FSMContext, db_
     """Обработка выбора действия с расписанием"""
     action_text = message.text.strip()
     if _is_cancel_text(action_text):
-        user = db_session.query(User).filter(User.tg_id == message.from_user.id).first()
+        user = await db_session.scalar(select(User).where(User.tg_id == message.from_user.id).limit(1))
         is_admin = _is_admin_user(user)
         await message.answer("Действие отменено.", reply_markup=get_main_keyboard(is_admin=is_admin))
         await state.clear()
@@ -376,8 +380,8 @@ async def process_schedule_action(message: types.Message, state: FSMContext, db_
     action = action_text.lower()
     
     if action in ['add', '1', 'добавить']:
-        user = db_session.query(User).filter(User.tg_id == message.from_user.id).first()
-        modes = db_session.query(Mode).filter(Mode.user_id == user.id).all()
+        user = await db_session.scalar(select(User).where(User.tg_id == message.from_user.id).limit(1))
+        modes = (await db_session.scalars(select(Mode).where(Mode.user_id == user.id))).all()
         
         if not modes:
             await message.answer("У вас пока нет добавленных пулов. Добавьте их с помощью кнопки Добавить пул или команды /addmode.")
@@ -396,12 +400,12 @@ async def process_schedule_action(message: types.Message, state: FSMContext, db_
     
     elif action in ['delete', '3', 'удалить']:
         # Показ списка расписаний с кнопками удаления
-        user = db_session.query(User).filter(User.tg_id == message.from_user.id).first()
+        user = await db_session.scalar(select(User).where(User.tg_id == message.from_user.id).limit(1))
         if not user:
             await message.answer("Вы не зарегистрированы в системе.")
             await state.clear()
             return
-        schedules = db_session.query(Schedule).filter(Schedule.user_id == user.id).all()
+        schedules = (await db_session.scalars(select(Schedule).where(Schedule.user_id == user.id))).all()
         if not schedules:
             await message.answer("У вас пока нет добавленных расписаний.")
             await state.clear()
@@ -421,8 +425,8 @@ async def process_schedule_mode(message: types.Message, state: FSMContext, db_se
     try:
         mode_id = int(message.text.strip())
         
-        user = db_session.query(User).filter(User.tg_id == message.from_user.id).first()
-        mode = db_session.query(Mode).filter(Mode.id == mode_id, Mode.user_id == user.id).first()
+        user = await db_session.scalar(select(User).where(User.tg_id == message.from_user.id).limit(1))
+        mode = await db_session.scalar(select(Mode).where(Mode.id == mode_id, Mode.user_id == user.id).limit(1))
         
         if not mode:
             await message.answer("Пул не найден. Попробуйте еще раз.")
@@ -445,12 +449,12 @@ async def process_schedule_mode_callback(callback: types.CallbackQuery, state: F
     data = callback.data  # ожидаем формат: schedule_mode_<id>
     try:
         mode_id = int(data.split("_")[-1])
-        user = db_session.query(User).filter(User.tg_id == callback.from_user.id).first()
+        user = await db_session.scalar(select(User).where(User.tg_id == callback.from_user.id).limit(1))
         if not user:
             await callback.message.answer("Вы не зарегистрированы в системе.")
             await callback.answer()
             return
-        mode = db_session.query(Mode).filter(Mode.id == mode_id, Mode.user_id == user.id).first()
+        mode = await db_session.scalar(select(Mode).where(Mode.id == mode_id, Mode.user_id == user.id).limit(1))
         if not mode:
             await callback.message.answer("Пул не найден. Попробуйте еще раз.")
             await callback.answer()
@@ -471,19 +475,21 @@ async def process_schedule_mode_callback(callback: types.CallbackQuery, state: F
 async def process_schedule_delete_callback(callback: types.CallbackQuery):
     """Удаление расписания по инлайн-кнопке delete_schedule_<id>"""
     data = callback.data  # ожидаем формат: delete_schedule_<id>
-    engine = init_db()
-    db_session = get_session(engine)
+    db_session = get_async_session()
     try:
         schedule_id = int(data.split("_")[-1])
-        schedule = db_session.query(Schedule).filter(Schedule.id == schedule_id).first()
+        schedule = await db_session.scalar(select(Schedule).where(Schedule.id == schedule_id).limit(1))
         if not schedule:
             await callback.message.answer("Расписание не найдено.")
             await callback.answer()
             return
-        user = db_session.query(User).filter(User.id == schedule.user_id).first()
+        user = await db_session.scalar(select(User).where(User.id == schedule.user_id).limit(1))
         is_admin = bool(user and user.role in (UserRole.ADMIN, UserRole.SUPERADMIN))
-        db_session.delete(schedule)
-        db_session.commit()
+        await db_session.delete(schedule)
+        await db_session.commit()
+        # Планировщик пересоберёт таймеры пользователя
+        if user:
+            await publish_port_change_async(db_session, user.port)
         await callback.message.answer(
             "Расписание удалено.",
             reply_markup=get_main_keyboard(is_admin=is_admin)
@@ -492,7 +498,7 @@ async def process_schedule_delete_callback(callback: types.CallbackQuery):
         await callback.message.answer("Ошибка удаления расписания. Попробуйте снова.")
     finally:
         await callback.answer()
-        db_session.close()
+        await db_session.close()
 
 async def process_schedule_start_time(message: types.Message, state: FSMContext):
     """Обработка ввода времени начала расписания"""
@@ -550,7 +556,7 @@ async def process_schedule_confirmation(message: types.Message, state: FSMContex
     """Обработка подтверждения создания расписания"""
     answer = message.text.strip().lower()
     if _is_cancel_text(answer):
-        user = db_session.query(User).filter(User.tg_id == message.from_user.id).first()
+        user = await db_session.scalar(select(User).where(User.tg_id == message.from_user.id).limit(1))
         is_admin = _is_admin_user(user)
         await message.answer("Действие отменено.", reply_markup=get_main_keyboard(is_admin=is_admin))
         await state.clear()
@@ -564,7 +570,7 @@ async def process_schedule_confirmation(message: types.Message, state: FSMContex
         end_time = data.get('end_time')
         
         # Получаем пользователя
-        user = db_session.query(User).filter(User.tg_id == message.from_user.id).first()
+        user = await db_session.scalar(select(User).where(User.tg_id == message.from_user.id).limit(1))
         
         if user:
             # Создаем новое расписание
@@ -575,7 +581,8 @@ async def process_schedule_confirmation(message: types.Message, state: FSMContex
                 end_time=end_time
             )
             db_session.add(new_schedule)
-            db_session.commit()
+            await db_session.commit()
+            await publish_port_change_async(db_session, user.port)
             
             is_admin = _is_admin_user(user)
             await message.answer(
@@ -586,7 +593,7 @@ async def process_schedule_confirmation(message: types.Message, state: FSMContex
             await message.answer("Вы не зарегистрированы в системе.")
     else:
         # Показываем основную клавиатуру после отмены
-        user = db_session.query(User).filter(User.tg_id == message.from_user.id).first()
+        user = await db_session.scalar(select(User).where(User.tg_id == message.from_user.id).limit(1))
         is_admin = _is_admin_user(user)
         await message.answer(
             "Создание расписания отменено.",
@@ -598,13 +605,13 @@ async def process_schedule_confirmation(message: types.Message, state: FSMContex
 
 async def show_schedules(message: types.Message, db_session):
     """Показать список расписаний пользователя"""
-    user = db_session.query(User).filter(User.tg_id == message.from_user.id).first()
+    user = await db_session.scalar(select(User).where(User.tg_id == message.from_user.id).limit(1))
     
     if not user:
         await message.answer("Вы не зарегистрированы в системе.", reply_markup=get_main_keyboard(is_admin=False))
         return
     
-    schedules = db_session.query(Schedule).filter(Schedule.user_id == user.id).all()
+    schedules = (await db_session.scalars(select(Schedule).where(Schedule.user_id == user.id))).all()
     
     if not schedules:
         is_admin = _is_admin_user(user)
@@ -613,7 +620,7 @@ async def show_schedules(message: types.Message, db_session):
     
     response = "Ваши расписания:\n\n"
     for i, schedule in enumerate(schedules, 1):
-        mode = db_session.query(Mode).filter(Mode.id == schedule.mode_id).first()
+        mode = await db_session.scalar(select(Mode).where(Mode.id == schedule.mode_id).limit(1))
         mode_name = mode.name if mode else "Неизвестный пул"
         
         response += f"{i}. {mode_name}\n"
@@ -623,14 +630,14 @@ async def show_schedules(message: types.Message, db_session):
 
 async def cmd_status(message: types.Message, db_session):
     """Обработчик команды /status"""
-    user = db_session.query(User).filter(User.tg_id == message.from_user.id).first()
+    user = await db_session.scalar(select(User).where(User.tg_id == message.from_user.id).limit(1))
     
     if not user:
         await message.answer("Вы не зарегистрированы в системе.")
         return
     
-    # Определяем активный режим по флагу is_active
-    active_mode = db_session.query(Mode).filter(Mode.user_id == user.id, Mode.is_active == 1).first()
+    # Активный режим — по указателю пользователя
+    active_mode = await db_session.get(Mode, user.active_mode_id) if user.active_mode_id else None
     
     response = f"Ваш статус:\n\n"
     response += f"Порт: {user.port}\n"
@@ -668,13 +675,14 @@ async def process_timezone_callback(callback: types.CallbackQuery, state: FSMCon
             return
         # Проверим валидность
         ZoneInfo(tz)
-        user = db_session.query(User).filter(User.tg_id == callback.from_user.id).first()
+        user = await db_session.scalar(select(User).where(User.tg_id == callback.from_user.id).limit(1))
         if not user:
             await callback.message.answer("Вы не зарегистрированы в системе.")
             await callback.answer()
             return
         user.timezone = tz
-        db_session.commit()
+        await db_session.commit()
+        await publish_port_change_async(db_session, user.port)
         is_admin = _is_admin_user(user)
         await callback.message.answer(f"Часовой пояс установлен: {tz}", reply_markup=get_main_keyboard(is_admin=is_admin))
     except Exception:
@@ -687,7 +695,7 @@ async def process_timezone_input(message: types.Message, state: FSMContext, db_s
     from zoneinfo import ZoneInfo
     text = message.text.strip()
     if _is_cancel_text(text):
-        user = db_session.query(User).filter(User.tg_id == message.from_user.id).first()
+        user = await db_session.scalar(select(User).where(User.tg_id == message.from_user.id).limit(1))
         is_admin = _is_admin_user(user)
         await message.answer("Действие отменено.", reply_markup=get_main_keyboard(is_admin=is_admin))
         await state.clear()
@@ -707,13 +715,14 @@ async def process_timezone_input(message: types.Message, state: FSMContext, db_s
     except Exception:
         await message.answer("Неверный часовой пояс. Введите корректный IANA идентификатор, например Europe/Moscow.")
         return
-    user = db_session.query(User).filter(User.tg_id == message.from_user.id).first()
+    user = await db_session.scalar(select(User).where(User.tg_id == message.from_user.id).limit(1))
     if not user:
         await message.answer("Вы не зарегистрированы в системе.")
         await state.clear()
         return
     user.timezone = tz
-    db_session.commit()
+    await db_session.commit()
+    await publish_port_change_async(db_session, user.port)
     is_admin = _is_admin_user(user)
     await message.answer(f"Часовой пояс установлен: {tz}", reply_markup=get_main_keyboard(is_admin=is_admin))
     await state.clear()
@@ -721,10 +730,9 @@ async def process_timezone_input(message: types.Message, state: FSMContext, db_s
 async def cmd_help(message: types.Message):
     """Обработчик команды /help"""
     # Создаем сессию БД, чтобы получить порт и логин пользователя
-    engine = init_db()
-    db_session = get_session(engine)
+    db_session = get_async_session()
     try:
-        user = db_session.query(User).filter(User.tg_id == message.from_user.id).first()
+        user = await db_session.scalar(select(User).where(User.tg_id == message.from_user.id).limit(1))
         # Блок команд
         commands_block = (
             "Доступные команды:\n\n"
@@ -745,7 +753,7 @@ async def cmd_help(message: types.Message):
         else:
             await message.answer(commands_block + "Вы не зарегистрированы в системе. Обратитесь к администратору.")
     finally:
-        db_session.close()
+        await db_session.close()
 
 async def cmd_cancel(message: types.Message, state: FSMContext):
     """Обработчик команды отмены"""
@@ -753,23 +761,21 @@ async def cmd_cancel(message: types.Message, state: FSMContext):
     if current_state is not None:
         await state.clear()
         # Показываем основную клавиатуру после отмены
-        engine = init_db()
-        db_session = get_session(engine)
+        db_session = get_async_session()
         try:
-            user = db_session.query(User).filter(User.tg_id == message.from_user.id).first()
+            user = await db_session.scalar(select(User).where(User.tg_id == message.from_user.id).limit(1))
             is_admin = _is_admin_user(user)
             await message.answer("Действие отменено.", reply_markup=get_main_keyboard(is_admin=is_admin))
         finally:
-            db_session.close()
+            await db_session.close()
     else:
-        engine = init_db()
-        db_session = get_session(engine)
+        db_session = get_async_session()
         try:
-            user = db_session.query(User).filter(User.tg_id == message.from_user.id).first()
+            user = await db_session.scalar(select(User).where(User.tg_id == message.from_user.id).limit(1))
             is_admin = _is_admin_user(user)
             await message.answer("Нет активного действия для отмены.", reply_markup=get_main_keyboard(is_admin=is_admin))
         finally:
-            db_session.close()
+            await db_session.close()
 
 # ===== Оплата подписки =====
 def _payment_settings():
@@ -921,19 +927,18 @@ async def process_pay_cancel(callback: types.CallbackQuery, state: FSMContext):
     except Exception:
         pass
     # Вернем пользователя на основную клавиатуру
-    engine = init_db()
-    db_session = get_session(engine)
+    db_session = get_async_session()
     try:
-        user = db_session.query(User).filter(User.tg_id == callback.from_user.id).first()
+        user = await db_session.scalar(select(User).where(User.tg_id == callback.from_user.id).limit(1))
         is_admin = _is_admin_user(user)
         await callback.message.answer("Оплата отменена.", reply_markup=get_main_keyboard(is_admin=is_admin))
     finally:
-        db_session.close()
+        await db_session.close()
     await callback.answer("Действие отменено")
 
 async def process_payment_screenshot(message: types.Message, state: FSMContext, db_session):
     # Ожидаем фото или документ оплаты
-    user = db_session.query(User).filter(User.tg_id == message.from_user.id).first()
+    user = await db_session.scalar(select(User).where(User.tg_id == message.from_user.id).limit(1))
     is_admin = _is_admin_user(user)
 
     # Проверка отмены
@@ -969,14 +974,14 @@ async def process_payment_screenshot(message: types.Message, state: FSMContext,
             status=PaymentStatus.PENDING,
         )
         db_session.add(pr)
-        db_session.commit()
+        await db_session.commit()
         await message.answer(
             "Заявка на оплату отправлена на проверку.",
             reply_markup=get_main_keyboard(is_admin=is_admin)
         )
         # Уведомление админам о новой заявке с кнопкой 'Просмотрено'
         try:
-            admins = db_session.query(User).filter(User.role.in_([UserRole.ADMIN, UserRole.SUPERADMIN])).all()
+            admins = (await db_session.scalars(select(User).where(User.role.in_([UserRole.ADMIN, UserRole.SUPERADMIN])))).all()
             if admins:
                 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
                 info = f"Пришла новая заявка на оплату! (#{pr.id})"
@@ -1010,12 +1015,11 @@ def register_user_handlers(dp: Dispatcher):
     
     # Модифицируем обработчики состояний для работы с БД
     async def process_login_input_wrapper(msg: types.Message, state: FSMContext):
-        engine = init_db()
-        db_session = get_session(engine)
+        db_session = get_async_session()
         try:
             await process_login_input(msg, state, db_session)
         finally:
-            db_session.close()
+            await db_session.close()
     
     dp.message.register(process_login_input_wrapper, SetLoginState.waiting_for_login)
     
@@ -1027,56 +1031,51 @@ def register_user_handlers(dp: Dispatcher):
     dp.message.register(process_mode_port, AddModeState.waiting_for_port)
     
     async def process_mode_alias_wrapper(msg: types.Message, state: FSMContext):
-        engine = init_db()
-        db_session = get_session(engine)
+        db_session = get_async_session()
         try:
             await process_mode_alias(msg, state, db_session)
         finally:
-            db_session.close()
+            await db_session.close()
     
     dp.message.register(process_mode_alias_wrapper, AddModeState.waiting_for_alias)
     
     async def cmd_modes_wrapper(msg: types.Message):
-        engine = init_db()
-        db_session = get_session(engine)
+        db_session = get_async_session()
         try:
             await cmd_modes(msg, db_session)
         finally:
-            db_session.close()
+            await db_session.close()
     
     dp.message.register(cmd_modes_wrapper, Command("modes"))
     dp.message.register(cmd_modes_wrapper, F.text == "Список ваших пулов")
     
     async def cmd_setmode_wrapper(msg: types.Message, state: FSMContext):
-        engine = init_db()
-        db_session = get_session(engine)
+        db_session = get_async_session()
         try:
             await cmd_setmode(msg, state, db_session)
         finally:
-            db_session.close()
+            await db_session.close()
     
     dp.message.register(cmd_setmode_wrapper, Command("setmode"))
     dp.message.register(cmd_setmode_wrapper, F.text == "Выбор текущего пула")
     dp.message.register(cmd_setmode_wrapper, F.text == "Установить текущий пул")
     
     async def process_mode_selection_wrapper(msg: types.Message, state: FSMContext):
-        engine = init_db()
-        db_session = get_session(engine)
+        db_session = get_async_session()
         try:
             await process_mode_selection(msg, state, db_session)
         finally:
-            db_session.close()
+            await db_session.close()
     
     dp.message.register(process_mode_selection_wrapper, SetModeState.waiting_for_mode)
 
     # Callback для выбора режима из инлайн-клавиатуры
     async def process_mode_callback_wrapper(cb: types.CallbackQuery, state: FSMContext):
-        engine = init_db()
-        db_session = get_session(engine)
+        db_session = get_async_session()
         try:
             await process_mode_callback(cb, state, db_session)
         finally:
-            db_session.close()
+            await db_session.close()
     dp.callback_query.register(process_mode_callback_wrapper, F.data.startswith("set_mode_"))
     
     # Команды для расписаний
@@ -1084,44 +1083,40 @@ def register_user_handlers(dp: Dispatcher):
     dp.message.register(cmd_schedule, F.text == "Управление расписаниями")
     
     async def process_schedule_action_wrapper(msg: types.Message, state: FSMContext):
-        engine = init_db()
-        db_session = get_session(engine)
+        db_session = get_async_session()
         try:
             await process_schedule_action(msg, state, db_session)
         finally:
-            db_session.close()
+            await db_session.close()
     
     dp.message.register(process_schedule_action_wrapper, ScheduleState.waiting_for_action)
     
     async def process_schedule_mode_wrapper(msg: types.Message, state: FSMContext):
-        engine = init_db()
-        db_session = get_session(engine)
+        db_session = get_async_session()
         try:
             await process_schedule_mode(msg, state, db_session)
         finally:
-            db_session.close()
+            await db_session.close()
     
     dp.message.register(process_schedule_mode_wrapper, ScheduleState.waiting_for_mode)
 
     # Callback для выбора режима при создании расписания
     async def process_schedule_mode_callback_wrapper(cb: types.CallbackQuery, state: FSMContext):
-        engine = init_db()
-        db_session = get_session(engine)
+        db_session = get_async_session()
         try:
             await process_schedule_mode_callback(cb, state, db_session)
         finally:
-            db_session.close()
+            await db_session.close()
     dp.callback_query.register(process_schedule_mode_callback_wrapper, F.data.startswith("schedule_mode_"))
     dp.message.register(process_schedule_start_time, ScheduleState.waiting_for_start_time)
     dp.message.register(process_schedule_end_time, ScheduleState.waiting_for_end_time)
     
     async def process_schedule_confirmation_wrapper(msg: types.Message, state: FSMContext):
-        engine = init_db()
-        db_session = get_session(engine)
+        db_session = get_async_session()
         try:
             await process_schedule_confirmation(msg, state, db_session)
         finally:
-            db_session.close()
+            await db_session.close()
     
     dp.message.register(process_schedule_confirmation_wrapper, ScheduleState.waiting_for_confirmation)
 
@@ -1130,31 +1125,28 @@ def register_user_handlers(dp: Dispatcher):
 
     # Обработчики часового пояса
     async def process_timezone_callback_wrapper(cb: types.CallbackQuery, state: FSMContext):
-        engine = init_db()
-        db_session = get_session(engine)
+        db_session = get_async_session()
         try:
             await process_timezone_callback(cb, state, db_session)
         finally:
-            db_session.close()
+            await db_session.close()
     dp.callback_query.register(process_timezone_callback_wrapper, F.data.startswith("set_timezone_"))
 
     async def process_timezone_input_wrapper(msg: types.Message, state: FSMContext):
-        engine = init_db()
-        db_session = get_session(engine)
+        db_session = get_async_session()
         try:
             await process_timezone_input(msg, state, db_session)
         finally:
-            db_session.close()
+            await db_session.close()
     dp.message.register(process_timezone_input_wrapper, TimezoneState.waiting_for_timezone_input)
     
     # Статус и помощь
     async def cmd_status_wrapper(msg: types.Message):
-        engine = init_db()
-        db_session = get_session(engine)
+        db_session = get_async_session()
         try:
             await cmd_status(msg, db_session)
         finally:
-            db_session.close()
+            await db_session.close()
     
     dp.message.register(cmd_status_wrapper, Command("status"))
     dp.message.register(cmd_status_wrapper, F.text == "Статус")
@@ -1174,12 +1166,11 @@ def register_user_handlers(dp: Dispatcher):
     dp.callback_query.register(process_pay_cancel, F.data == "pay_cancel")
 
     async def process_payment_screenshot_wrapper(msg: types.Message, state: FSMContext):
-        engine = init_db()
-        db_session = get_session(engine)
+        db_session = get_async_session()
         try:
             await process_payment_screenshot(msg, state, db_session)
         finally:
-            db_session.close()
+            await db_session.close()
     # принимаем фото и документы в состоянии ожидания скрина/чека
     dp.message.register(process_payment_screenshot_wrapper, PaymentState.waiting_for_screenshot, F.photo)
     dp.message.register(process_payment_screenshot_wrapper, PaymentState.waiting_for_screenshot, F.document)
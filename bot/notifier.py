@@ -0,0 +1,144 @@
+import asyncio
+import logging
+import time
+from typing import Dict, List, Optional, Tuple
+
+from config.settings import (
+    BOT_TOKEN,
+    NOTIFY_QUEUE_SIZE,
+    NOTIFY_COALESCE_WINDOW,
+    NOTIFY_RATE_PER_SEC,
+    NOTIFY_MAX_LINES,
+)
+
+logger = logging.getLogger(__name__)
+
+
+def _plural(n: int, one: str, few: str, many: str) -> str:
+    if n % 10 == 1 and n % 100 != 11:
+        return one
+    if 2 <= n % 10 <= 4 and not 12 <= n % 100 <= 14:
+        return few
+    return many
+
+
+class Notifier:
+    """
+    Долгоживущий сервис уведомлений в Telegram.
+    - Один экземпляр Bot и одна HTTP-сессия на всё время работы.
+    - Ограниченная очередь: при переполнении новые уведомления отбрасываются с предупреждением.
+    - Уведомления одному пользователю в пределах NOTIFY_COALESCE_WINDOW секунд объединяются
+      в одно сообщение («12 устройств стали оффлайн»).
+    - Общий темп отправки не выше NOTIFY_RATE_PER_SEC сообщений в секунду, RetryAfter соблюдается.
+    """
+
+    def __init__(self, bot=None, token: str = BOT_TOKEN):
+        # Если бот передан снаружи, его сессией управляет владелец
+        self._bot = bot
+        self._own_bot = bot is None
+        self._token = token
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=max(1, NOTIFY_QUEUE_SIZE))
+        # tg_id -> (время первого события, строки)
+        self._pending: Dict[int, Tuple[float, List[str]]] = {}
+        self._task: Optional[asyncio.Task] = None
+        self._last_send = 0.0
+        self.dropped = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self._bot is not None or bool(self._token)
+
+    def start(self):
+        if not self.enabled:
+            return
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if self._own_bot and self._bot is not None:
+            try:
+                await self._bot.session.close()
+            except Exception:
+                pass
+            self._bot = None
+
+    def notify_offline(self, tg_id: int, name: str, worker: str):
+        worker_info = f" ({worker})" if worker else ""
+        self._add(tg_id, f"{name}{worker_info}")
+
+    def _add(self, tg_id: int, line: str):
+        if not self.enabled or not tg_id:
+            return
+        entry = self._pending.get(tg_id)
+        if entry is not None:
+            entry[1].append(line)
+            return
+        try:
+            self._queue.put_nowait(tg_id)
+        except asyncio.QueueFull:
+            self.dropped += 1
+            if self.dropped == 1 or self.dropped % 100 == 0:
+                logger.warning(f"Очередь уведомлений переполнена, отброшено: {self.dropped}")
+            return
+        self._pending[tg_id] = (time.monotonic(), [line])
+
+    def _get_bot(self):
+        if self._bot is None:
+            # aiogram загружаем только когда уведомления действительно отправляются
+            from aiogram import Bot
+            from aiogram.enums import ParseMode
+            self._bot = Bot(token=self._token, parse_mode=ParseMode.HTML)
+        return self._bot
+
+    @staticmethod
+    def _format(lines: List[str]) -> str:
+        if len(lines) == 1:
+            return f"❗️ {lines[0]} стал оффлайн."
+        n = len(lines)
+        shown = lines[:NOTIFY_MAX_LINES]
+        text = f"❗️ {n} {_plural(n, 'устройство стало', 'устройства стали', 'устройств стали')} оффлайн:\n"
+        text += "\n".join(f"• {line}" for line in shown)
+        if n > len(shown):
+            text += f"\n…и ещё {n - len(shown)}"
+        return text
+
+    async def _run(self):
+        min_interval = 1.0 / max(0.1, NOTIFY_RATE_PER_SEC)
+        while True:
+            try:
+                tg_id = await self._queue.get()
+                first_at, _ = self._pending.get(tg_id, (time.monotonic(), []))
+                # Ждём окончания окна объединения для этого пользователя
+                delay = first_at + NOTIFY_COALESCE_WINDOW - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                _, lines = self._pending.pop(tg_id, (0.0, []))
+                if not lines:
+                    continue
+                text = self._format(lines)
+                for attempt in range(2):
+                    wait = self._last_send + min_interval - time.monotonic()
+                    if wait > 0:
+                        await asyncio.sleep(wait)
+                    self._last_send = time.monotonic()
+                    try:
+                        await self._get_bot().send_message(chat_id=tg_id, text=text)
+                        break
+                    except Exception as e:
+                        # TelegramRetryAfter: соблюдаем паузу и пробуем ещё раз
+                        retry_after = getattr(e, "retry_after", None)
+                        if retry_after is None or attempt:
+                            raise
+                        logger.warning(f"Telegram просит подождать {retry_after} с перед отправкой")
+                        await asyncio.sleep(retry_after)
+            except asyncio.CancelledError:
+                break
+            except Exception as e:
+                logger.warning(f"Ошибка отправки уведомления об оффлайне: {e}")
+
+
+__all__ = ["Notifier"]
@@ -1,31 +1,145 @@
 import asyncio
+import heapq
+import itertools
 import logging
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+from typing import Dict, Iterable, List, Optional, Set, Tuple
 from zoneinfo import ZoneInfo
-from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+import aiohttp
 
-from db.models import User, Mode, Schedule, get_session, init_db
-from proxy.utils import is_time_in_range
+from sqlalchemy import select
+
+from config.settings import (
+    SCHEDULER_RESYNC_INTERVAL,
+    SCHEDULE_PREWARM_LEAD,
+    PROXY_API_HOST,
+    PROXY_API_PORT,
+    PROXY_API_TOKEN,
+)
+from db.models import User, Mode, Schedule, get_engine
+from db.aio import get_async_session, set_active_mode
+from db.changes import ModeChangeListener, decode_ports, publish_port_change_async
+from proxy.utils import is_time_in_range, range_boundaries
 
 logger = logging.getLogger(__name__)
 
+DEFAULT_TIMEZONE = "Europe/Moscow"
+
+
+@lru_cache(maxsize=None)
+def get_zone(name: Optional[str]) -> ZoneInfo:
+    """Объект часового пояса (кешируется). Неизвестный пояс заменяется на DEFAULT_TIMEZONE."""
+    try:
+        return ZoneInfo(name or DEFAULT_TIMEZONE)
+    except Exception:
+        logger.warning(f"Неизвестный часовой пояс '{name}', использую {DEFAULT_TIMEZONE}")
+        return ZoneInfo(DEFAULT_TIMEZONE)
+
+
+def local_to_utc(local: datetime, tz: ZoneInfo) -> datetime:
+    """
+    Переводит локальное время (без tzinfo) в момент UTC.
+    Неоднозначное время (перевод часов назад) — первое наступление; несуществующее
+    (перевод вперёд) — момент перевода, когда часы перескакивают через него.
+    """
+    utc = local.replace(tzinfo=tz).astimezone(timezone.utc)
+    if utc.astimezone(tz).replace(tzinfo=None) == local:
+        return utc
+    lo = local.replace(tzinfo=tz, fold=1).astimezone(timezone.utc)
+    lo, hi = min(lo, utc), max(lo, utc)
+    # Ищем первый момент, когда часы показывают не меньше local
+    while hi - lo > timedelta(seconds=1):
+        mid = lo + (hi - lo) / 2
+        if mid.astimezone(tz).replace(tzinfo=None) >= local:
+            hi = mid
+        else:
+            lo = mid
+    return hi
+
+
+class _UserPlan:
+    """Скомпилированные расписания пользователя: окна в порядке создания и минуты-границы."""
+
+    __slots__ = ("user_id", "port", "tz_name", "tz", "windows", "boundaries", "version")
+
+    def __init__(self, user_id: int, port: int, tz_name: Optional[str], windows: Tuple[tuple, ...], version: int):
+        self.user_id = user_id
+        self.port = port
+        self.tz_name = tz_name
+        self.tz = get_zone(tz_name)
+        # (start_time, end_time, mode_id)
+        self.windows = windows
+        self.boundaries = sorted({m for start, end, _ in windows for m in range_boundaries(start, end)})
+        self.version = version
+
+    def same_rules(self, other: "_UserPlan") -> bool:
+        return self.tz_name == other.tz_name and self.windows == other.windows
+
+    def desired_mode(self, now: datetime) -> Optional[int]:
+        """Режим по расписанию на момент now; при пересечении окон побеждает последнее. None — окна нет."""
+        current = now.astimezone(self.tz).strftime("%H:%M")
+        mode_id = None
+        for start, end, window_mode in self.windows:
+            if is_time_in_range(current, start, end):
+                mode_id = window_mode
+        return mode_id
+
+    def next_transition(self, now: datetime) -> Optional[datetime]:
+        """Ближайший момент UTC после now, в который может смениться режим по расписанию."""
+        if not self.boundaries:
+            return None
+        day = now.astimezone(self.tz).replace(hour=0, minute=0, second=0, microsecond=0, tzinfo=None)
+        for _ in range(3):
+            for minute in self.boundaries:
+                at = local_to_utc(day + timedelta(minutes=minute), self.tz)
+                if at > now:
+                    return at
+            day += timedelta(days=1)
+        return None
+
+
+def _utcnow() -> datetime:
+    return datetime.now(timezone.utc)
+
+
 class Scheduler:
     def __init__(self, proxy_server, check_interval=60, bot=None):
         """
         Инициализация планировщика
         
         :param proxy_server: Экземпляр прокси-сервера для обновления режимов
-        :param check_interval: Интервал проверки расписаний в секундах
+        :param check_interval: Интервал проверки напоминаний о подписке в секундах
         :param bot: Экземпляр Telegram-бота для уведомлений (опционально)
+
+        Расписания не опрашиваются: для каждого пользователя вычисляется ближайший момент
+        переключения (UTC, с учётом перехода на летнее время), моменты хранятся в куче, и
+        планировщик спит ровно до ближайшего. План пользователя пересобирается по уведомлению
+        об изменении его порта (расписания, часовой пояс), а раз в SCHEDULER_RESYNC_INTERVAL
+        секунд — для всех. За SCHEDULE_PREWARM_LEAD секунд до переключения прокси получает
+        предстоящий пул порта, чтобы заранее открыть к нему соединения.
         """
         self.proxy_server = proxy_server
         self.check_interval = check_interval
         self.bot = bot
         self.running = False
         self.task = None
+        self._reminder_task = None
         # Защита от повторных уведомлений в течение одного дня
         # Формат: {user_id: {date: set(days_left)}}
         self._notified_today = {}
+        # user_id -> план; порт -> user_id
+        self._plans: Dict[int, _UserPlan] = {}
+        self._port_users: Dict[int, int] = {}
+        # (момент UTC, user_id, версия плана); записи устаревших версий пропускаются
+        self._heap: List[Tuple[datetime, int, int]] = []
+        # (момент прогрева UTC, момент переключения UTC, user_id, версия плана)
+        self._prewarm_heap: List[Tuple[datetime, datetime, int, int]] = []
+        self._versions = itertools.count()
+        self._dirty_ports: Set[int] = set()
+        self._dirty_all = True
+        self._wakeup = asyncio.Event()
+        self._change_listener: Optional[ModeChangeListener] = None
         
     async def start(self):
         """Запуск планировщика"""
@@ -33,7 +147,16 @@ class Scheduler:
             return
             
         self.running = True
+        self._dirty_all = True
+        try:
+            # Без PostgreSQL слушаем только внутрипроцессные уведомления: UDP-сокет принадлежит прокси
+            self._change_listener = ModeChangeListener(get_engine(), self._on_change, udp=False)
+            await self._change_listener.start()
+        except Exception as e:
+            logger.warning(f"Не удалось подписаться на изменения расписаний: {e}")
+            self._change_listener = None
         self.task = asyncio.create_task(self._scheduler_loop())
+        self._reminder_task = asyncio.create_task(self._reminder_loop())
         logger.info("Планировщик запущен")
         
     async def stop(self):
@@ -42,88 +165,274 @@ class Scheduler:
             return
             
         self.running = False
-        if self.task:
-            self.task.cancel()
+        for task in (self.task, self._reminder_task):
+            if task:
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        self.task = None
+        self._reminder_task = None
+        if self._change_listener:
             try:
-                await self.task
-            except asyncio.CancelledError:
+                await self._change_listener.stop()
+            except Exception:
                 pass
-            self.task = None
+            self._change_listener = None
         logger.info("Планировщик остановлен")
+
+    def _on_change(self, payload: str):
+        """Колбэк канала уведомлений: помечает порты, чьи планы нужно пересобрать."""
+        ports = decode_ports(payload)
+        if ports is None:
+            self._dirty_all = True
+        else:
+            self._dirty_ports |= ports
+        self._wakeup.set()
         
     async def _scheduler_loop(self):
-        """Основной цикл планировщика"""
+        """Основной цикл планировщика: спит до ближайшего переключения или уведомления"""
+        loop = asyncio.get_running_loop()
+        next_resync = loop.time()
         while self.running:
             try:
+                if self._dirty_all or loop.time() >= next_resync:
+                    self._dirty_all = False
+                    self._dirty_ports.clear()
+                    next_resync = loop.time() + SCHEDULER_RESYNC_INTERVAL if SCHEDULER_RESYNC_INTERVAL > 0 else float("inf")
+                    await self._rebuild(None)
+                elif self._dirty_ports:
+                    ports, self._dirty_ports = self._dirty_ports, set()
+                    await self._rebuild(ports)
                 await self._check_schedules()
-                await self._check_subscription_reminders()
+                await self._check_prewarm()
             except Exception as e:
                 logger.error(f"Ошибка при проверке расписаний: {e}")
-                
+                # Пересоберём всё заново после паузы
+                self._dirty_all = True
+                await asyncio.sleep(5)
+                continue
+            if self._dirty_all or self._dirty_ports:
+                continue
+            timeout = next_resync - loop.time()
+            for heap in (self._heap, self._prewarm_heap):
+                if heap:
+                    timeout = min(timeout, (heap[0][0] - _utcnow()).total_seconds())
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), max(0.0, timeout) if timeout != float("inf") else None)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _reminder_loop(self):
+        """Периодическая проверка напоминаний о подписке"""
+        while self.running:
+            try:
+                await self._check_subscription_reminders()
+            except Exception as e:
+                logger.error(f"Ошибка при проверке напоминаний о подписке: {e}")
             await asyncio.sleep(self.check_interval)
+
+    def _push(self, plan: _UserPlan, now: datetime):
+        at = plan.next_transition(now)
+        if at is None:
+            return
+        heapq.heappush(self._heap, (at, plan.user_id, plan.version))
+        if SCHEDULE_PREWARM_LEAD > 0:
+            heapq.heappush(self._prewarm_heap, (at - timedelta(seconds=SCHEDULE_PREWARM_LEAD), at, plan.user_id, plan.version))
+
+    async def _rebuild(self, ports: Optional[Iterable[int]]):
+        """
+        Перечитывает расписания и часовые пояса (всех пользователей или указанных портов).
+        Планы с неизменившимися правилами сохраняются; для новых и изменившихся режим
+        по расписанию применяется сразу. Полная пересборка применяет режим по расписанию всем
+        пользователям: так исправляются ручные смены режима внутри окна и повторяются
+        переключения, не применённые из-за ошибки.
+        """
+        db_session = get_async_session()
+        try:
+            q = select(User.id, User.port, User.timezone)
+            if ports is not None:
+                q = q.where(User.port.in_(list(ports)))
+            users = (await db_session.execute(q)).all()
+            windows: Dict[int, List[tuple]] = {}
+            if users:
+                sq = select(Schedule.user_id, Schedule.start_time, Schedule.end_time, Schedule.mode_id).order_by(Schedule.id)
+                if ports is not None:
+                    sq = sq.where(Schedule.user_id.in_([u.id for u in users]))
+                for row in (await db_session.execute(sq)).all():
+                    windows.setdefault(row.user_id, []).append((row.start_time, row.end_time, row.mode_id))
+        finally:
+            await db_session.close()
+
+        now = _utcnow()
+        found = {u.id for u in users}
+        if ports is None:
+            stale = set(self._plans) - found
+        else:
+            stale = {self._port_users[p] for p in ports if p in self._port_users} - found
+        for user_id in stale:
+            plan = self._plans.pop(user_id)
+            if self._port_users.get(plan.port) == user_id:
+                del self._port_users[plan.port]
+
+        changed: Set[int] = set()
+        for u in users:
+            plan = _UserPlan(u.id, u.port, u.timezone, tuple(windows.get(u.id, ())), next(self._versions))
+            old = self._plans.get(u.id)
+            if old is not None and old.port != u.port and self._port_users.get(old.port) == u.id:
+                del self._port_users[old.port]
+            self._port_users[u.port] = u.id
+            if old is not None and old.same_rules(plan):
+                old.port = u.port
+                continue
+            self._plans[u.id] = plan
+            self._push(plan, now)
+            if plan.windows:
+                changed.add(u.id)
+
+        if ports is None:
+            # Полная пересборка заодно очищает кучи от устаревших записей
+            self._heap = [entry for entry in self._heap if self._is_current(entry[1], entry[2])]
+            heapq.heapify(self._heap)
+            self._prewarm_heap = [entry for entry in self._prewarm_heap if self._is_current(entry[2], entry[3])]
+            heapq.heapify(self._prewarm_heap)
+            logger.debug(f"Расписания перечитаны: пользователей с расписаниями {sum(1 for p in self._plans.values() if p.windows)}, "
+                         f"таймеров {len(self._heap)}")
+        if ports is None:
+            changed = {user_id for user_id, plan in self._plans.items() if plan.windows}
+        if changed:
+            await self._apply(changed, now)
             
+    def _is_current(self, user_id: int, version: int) -> bool:
+        plan = self._plans.get(user_id)
+        return plan is not None and plan.version == version
+
+    async def _check_prewarm(self):
+        """Передаёт прокси переключения, до которых осталось не больше SCHEDULE_PREWARM_LEAD секунд"""
+        now = _utcnow()
+        upcoming: List[Tuple[int, int, datetime]] = []
+        while self._prewarm_heap and self._prewarm_heap[0][0] <= now:
+            _, at, user_id, version = heapq.heappop(self._prewarm_heap)
+            if at <= now or not self._is_current(user_id, version):
+                continue
+            plan = self._plans[user_id]
+            mode_id = plan.desired_mode(at)
+            if mode_id is None or mode_id == plan.desired_mode(now):
+                continue
+            upcoming.append((plan.port, mode_id, at))
+        if not upcoming:
+            return
+        db_session = get_async_session()
+        try:
+            modes = {row.id: row for row in (await db_session.execute(
+                select(Mode.id, Mode.host, Mode.port).where(Mode.id.in_({mode_id for _, mode_id, _ in upcoming}))
+            )).all()}
+        finally:
+            await db_session.close()
+        transitions = []
+        for port, mode_id, at in upcoming:
+            mode = modes.get(mode_id)
+            # Режим сна не требует подключений к пулу
+            if mode is None or not mode.host or mode.host == "sleep" or not mode.port:
+                continue
+            transitions.append({"port": port, "host": mode.host, "pool_port": int(mode.port), "at": at.timestamp()})
+        if not transitions:
+            return
+        try:
+            if self.proxy_server is not None:
+                await self.proxy_server.prewarm_transitions(transitions)
+            else:
+                await self._post_proxy_api("/prewarm", {"transitions": transitions})
+            logger.debug(f"Прокси передано предстоящих переключений: {len(transitions)}")
+        except Exception as e:
+            logger.debug(f"Не удалось передать прокси предстоящие переключения: {e}")
+
+    async def _post_proxy_api(self, path: str, payload: dict):
+        """Запрос к HTTP API прокси, работающего в другом процессе"""
+        url = f"http://{PROXY_API_HOST}:{PROXY_API_PORT}{path}"
+        headers = {"X-Proxy-Token": PROXY_API_TOKEN} if PROXY_API_TOKEN else {}
+        async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=5)) as session:
+            async with session.post(url, json=payload, headers=headers) as resp:
+                if resp.status >= 400:
+                    raise RuntimeError(f"proxy api error {resp.status}: {await resp.text()}")
+
     async def _check_schedules(self):
-        """Проверка расписаний и обновление активных режимов"""
-        logger.debug("Проверка расписаний...")
+        """Применяет переключения, момент которых наступил"""
+        now = _utcnow()
+        due: Set[int] = set()
+        while self._heap and self._heap[0][0] <= now:
+            _, user_id, version = heapq.heappop(self._heap)
+            plan = self._plans.get(user_id)
+            if plan is not None and plan.version == version:
+                due.add(user_id)
+        if not due:
+            return
+        # Следующий момент ставится и при ошибке: цикл после неё делает полную пересборку,
+        # которая повторяет переключение (_rebuild применяет режим по расписанию всем)
+        try:
+            await self._apply(due, now)
+        finally:
+            for user_id in due:
+                self._push(self._plans[user_id], now)
+
+    async def _apply(self, user_ids: Iterable[int], now: datetime):
+        """Активирует режимы по расписанию тем пользователям, у которых активен другой режим"""
+        wanted: Dict[int, int] = {}
+        for user_id in user_ids:
+            mode_id = self._plans[user_id].desired_mode(now)
+            if mode_id is not None:
+                wanted[user_id] = mode_id
+        if not wanted:
+            return
         changed_ports = set()
         
-        # Текущее время вычисляется для каждого пользователя в его часовом поясе
-        
-        # Создаем engine и сессию БД
-        engine = init_db()
-        db_session = get_session(engine)
+        # Асинхронная сессия БД: запросы не блокируют цикл событий
+        db_session = get_async_session()
         try:
-            # Получаем всех пользователей
-            users = db_session.query(User).all()
-            
-            for user in users:
-                # Получаем все расписания пользователя
-                schedules = db_session.query(Schedule).filter(Schedule.user_id == user.id).all()
-                
-                # Проверяем каждое расписание
-                for schedule in schedules:
-                    # Определяем локальное время пользователя
-                    tz_name = user.timezone or "Europe/Moscow"
-                    current_time = datetime.now(ZoneInfo(tz_name)).strftime("%H:%M")
-                    # Проверяем, находится ли текущее время в диапазоне расписания (строки HH:MM)
-                    if is_time_in_range(current_time, schedule.start_time, schedule.end_time):
-                        # Текущий активный режим пользователя
-                        active_mode = db_session.query(Mode).filter(Mode.user_id == user.id, Mode.is_active == 1).first()
-                        # Если текущий активный режим не соответствует расписанию
-                        if not active_mode or active_mode.id != schedule.mode_id:
-                            logger.info(f"Обновление режима для пользователя {user.username} (ID: {user.id}) "
-                                       f"согласно расписанию. Новый режим ID: {schedule.mode_id}")
-
-                            # Снимаем активность у предыдущего режима и активируем режим из расписания
-                            db_session.query(Mode).filter(Mode.user_id == user.id, Mode.is_active == 1).update({Mode.is_active: 0})
-                            mode_to_activate = db_session.query(Mode).filter(Mode.id == schedule.mode_id, Mode.user_id == user.id).first()
-                            if mode_to_activate:
-                                mode_to_activate.is_active = 1
-                                db_session.commit()
-                                # Запомним порт пользователя, которому нужна перезагрузка
-                                changed_ports.add(user.port)
-            # Точечная перезагрузка портов, где были изменения
-            if self.proxy_server and changed_ports:
-                for port in changed_ports:
-                    await self.proxy_server.reload_port(port)
+            rows = (await db_session.execute(
+                select(User.id, User.port, User.username, User.active_mode_id).where(User.id.in_(list(wanted)))
+            )).all()
+            pending = [row for row in rows if row.active_mode_id != wanted[row.id]]
+            if not pending:
+                return
+            # Режим из расписания должен принадлежать пользователю
+            owned = set((await db_session.execute(
+                select(Mode.id, Mode.user_id).where(Mode.id.in_({wanted[row.id] for row in pending}))
+            )).all())
+            for row in pending:
+                mode_id = wanted[row.id]
+                if (mode_id, row.id) not in owned:
+                    continue
+                logger.info(f"Обновление режима для пользователя {row.username} (ID: {row.id}) "
+                            f"согласно расписанию. Новый режим ID: {mode_id}")
+                await set_active_mode(db_session, row.id, mode_id)
+                # Запомним порт пользователя, которому нужна перезагрузка
+                changed_ports.add(row.port)
+            await db_session.commit()
+            # Прокси (в этом или другом процессе) получает изменения через канал уведомлений
+            # и переключает порты через очередь с ограничением темпа (SWITCH_RATE)
+            if changed_ports:
+                await publish_port_change_async(db_session, *changed_ports)
         
         finally:
-            db_session.close()
+            await db_session.close()
 
     async def _check_subscription_reminders(self):
         """Отправка уведомлений пользователям за 3, 2 и 1 день до окончания подписки"""
         if self.bot is None:
             return
+        # aiogram нужен только при запущенном боте: в режиме --proxy-only он не загружается
+        from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
         logger.debug("Проверка напоминаний о подписке...")
 
-        engine = init_db()
-        db_session = get_session(engine)
+        db_session = get_async_session()
         try:
-            users = db_session.query(User).all()
+            users = (await db_session.scalars(select(User))).all()
             for user in users:
                 # Дата в часовом поясе пользователя
-                tz_name = user.timezone or "Europe/Moscow"
-                today_user = datetime.now(ZoneInfo(tz_name)).date()
+                today_user = datetime.now(get_zone(user.timezone)).date()
                 expiry_date = user.subscription_until.date()
 
                 days_left = (expiry_date - today_user).days
@@ -153,4 +462,4 @@ class Scheduler:
                     except Exception as e:
                         logger.error(f"Ошибка отправки напоминания пользователю {user.username} (ID: {user.id}): {e}")
         finally:
-            db_session.close()
\ No newline at end of file
+            await db_session.close()
\ No newline at end of file
@@ -16,7 +16,7 @@ TELEGRAM_TOKEN = BOT_TOKEN  # сохранение совместимости с
 # Настройки прокси
 DEFAULT_PORT_RANGE = (4000, 4200)  # Диапазон портов для пользователей
 PROXY_HOST = '0.0.0.0'  # Хост для прослушивания
-SCHEDULER_CHECK_INTERVAL = 60  # Интервал проверки расписаний в секундах
+SCHEDULER_CHECK_INTERVAL = 60  # Интервал проверки напоминаний о подписке в секундах
 
 # Настройки логирования
 LOG_DIR = BASE_DIR / 'logs'
@@ -48,4 +48,101 @@ PROXY_API_TOKEN = os.getenv('PROXY_API_TOKEN', '')
 # Приложение HTTP API
 APP_API_HOST = os.getenv('APP_API_HOST', '0.0.0.0')
 APP_API_PORT = int(os.getenv('APP_API_PORT', '8000'))
-APP_API_TOKEN = os.getenv('APP_API_TOKEN', '')
\ No newline at end of file
+APP_API_TOKEN = os.getenv('APP_API_TOKEN', '')
+
+# Канал уведомлений об изменениях режимов (PostgreSQL LISTEN/NOTIFY, для SQLite — локальный UDP)
+MODE_CHANGES_CHANNEL = os.getenv('MODE_CHANGES_CHANNEL', 'proxy_mode_changed')
+MODE_CHANGES_UDP_HOST = os.getenv('MODE_CHANGES_UDP_HOST', '127.0.0.1')
+MODE_CHANGES_UDP_PORT = int(os.getenv('MODE_CHANGES_UDP_PORT', '8079'))
+# Интервал полной пересинхронизации режимов с БД (страховка на случай потерянных уведомлений), 0 — отключить
+MODE_RESYNC_INTERVAL = int(os.getenv('MODE_RESYNC_INTERVAL', '300'))
+# Планировщик расписаний спит до ближайшего переключения; раз в столько секунд он полностью
+# перечитывает расписания из БД (страховка на случай потерянных уведомлений), 0 — отключить
+SCHEDULER_RESYNC_INTERVAL = int(os.getenv('SCHEDULER_RESYNC_INTERVAL', '600'))
+
+# Горячее переключение режима на порту: migrate — перенос сессий на новый пул,
+# drain — сессии остаются на старом пуле и закрываются постепенно, restart — перезапуск порта
+MODE_SWITCH_STRATEGY = os.getenv('MODE_SWITCH_STRATEGY', 'migrate')
+# Окно (сек), в течение которого закрываются непереносимые сессии после переключения
+MODE_SWITCH_DRAIN_TIMEOUT = int(os.getenv('MODE_SWITCH_DRAIN_TIMEOUT', '60'))
+# Сколько сессий порта переносится на новый пул одновременно
+MODE_SWITCH_CONCURRENCY = int(os.getenv('MODE_SWITCH_CONCURRENCY', '50'))
+# Сколько портов перезагружается, запускается или останавливается одновременно при массовых операциях
+PORT_RELOAD_CONCURRENCY = int(os.getenv('PORT_RELOAD_CONCURRENCY', '20'))
+# Окно (мс), в котором запросы перезагрузки одного порта и уведомления об изменениях объединяются
+# в одну обработку; порт с неизменившейся конфигурацией не перезагружается
+RELOAD_DEBOUNCE_MS = int(os.getenv('RELOAD_DEBOUNCE_MS', '250'))
+# Волны переключений по расписанию: не более SWITCH_RATE портов в секунду на процесс (0 — без ограничения),
+# не более SWITCH_POOL_CONCURRENCY одновременных переключений на один пул назначения (0 — без ограничения)
+# и случайная задержка до SWITCH_JITTER секунд перед переключением порта
+SWITCH_RATE = float(os.getenv('SWITCH_RATE', '20'))
+SWITCH_POOL_CONCURRENCY = int(os.getenv('SWITCH_POOL_CONCURRENCY', '10'))
+SWITCH_JITTER = float(os.getenv('SWITCH_JITTER', '0'))
+# Прогрев перед переключением по расписанию: за сколько секунд до переключения открывать
+# соединения к новому пулу (0 — отключить; должно быть меньше UPSTREAM_WARM_MAX_AGE)
+# и сколько тёплых сокетов максимум открывать к одному пулу
+SCHEDULE_PREWARM_LEAD = float(os.getenv('SCHEDULE_PREWARM_LEAD', '10'))
+SCHEDULE_PREWARM_MAX_SOCKETS = int(os.getenv('SCHEDULE_PREWARM_MAX_SOCKETS', '32'))
+# Таймаут подключения и рукопожатия с пулом (сек)
+UPSTREAM_CONNECT_TIMEOUT = float(os.getenv('UPSTREAM_CONNECT_TIMEOUT', '10'))
+
+# Подключения к пулам: кеш DNS (сек), число «тёплых» заранее открытых сокетов на пул,
+# их максимальный возраст (сек) и лимит одновременных подключений к одному пулу
+UPSTREAM_DNS_TTL = int(os.getenv('UPSTREAM_DNS_TTL', '300'))
+UPSTREAM_WARM_POOL_SIZE = int(os.getenv('UPSTREAM_WARM_POOL_SIZE', '2'))
+UPSTREAM_WARM_MAX_AGE = float(os.getenv('UPSTREAM_WARM_MAX_AGE', '30'))
+UPSTREAM_CONNECT_CONCURRENCY = int(os.getenv('UPSTREAM_CONNECT_CONCURRENCY', '32'))
+
+# Режим агрегации: майнеры порта разделяют общие upstream-сессии к пулу (деление extranonce2)
+AGGREGATION_ENABLED = os.getenv('AGGREGATION_ENABLED', '0').lower() in ('1', 'true', 'yes')
+# Сколько байт extranonce2 пула отдаётся под номер майнера (1 байт — до 256 майнеров на сессию)
+AGGREGATION_EXTRANONCE_BYTES = int(os.getenv('AGGREGATION_EXTRANONCE_BYTES', '1'))
+# Максимум майнеров на одну общую сессию
+AGGREGATION_MAX_MINERS = int(os.getenv('AGGREGATION_MAX_MINERS', '256'))
+# Через сколько секунд закрывать общую сессию без майнеров
+AGGREGATION_IDLE_TIMEOUT = float(os.getenv('AGGREGATION_IDLE_TIMEOUT', '60'))
+# Предел неотправленных данных майнеру (байт), после которого медленный майнер отключается
+AGGREGATION_MAX_MINER_BUFFER = int(os.getenv('AGGREGATION_MAX_MINER_BUFFER', str(1024 * 1024)))
+
+# Парковка майнеров портов в режиме сна: соединение не закрывается, а ждёт пробуждения режима.
+# Максимум припаркованных соединений на процесс (0 — не парковать, закрывать соединения как раньше)
+SLEEP_PARK_MAX_SESSIONS = int(os.getenv('SLEEP_PARK_MAX_SESSIONS', '10000'))
+
+# Общий порт для всех пользователей (только в однопроцессном режиме): пользователь определяется
+# по логину майнера User.login[.worker] из первого mining.authorize; персональные порты продолжают работать
+PROXY_SHARED_PORT = int(os.getenv('PROXY_SHARED_PORT', '0'))  # 0 — отключён
+# Сколько секунд ждать mining.authorize от нового подключения к общему порту
+PROXY_SHARED_AUTH_TIMEOUT = float(os.getenv('PROXY_SHARED_AUTH_TIMEOUT', '30'))
+
+# Снимок конфигурации портов на диске: прокси открывает порты из него, не дожидаясь БД, и сверяется
+# с БД, когда она доступна. Путь к файлу ('' — отключить; процессы многопроцессного режима добавляют .<номер>)
+PROXY_SNAPSHOT_PATH = os.getenv('PROXY_SNAPSHOT_PATH', str(BASE_DIR / 'proxy_snapshot.json'))
+# Задержка записи снимка после изменений конфигурации (сек)
+PROXY_SNAPSHOT_SAVE_DELAY = float(os.getenv('PROXY_SNAPSHOT_SAVE_DELAY', '1'))
+
+# Движок пересылки строк между майнером и пулом: streams — StreamReader/StreamWriter и задача
+# на каждое направление; protocol — колбэки asyncio.BufferedProtocol без задач и drain() на строку
+PROXY_RELAY_ENGINE = os.getenv('PROXY_RELAY_ENGINE', 'streams').strip().lower()
+# Предельный размер буфера чтения сокета в режиме protocol (байт): строка длиннее закрывает соединение
+PROXY_RELAY_BUFFER = int(os.getenv('PROXY_RELAY_BUFFER', '65536'))
+
+# Фоновая запись состояния устройств: период сброса (мс) и число событий для досрочного сброса
+DEVICE_FLUSH_INTERVAL_MS = int(os.getenv('DEVICE_FLUSH_INTERVAL_MS', '500'))
+DEVICE_FLUSH_MAX_EVENTS = int(os.getenv('DEVICE_FLUSH_MAX_EVENTS', '500'))
+
+# Уведомления в Telegram: размер очереди, окно объединения уведомлений одному пользователю (сек),
+# общий темп отправки (сообщений/сек) и сколько устройств перечислять в одном сообщении
+NOTIFY_QUEUE_SIZE = int(os.getenv('NOTIFY_QUEUE_SIZE', '1000'))
+NOTIFY_COALESCE_WINDOW = float(os.getenv('NOTIFY_COALESCE_WINDOW', '5'))
+NOTIFY_RATE_PER_SEC = float(os.getenv('NOTIFY_RATE_PER_SEC', '20'))
+NOTIFY_MAX_LINES = int(os.getenv('NOTIFY_MAX_LINES', '20'))
+
+# Многопроцессный режим (--workers N): порты пользователей делятся между процессами по стабильному хешу.
+# HTTP API процесса i слушает PROXY_API_HOST:PROXY_WORKER_API_BASE_PORT+i, UDP-уведомления — MODE_CHANGES_UDP_PORT+1+i
+PROXY_WORKERS = int(os.getenv('PROXY_WORKERS', '1'))
+PROXY_WORKER_API_BASE_PORT = int(os.getenv('PROXY_WORKER_API_BASE_PORT', '8090'))
+# Пауза перед перезапуском упавшего процесса (сек), удваивается при частых падениях до максимума
+PROXY_WORKER_RESTART_DELAY = float(os.getenv('PROXY_WORKER_RESTART_DELAY', '1'))
+PROXY_WORKER_RESTART_MAX_DELAY = float(os.getenv('PROXY_WORKER_RESTART_MAX_DELAY', '30'))
+# Нагруженные порты, которые слушают все процессы сразу через SO_REUSEPORT (через запятую, только Linux/BSD)
+PROXY_REUSEPORT_PORTS = {int(p) for p in os.getenv('PROXY_REUSEPORT_PORTS', '').split(',') if p.strip()}
@@ -0,0 +1,104 @@
+"""
+Асинхронный доступ к БД (SQLAlchemy asyncio).
+
+Движок строится по URL общего синхронного движка (get_engine): postgresql -> asyncpg,
+sqlite -> aiosqlite. Если синхронная инициализация откатилась на локальную SQLite,
+асинхронный движок использует ту же базу. Схема создаётся один раз в init_db().
+
+Сессии создаются с expire_on_commit=False: после commit объекты остаются доступными
+без повторной (неявной) загрузки, которая в AsyncSession недопустима.
+"""
+import threading
+from typing import Optional
+
+from sqlalchemy.engine import make_url, URL
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, async_sessionmaker, create_async_engine
+
+from db.models import get_engine, activate_mode_statements
+
+_async_engine: Optional[AsyncEngine] = None
+_async_session_factory: Optional[async_sessionmaker] = None
+_lock = threading.Lock()
+
+_ASYNC_DRIVERS = {
+    "postgresql": "postgresql+asyncpg",
+    "sqlite": "sqlite+aiosqlite",
+}
+
+
+def async_url(url) -> URL:
+    """Подменяет синхронный драйвер в URL на асинхронный (asyncpg / aiosqlite)."""
+    url = make_url(url)
+    backend = url.get_backend_name()
+    driver = _ASYNC_DRIVERS.get(backend)
+    if driver is None:
+        raise ValueError(f"Нет асинхронного драйвера для БД '{backend}'")
+    return url.set(drivername=driver)
+
+
+def create_async_db_engine(url) -> AsyncEngine:
+    url = async_url(url)
+    if url.get_backend_name() == "sqlite":
+        return create_async_engine(url)
+    try:
+        from config.settings import (
+            DB_POOL_SIZE,
+            DB_MAX_OVERFLOW,
+            DB_POOL_TIMEOUT,
+            DB_POOL_RECYCLE,
+            DB_POOL_PRE_PING,
+        )
+    except Exception:
+        DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_TIMEOUT, DB_POOL_RECYCLE, DB_POOL_PRE_PING = 200, 400, 60, 1800, True
+    return create_async_engine(
+        url,
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_timeout=DB_POOL_TIMEOUT,
+        pool_pre_ping=DB_POOL_PRE_PING,
+        pool_recycle=DB_POOL_RECYCLE,
+    )
+
+
+def get_async_engine() -> AsyncEngine:
+    """Общий асинхронный движок процесса (создаётся при первом обращении)."""
+    global _async_engine, _async_session_factory
+    if _async_engine is None:
+        with _lock:
+            if _async_engine is None:
+                engine = create_async_db_engine(get_engine().url)
+                _async_session_factory = async_sessionmaker(engine, expire_on_commit=False)
+                _async_engine = engine
+    return _async_engine
+
+
+def get_async_session() -> AsyncSession:
+    """Новая асинхронная сессия на общем движке. Закрывать через await session.close() или async with."""
+    get_async_engine()
+    return _async_session_factory()
+
+
+async def dispose_async_engine():
+    """Закрывает соединения асинхронного движка (при остановке приложения)."""
+    global _async_engine, _async_session_factory
+    engine = _async_engine
+    _async_engine = None
+    _async_session_factory = None
+    if engine is not None:
+        await engine.dispose()
+
+
+async def set_active_mode(session: AsyncSession, user_id: int, mode_id: int):
+    """Делает режим активным для пользователя (без commit — в транзакции вызывающего)."""
+    for stmt in activate_mode_statements(user_id, mode_id):
+        await session.execute(stmt)
+
+
+__all__ = [
+    "async_url",
+    "create_async_db_engine",
+    "get_async_engine",
+    "get_async_session",
+    "dispose_async_engine",
+    "set_active_mode",
+]
@@ -0,0 +1,252 @@
+"""
+Канал уведомлений об изменении конфигурации портов (активный режим, логин, порт).
+
+- PostgreSQL: LISTEN/NOTIFY на канале MODE_CHANGES_CHANNEL. Уведомление отправляется
+  после commit изменения, отдельной транзакцией (pg_notify + commit в publish_port_change*).
+  Если процесс упадёт между этими двумя commit, уведомление потеряется — такое изменение
+  прокси подхватит только при периодической пересинхронизации (MODE_RESYNC_INTERVAL).
+- SQLite и прочие БД: внутрипроцессные подписчики (бот, планировщик и прокси в одном процессе)
+  и UDP-датаграмма на локальный сокет MODE_CHANGES_UDP_HOST:MODE_CHANGES_UDP_PORT, если этот
+  сокет не открыт в том же процессе.
+
+Полезная нагрузка — список портов через запятую либо "*" (полная пересинхронизация).
+"""
+import asyncio
+import logging
+import socket
+from typing import Callable, Iterable, List, Optional, Set
+
+from sqlalchemy import text
+
+from config.settings import MODE_CHANGES_CHANNEL, MODE_CHANGES_UDP_HOST, MODE_CHANGES_UDP_PORT
+
+logger = logging.getLogger(__name__)
+
+# Внутрипроцессные подписчики: (loop, callback(ports))
+_local_subscribers: List[tuple] = []
+# Сколько подписчиков этого процесса слушают UDP-сокет уведомлений
+_udp_owners = 0
+
+ALL_PORTS = "*"
+
+
+def _is_postgres(bind) -> bool:
+    try:
+        return bind.dialect.name == "postgresql"
+    except Exception:
+        return False
+
+
+def _encode(ports: Iterable) -> str:
+    items = []
+    for p in ports:
+        if p is None:
+            continue
+        items.append(ALL_PORTS if p == ALL_PORTS else str(int(p)))
+    return ",".join(dict.fromkeys(items))
+
+
+def decode_ports(payload: str) -> Optional[Set[int]]:
+    """Разбирает полезную нагрузку. None означает «все порты»."""
+    ports: Set[int] = set()
+    for part in (payload or "").split(","):
+        part = part.strip()
+        if not part:
+            continue
+        if part == ALL_PORTS:
+            return None
+        try:
+            ports.add(int(part))
+        except ValueError:
+            logger.warning(f"Некорректный порт в уведомлении об изменении: '{part}'")
+    return ports
+
+
+def publish_port_change(session, *ports) -> None:
+    """
+    Публикует изменение конфигурации портов. Вызывать после commit изменений.
+    Ошибки публикации не пробрасываются: прокси всё равно периодически пересинхронизируется.
+    """
+    payload = _encode(ports)
+    if not payload:
+        return
+    try:
+        if _is_postgres(session.get_bind()):
+            session.execute(text("SELECT pg_notify(:channel, :payload)"), {"channel": MODE_CHANGES_CHANNEL, "payload": payload})
+            session.commit()
+            return
+    except Exception as e:
+        logger.warning(f"Не удалось отправить NOTIFY об изменении портов {payload}: {e}")
+        try:
+            session.rollback()
+        except Exception:
+            pass
+    _publish_local(payload)
+
+
+async def publish_port_change_async(session, *ports) -> None:
+    """Асинхронный вариант publish_port_change для AsyncSession. Вызывать после commit изменений."""
+    payload = _encode(ports)
+    if not payload:
+        return
+    try:
+        if _is_postgres(session.bind):
+            await session.execute(text("SELECT pg_notify(:channel, :payload)"), {"channel": MODE_CHANGES_CHANNEL, "payload": payload})
+            await session.commit()
+            return
+    except Exception as e:
+        logger.warning(f"Не удалось отправить NOTIFY об изменении портов {payload}: {e}")
+        try:
+            await session.rollback()
+        except Exception:
+            pass
+    _publish_local(payload)
+
+
+def _publish_local(payload: str) -> None:
+    for loop, callback in list(_local_subscribers):
+        try:
+            loop.call_soon_threadsafe(callback, payload)
+        except RuntimeError:
+            # Цикл уже закрыт
+            pass
+    if _udp_owners:
+        # UDP-сокет слушает этот же процесс — подписчики уже уведомлены
+        return
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.sendto(payload.encode(), (MODE_CHANGES_UDP_HOST, MODE_CHANGES_UDP_PORT))
+    except Exception as e:
+        logger.warning(f"Не удалось отправить UDP-уведомление об изменении портов {payload}: {e}")
+
+
+class _UdpChangeProtocol(asyncio.DatagramProtocol):
+    def __init__(self, callback: Callable[[str], None]):
+        self._callback = callback
+
+    def datagram_received(self, data, addr):
+        try:
+            self._callback(data.decode(errors="ignore"))
+        except Exception as e:
+            logger.warning(f"Ошибка обработки UDP-уведомления от {addr}: {e}")
+
+
+class ModeChangeListener:
+    """
+    Подписка на изменения конфигурации портов.
+    callback(payload) вызывается в цикле событий для каждого уведомления.
+    udp=False — без PostgreSQL только внутрипроцессные уведомления: UDP-сокет остаётся
+    прокси, который может работать в другом процессе.
+    """
+
+    def __init__(self, engine, callback: Callable[[str], None], udp: bool = True):
+        self._engine = engine
+        self._callback = callback
+        self._udp = udp
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._pg_conn = None
+        self._pg_task: Optional[asyncio.Task] = None
+        self._udp_transport = None
+        self._local_entry: Optional[tuple] = None
+
+    async def start(self):
+        global _udp_owners
+        self._loop = asyncio.get_running_loop()
+        if _is_postgres(self._engine):
+            self._pg_task = asyncio.create_task(self._pg_listen_loop())
+            return
+        self._local_entry = (self._loop, self._callback)
+        _local_subscribers.append(self._local_entry)
+        if not self._udp:
+            return
+        try:
+            self._udp_transport, _ = await self._loop.create_datagram_endpoint(
+                lambda: _UdpChangeProtocol(self._callback),
+                local_addr=(MODE_CHANGES_UDP_HOST, MODE_CHANGES_UDP_PORT),
+            )
+            _udp_owners += 1
+            logger.info(f"Слушаю UDP-уведомления об изменениях на {MODE_CHANGES_UDP_HOST}:{MODE_CHANGES_UDP_PORT}")
+        except Exception as e:
+            logger.warning(f"Не удалось открыть UDP-сокет уведомлений: {e}. Доступны только внутрипроцессные уведомления.")
+
+    async def stop(self):
+        global _udp_owners
+        if self._local_entry in _local_subscribers:
+            _local_subscribers.remove(self._local_entry)
+        self._local_entry = None
+        if self._udp_transport:
+            _udp_owners -= 1
+            self._udp_transport.close()
+            self._udp_transport = None
+        if self._pg_task:
+            self._pg_task.cancel()
+            await asyncio.gather(self._pg_task, return_exceptions=True)
+            self._pg_task = None
+        self._close_pg()
+
+    def _close_pg(self):
+        conn = self._pg_conn
+        self._pg_conn = None
+        if conn is None:
+            return
+        try:
+            self._loop.remove_reader(conn.fileno())
+        except Exception:
+            pass
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _pg_connect(self):
+        raw = self._engine.raw_connection()
+        conn = getattr(raw, "driver_connection", None) or raw.connection
+        # Отдельное соединение вне пула: LISTEN живёт всё время работы прокси
+        raw.detach()
+        conn.autocommit = True
+        cur = conn.cursor()
+        cur.execute(f"LISTEN {MODE_CHANGES_CHANNEL};")
+        cur.close()
+        return conn
+
+    def _pg_on_readable(self, lost: asyncio.Event):
+        conn = self._pg_conn
+        if conn is None:
+            return
+        try:
+            conn.poll()
+        except Exception as e:
+            logger.warning(f"Соединение LISTEN потеряно: {e}")
+            lost.set()
+            return
+        while conn.notifies:
+            notify = conn.notifies.pop(0)
+            try:
+                self._callback(notify.payload)
+            except Exception as e:
+                logger.warning(f"Ошибка обработки уведомления {notify.payload}: {e}")
+
+    async def _pg_listen_loop(self):
+        reconnect = False
+        while True:
+            lost = asyncio.Event()
+            try:
+                self._pg_conn = await asyncio.to_thread(self._pg_connect)
+                self._loop.add_reader(self._pg_conn.fileno(), self._pg_on_readable, lost)
+                logger.info(f"Подписка LISTEN {MODE_CHANGES_CHANNEL} установлена")
+                if reconnect:
+                    # Пока соединения не было, уведомления могли быть пропущены
+                    self._callback(ALL_PORTS)
+                reconnect = True
+                await lost.wait()
+            except asyncio.CancelledError:
+                break
+            except Exception as e:
+                logger.warning(f"Ошибка подписки LISTEN {MODE_CHANGES_CHANNEL}: {e}")
+                # БД была недоступна: после подключения нужна полная сверка
+                reconnect = True
+            self._close_pg()
+            await asyncio.sleep(5)
+
+
+__all__ = ["publish_port_change", "publish_port_change_async", "decode_ports", "ModeChangeListener", "ALL_PORTS"]
@@ -0,0 +1,58 @@
+"""Indexes for hot lookups, unique device per worker, users.active_mode_id
+
+Revision ID: 20261017_hot_lookup_indexes
+Revises: 20251024_change_tg_id_bigint
+Create Date: 2026-10-17
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '20261017_hot_lookup_indexes'
+down_revision = '20251024_change_tg_id_bigint'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Active mode by user, schedules by user, pending payments by (status, created_at)
+    op.create_index('ix_modes_user_id_is_active', 'modes', ['user_id', 'is_active'])
+    op.create_index('ix_schedules_user_id', 'schedules', ['user_id'])
+    op.create_index('ix_payment_requests_status_created_at', 'payment_requests', ['status', 'created_at'])
+
+    # Keep the newest row for each (user_id, worker) before adding the unique constraint
+    op.execute(
+        "DELETE FROM devices WHERE id NOT IN "
+        "(SELECT MAX(id) FROM devices GROUP BY user_id, worker)"
+    )
+    with op.batch_alter_table('devices') as batch_op:
+        batch_op.create_unique_constraint('uq_devices_user_id_worker', ['user_id', 'worker'])
+
+    # Pointer to the active mode: switching becomes a single-row UPDATE
+    with op.batch_alter_table('users') as batch_op:
+        batch_op.add_column(sa.Column('active_mode_id', sa.Integer(), nullable=True))
+        batch_op.create_foreign_key(
+            'fk_users_active_mode_id', 'modes', ['active_mode_id'], ['id'], ondelete='SET NULL'
+        )
+
+    # Backfill from the is_active flags (the lowest id wins if several are set),
+    # then clear flags that do not match the pointer
+    op.execute(
+        "UPDATE users SET active_mode_id = "
+        "(SELECT MIN(modes.id) FROM modes WHERE modes.user_id = users.id AND modes.is_active = 1)"
+    )
+    op.execute(
+        "UPDATE modes SET is_active = 0 WHERE is_active = 1 AND id NOT IN "
+        "(SELECT active_mode_id FROM users WHERE active_mode_id IS NOT NULL)"
+    )
+
+
+def downgrade():
+    with op.batch_alter_table('users') as batch_op:
+        batch_op.drop_constraint('fk_users_active_mode_id', type_='foreignkey')
+        batch_op.drop_column('active_mode_id')
+    with op.batch_alter_table('devices') as batch_op:
+        batch_op.drop_constraint('uq_devices_user_id_worker', type_='unique')
+    op.drop_index('ix_payment_requests_status_created_at', table_name='payment_requests')
+    op.drop_index('ix_schedules_user_id', table_name='schedules')
+    op.drop_index('ix_modes_user_id_is_active', table_name='modes')
@@ -1,10 +1,15 @@
-from sqlalchemy import Column, Integer, BigInteger, String, ForeignKey, DateTime, create_engine, Enum
+from sqlalchemy import Column, Integer, BigInteger, String, ForeignKey, DateTime, create_engine, Enum, Index, UniqueConstraint, case, or_, update
 from sqlalchemy.exc import OperationalError
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship, sessionmaker
 import datetime
 import enum
 import calendar
+import logging
+import threading
+import weakref
+
+logger = logging.getLogger(__name__)
 
 Base = declarative_base()
 
@@ -24,8 +29,15 @@ class User(Base):
     login = Column(String, nullable=False)
     timezone = Column(String, default='UTC')
     subscription_until = Column(DateTime, nullable=False)
+    # Активный режим: переключение — обновление одной строки; флаги Mode.is_active
+    # поддерживаются в согласованном состоянии для совместимости (см. activate_mode_statements)
+    active_mode_id = Column(
+        Integer,
+        ForeignKey('modes.id', ondelete='SET NULL', use_alter=True, name='fk_users_active_mode_id'),
+        nullable=True,
+    )
     
-    modes = relationship("Mode", back_populates="user", cascade="all, delete-orphan")
+    modes = relationship("Mode", back_populates="user", cascade="all, delete-orphan", foreign_keys="Mode.user_id")
     schedules = relationship("Schedule", back_populates="user", cascade="all, delete-orphan")
     payment_requests = relationship("PaymentRequest", back_populates="user", cascade="all, delete-orphan")
     devices = relationship("Device", back_populates="user", cascade="all, delete-orphan")
@@ -38,6 +50,9 @@ class User(Base):
 
 class Mode(Base):
     __tablename__ = 'modes'
+    __table_args__ = (
+        Index('ix_modes_user_id_is_active', 'user_id', 'is_active'),
+    )
     
     id = Column(Integer, primary_key=True)
     user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
@@ -47,7 +62,7 @@ class Mode(Base):
     alias = Column(String, nullable=False)
     is_active = Column(Integer, default=0)  # 0 - неактивный, 1 - активный
     
-    user = relationship("User", back_populates="modes")
+    user = relationship("User", back_populates="modes", foreign_keys=[user_id])
     schedules = relationship("Schedule", back_populates="mode", cascade="all, delete-orphan")
     
     def __repr__(self):
@@ -55,6 +70,9 @@ class Mode(Base):
 
 class Schedule(Base):
     __tablename__ = 'schedules'
+    __table_args__ = (
+        Index('ix_schedules_user_id', 'user_id'),
+    )
     
     id = Column(Integer, primary_key=True)
     user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
@@ -80,6 +98,9 @@ class PaymentStatus(enum.Enum):
 
 class PaymentRequest(Base):
     __tablename__ = 'payment_requests'
+    __table_args__ = (
+        Index('ix_payment_requests_status_created_at', 'status', 'created_at'),
+    )
 
     id = Column(Integer, primary_key=True)
     user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
@@ -93,6 +114,10 @@ class PaymentRequest(Base):
 # ===== Новая модель устройств пользователя =====
 class Device(Base):
     __tablename__ = 'devices'
+    __table_args__ = (
+        # Одно устройство на воркер пользователя (позволяет upsert через ON CONFLICT)
+        UniqueConstraint('user_id', 'worker', name='uq_devices_user_id_worker'),
+    )
 
     id = Column(Integer, primary_key=True)
     user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
@@ -115,28 +140,67 @@ class Device(Base):
         return f"<Device(id={self.id}, user_id={self.user_id}, worker={self.worker}, online={self.is_online})>"
 
 
-def init_db(db_url=None):
-    """Инициализация базы данных"""
+def activate_mode_statements(user_id: int, mode_id: int):
+    """
+    Запросы переключения активного режима пользователя (выполнять в одной транзакции).
+    Первый атомарно переставляет указатель users.active_mode_id, второй синхронизирует
+    флаги is_active и затрагивает только прежний и новый режимы.
+    """
+    return (
+        update(User).where(User.id == user_id).values(active_mode_id=mode_id),
+        update(Mode)
+        .where(Mode.user_id == user_id, or_(Mode.is_active == 1, Mode.id == mode_id))
+        .values(is_active=case((Mode.id == mode_id, 1), else_=0))
+        .execution_options(synchronize_session="fetch"),
+    )
+
+
+# Движок и фабрика сессий процесса: создаются один раз при первом обращении
+_engine = None
+_engine_lock = threading.Lock()
+_session_factories = weakref.WeakKeyDictionary()
+
+
+def init_db(db_url=None, fallback=True):
+    """
+    Инициализация базы данных.
+    Без db_url возвращает общий движок процесса: он создаётся (и схема проверяется) только
+    при первом вызове. С явным db_url всегда создаёт новый движок (скрипты, стенды).
+    fallback=False — при недоступной БД не переключаться на локальную SQLite, а вернуть движок
+    настроенной БД (подключение будет выполнено при первом запросе).
+    """
+    global _engine
+    if db_url is None:
+        if _engine is not None:
+            return _engine
+        with _engine_lock:
+            if _engine is None:
+                _engine = _create_engine_with_schema(None, fallback)
+            return _engine
+    return _create_engine_with_schema(db_url, fallback)
+
+
+def _create_engine_with_schema(db_url=None, fallback=True):
+    try:
+        from config.settings import (
+            DATABASE_URL,
+            DB_POOL_SIZE,
+            DB_MAX_OVERFLOW,
+            DB_POOL_TIMEOUT,
+            DB_POOL_RECYCLE,
+            DB_POOL_PRE_PING,
+        )
+    except Exception:
+        # Фолбэк на локальную SQLite, если настройки недоступны
+        DATABASE_URL = "sqlite:///stratum_proxy.db"
+        DB_POOL_SIZE = 200
+        DB_MAX_OVERFLOW = 400
+        DB_POOL_TIMEOUT = 60
+        DB_POOL_RECYCLE = 1800
+        DB_POOL_PRE_PING = True
     # Если URL базы не передан, используем значение из настроек
     if db_url is None:
-        try:
-            from config.settings import (
-                DATABASE_URL,
-                DB_POOL_SIZE,
-                DB_MAX_OVERFLOW,
-                DB_POOL_TIMEOUT,
-                DB_POOL_RECYCLE,
-                DB_POOL_PRE_PING,
-            )
-            db_url = DATABASE_URL
-        except Exception:
-            # Фолбэк на локальную SQLite, если настройки недоступны
-            db_url = "sqlite:///stratum_proxy.db"
-            DB_POOL_SIZE = 200
-            DB_MAX_OVERFLOW = 400
-            DB_POOL_TIMEOUT = 60
-            DB_POOL_RECYCLE = 1800
-            DB_POOL_PRE_PING = True
+        db_url = DATABASE_URL
     def _create(db_url_local, use_pool=True):
         if db_url_local.startswith("sqlite"):
             use_pool = False
@@ -157,14 +221,28 @@ def init_db(db_url=None):
         engine = _create(db_url)
         Base.metadata.create_all(engine)
         return engine
-    except OperationalError:
+    except OperationalError as e:
+        if not fallback:
+            logger.warning(f"БД недоступна, схема не проверена: {e}")
+            return engine
         fallback_url = "sqlite:///stratum_proxy.db"
+        logger.warning(f"БД недоступна ({e}), использую локальную {fallback_url}")
         engine = _create(fallback_url, use_pool=False)
         Base.metadata.create_all(engine)
         return engine
 
 
-def get_session(engine):
-    """Создание сессии для работы с базой данных"""
-    Session = sessionmaker(bind=engine)
-    return Session()
\ No newline at end of file
+def get_engine():
+    """Общий движок процесса (создаётся при первом обращении)."""
+    return _engine if _engine is not None else init_db()
+
+
+def get_session(engine=None):
+    """Создание сессии для работы с базой данных (фабрика сессий кешируется на движок)"""
+    if engine is None:
+        engine = get_engine()
+    factory = _session_factories.get(engine)
+    if factory is None:
+        factory = sessionmaker(bind=engine)
+        _session_factories[engine] = factory
+    return factory()
@@ -1,5 +1,6 @@
 import asyncio
 import os
+import signal
 import sys
 import argparse
 
@@ -10,21 +11,27 @@ if PROJECT_ROOT not in sys.path:
 import logging
 import io
 import sys
-from aiogram import Bot, Dispatcher
-from aiogram.fsm.storage.memory import MemoryStorage
-from aiogram.enums import ParseMode
-from aiogram.types import BotCommand, BotCommandScopeDefault, BotCommandScopeChat, BotCommandScopeAllPrivateChats, BotCommandScopeAllGroupChats
+from typing import TYPE_CHECKING
+
+from sqlalchemy import select
 
 from config.settings import (
     BOT_TOKEN, PROXY_HOST, DEFAULT_PORT_RANGE,
     SCHEDULER_CHECK_INTERVAL, LOG_LEVEL,
-    PROXY_API_HOST, PROXY_API_PORT, PROXY_API_TOKEN,
+    PROXY_API_HOST, PROXY_API_PORT, PROXY_API_TOKEN, PROXY_WORKERS, PROXY_SNAPSHOT_PATH,
 )
-from db.models import init_db, get_session, User, UserRole
+from db.models import init_db, User, UserRole
+from db.aio import dispose_async_engine, get_async_session
 from proxy.server import StratumProxyServer
-from bot.handlers import register_handlers
+from proxy.snapshot import has_snapshot
+from proxy.supervisor import ProxySupervisor, worker_api_port
 from bot.scheduler import Scheduler
 
+# aiogram, обработчики и клавиатуры бота импортируются только в main(): режим --proxy-only
+# и процессы прокси их не загружают (проверка: scripts/import_report.py)
+if TYPE_CHECKING:
+    from aiogram import Bot
+
 # Настройка логирования
 try:
     sys.stdout.reconfigure(encoding='utf-8')
@@ -41,7 +48,9 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-async def set_commands(bot: Bot):
+async def set_commands(bot: "Bot"):
+    from aiogram.types import BotCommand, BotCommandScopeChat, BotCommandScopeAllPrivateChats, BotCommandScopeAllGroupChats
+
     # Команды по умолчанию для всех пользователей
     default_commands = [
         BotCommand(command="start", description="Запустить бота"),
@@ -71,18 +80,18 @@ async def set_commands(bot: Bot):
     ]
 
     # Устанавливаем админские команды для чатов администраторов
-    engine = init_db()
-    db_session = get_session(engine)
+    db_session = get_async_session()
     try:
-        admins = db_session.query(User).filter(User.role.in_([UserRole.ADMIN, UserRole.SUPERADMIN])).all()
+        admin_ids = (await db_session.execute(
+            select(User.tg_id).where(User.role.in_([UserRole.ADMIN, UserRole.SUPERADMIN]))
+        )).scalars().all()
         # Устанавливаем команды только для приватных чатов
         await bot.set_my_commands(default_commands, scope=BotCommandScopeAllPrivateChats())
         # Очищаем меню команд в группах/супергруппах
         await bot.set_my_commands([], scope=BotCommandScopeAllGroupChats())
         
         # Для каждого админа ставим расширенное меню в его приватном чате
-        for admin in admins:
-            tg_id = getattr(admin, "tg_id", None)
+        for tg_id in admin_ids:
             if not tg_id:
                 continue
             # Объединяем дефолтные + админские
@@ -94,22 +103,41 @@ async def set_commands(bot: Bot):
                 pass
 
     finally:
-        db_session.close()
+        await db_session.close()
+
+def _db_fallback(workers: int) -> bool:
+    """
+    Подменять ли недоступную БД локальной SQLite. Нет, только если на диске есть снимок
+    конфигурации прокси (у каждого процесса многопроцессного режима — свой): порты работают по нему.
+    """
+    if not PROXY_SNAPSHOT_PATH:
+        return True
+    paths = [PROXY_SNAPSHOT_PATH] if workers <= 1 else [f"{PROXY_SNAPSHOT_PATH}.{i}" for i in range(workers)]
+    return not any(has_snapshot(path) for path in paths)
 
-async def main():
+async def main(workers: int = 1):
     """Основная функция запуска приложения"""
     logger.info("Запуск приложения...")
+    from aiogram import Bot, Dispatcher
+    from aiogram.fsm.storage.memory import MemoryStorage
+    from aiogram.enums import ParseMode
+    from bot.handlers import register_handlers
+    from bot.notifier import Notifier
     
-    # Инициализация базы данных
-    engine = init_db()
+    # Инициализация базы данных (при загруженном снимке конфигурации прокси — без подмены недоступной БД на SQLite)
+    engine = init_db(fallback=_db_fallback(workers))
     
     # Инициализация бота
     bot = Bot(token=BOT_TOKEN, parse_mode=ParseMode.HTML)
     storage = MemoryStorage()
     dp = Dispatcher(storage=storage)
     
-    # Инициализация прокси-сервера
-    proxy_server = StratumProxyServer()
+    # Инициализация прокси-сервера (уведомления отправляются через общий экземпляр бота);
+    # при workers > 1 порты обслуживают дочерние процессы под управлением супервизора
+    if workers > 1:
+        proxy_server = ProxySupervisor(workers, engine=engine)
+    else:
+        proxy_server = StratumProxyServer(notifier=Notifier(bot=bot))
     
     # Инициализация планировщика
     scheduler = Scheduler(
@@ -141,15 +169,19 @@ async def main():
         
         # Остановка прокси-сервера
         await proxy_server.stop()
+        await dispose_async_engine()
         
         logger.info("Приложение остановлено")
 
-async def run_proxy_only():
+async def run_proxy_only(workers: int = 1):
     """Запуск только прокси-сервера и планировщика без Telegram-бота"""
     logger.info("Запуск только прокси-сервера и планировщика (без Telegram-бота)...")
 
-    engine = init_db()
-    proxy_server = StratumProxyServer()
+    engine = init_db(fallback=_db_fallback(workers))
+    if workers > 1:
+        proxy_server = ProxySupervisor(workers, engine=engine)
+    else:
+        proxy_server = StratumProxyServer()
     scheduler = Scheduler(
         proxy_server=proxy_server,
         check_interval=SCHEDULER_CHECK_INTERVAL,
@@ -168,18 +200,50 @@ async def run_proxy_only():
     finally:
         await scheduler.stop()
         await proxy_server.stop()
+        await dispose_async_engine()
         logger.info("Proxy-only сервис остановлен")
 
+async def run_proxy_worker(index: int, workers: int):
+    """Дочерний процесс многопроцессного режима: только свои порты, без планировщика"""
+    logger.info(f"Запуск процесса прокси #{index} из {workers}...")
+    proxy_server = StratumProxyServer(shard=(index, workers))
+    stop_event = asyncio.Event()
+    try:
+        # Супервизор останавливает процессы через SIGTERM
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stop_event.set)
+    except (NotImplementedError, AttributeError):
+        pass
+
+    try:
+        await proxy_server.start_http_api(PROXY_API_HOST, worker_api_port(index), PROXY_API_TOKEN)
+        await proxy_server.start()
+        await stop_event.wait()
+    finally:
+        await proxy_server.stop()
+        await dispose_async_engine()
+        logger.info(f"Процесс прокси #{index} остановлен")
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Cryptoshi Stratum Proxy")
     parser.add_argument("--proxy-only", action="store_true", help="Запустить только прокси-сервер без Telegram-бота")
+    parser.add_argument("--workers", type=int, default=PROXY_WORKERS, help="Число процессов прокси (порты делятся между ними)")
+    parser.add_argument("--worker-index", type=int, default=None, help=argparse.SUPPRESS)
     args = parser.parse_args()
 
+    if args.worker_index is not None:
+        # Помечаем строки лога номером процесса
+        for handler in logging.getLogger().handlers:
+            handler.setFormatter(logging.Formatter(
+                f'%(asctime)s - [w{args.worker_index}] %(name)s - %(levelname)s - %(message)s'
+            ))
+
     try:
-        if args.proxy_only:
-            asyncio.run(run_proxy_only())
+        if args.worker_index is not None:
+            asyncio.run(run_proxy_worker(args.worker_index, args.workers))
+        elif args.proxy_only:
+            asyncio.run(run_proxy_only(args.workers))
         else:
-            asyncio.run(main())
+            asyncio.run(main(args.workers))
     except (KeyboardInterrupt, SystemExit):
         logger.info("Приложение остановлено пользователем")
     except Exception as e:
@@ -0,0 +1,352 @@
+"""
+Режим агрегации: майнеры одного порта разделяют общие upstream-сессии к пулу.
+
+Каждая upstream-сессия подписывается на пул один раз и получает extranonce1/extranonce2_size.
+Пространство extranonce2 делится между майнерами: майнеру выдаётся
+extranonce1 = pool_extranonce1 + slot (AGGREGATION_EXTRANONCE_BYTES байт),
+extranonce2_size = pool_extranonce2_size - AGGREGATION_EXTRANONCE_BYTES.
+При отправке шары slot дописывается в начало extranonce2, поэтому работа майнеров не пересекается.
+
+mining.notify / mining.set_difficulty пула рассылаются всем майнерам сессии как есть,
+ответы на запросы майнеров возвращаются отправителю по id запроса.
+"""
+import asyncio
+import json
+import logging
+from typing import Dict, List, Optional, Tuple
+
+from config.settings import (
+    AGGREGATION_EXTRANONCE_BYTES,
+    AGGREGATION_MAX_MINERS,
+    AGGREGATION_IDLE_TIMEOUT,
+    AGGREGATION_MAX_MINER_BUFFER,
+    UPSTREAM_CONNECT_TIMEOUT,
+)
+
+logger = logging.getLogger(__name__)
+
+# Сколько секунд после неудачного открытия общей сессии майнеры порта подключаются к пулу напрямую
+_OPEN_RETRY_DELAY = 30.0
+
+
+class _SharedUpstream:
+    """Одна upstream-сессия к пулу, разделяемая несколькими майнерами порта."""
+
+    def __init__(self, aggregator: "ShareAggregator", key: tuple, conf: dict):
+        self.aggregator = aggregator
+        self.key = key
+        self.conf = conf
+        self.reader: Optional[asyncio.StreamReader] = None
+        self.writer: Optional[asyncio.StreamWriter] = None
+        self.extranonce1 = ""
+        self.extranonce2_size = 0
+        self.slot_bytes = max(1, AGGREGATION_EXTRANONCE_BYTES)
+        self.capacity = min(256 ** self.slot_bytes, max(1, AGGREGATION_MAX_MINERS))
+        self._free_slots: List[int] = list(range(self.capacity - 1, -1, -1))
+        self.miners: Dict[int, object] = {}
+        # upstream id -> (сессия майнера, исходный id)
+        self._pending: Dict[int, Tuple[object, object]] = {}
+        self._next_id = 0
+        # Последние set_difficulty / notify для новых майнеров
+        self.last_difficulty: Optional[bytes] = None
+        self.last_notify: Optional[bytes] = None
+        self.closed = False
+        self._pump_task: Optional[asyncio.Task] = None
+        self._idle_handle: Optional[asyncio.TimerHandle] = None
+
+    @property
+    def full(self) -> bool:
+        return not self._free_slots
+
+    async def open(self):
+        host, port = self.conf["host"], int(self.conf["port"])
+        self.reader, self.writer = await self.aggregator.server._upstreams.connect(host, port)
+        try:
+            req_id = self._alloc_id()
+            self.writer.write((json.dumps({"id": req_id, "method": "mining.subscribe", "params": ["stratum-proxy/aggregator"]}) + "\n").encode())
+            await self.writer.drain()
+            while True:
+                line = await asyncio.wait_for(self.reader.readline(), UPSTREAM_CONNECT_TIMEOUT)
+                if not line:
+                    raise ConnectionResetError("pool closed connection during subscribe")
+                try:
+                    resp = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if resp.get("id") == req_id:
+                    break
+                self._remember(line, resp.get("method"))
+            result = resp.get("result")
+            if not (isinstance(result, list) and len(result) >= 3):
+                raise ValueError(f"bad subscribe response: {resp}")
+            self.extranonce1, self.extranonce2_size = str(result[1]), int(result[2])
+            if self.extranonce2_size - self.slot_bytes < 2:
+                raise ValueError(f"extranonce2_size={self.extranonce2_size} слишком мал для деления")
+        except BaseException:
+            # Сессия не попадёт в реестр, и закрыть подписанный сокет больше некому
+            self.closed = True
+            self.writer.close()
+            raise
+        self._pump_task = asyncio.create_task(self._pump())
+        logger.info(
+            f"Агрегация: открыта общая сессия к {host}:{port} для порта {self.key[0]} "
+            f"(extranonce1={self.extranonce1}, extranonce2_size={self.extranonce2_size}, мест={self.capacity})"
+        )
+
+    def _alloc_id(self) -> int:
+        self._next_id += 1
+        return self._next_id
+
+    def _remember(self, line: bytes, method: Optional[str]):
+        if method == "mining.set_difficulty":
+            self.last_difficulty = line
+        elif method == "mining.notify":
+            self.last_notify = line
+
+    def attach(self, sess) -> int:
+        slot = self._free_slots.pop()
+        self.miners[slot] = sess
+        if self._idle_handle:
+            self._idle_handle.cancel()
+            self._idle_handle = None
+        return slot
+
+    def detach(self, slot: int):
+        sess = self.miners.pop(slot, None)
+        if sess is None:
+            return
+        self._free_slots.append(slot)
+        # Ответы, которые уже некому доставить
+        for uid in [k for k, (s, _) in self._pending.items() if s is sess]:
+            self._pending.pop(uid, None)
+        if not self.miners and not self.closed:
+            loop = asyncio.get_running_loop()
+            self._idle_handle = loop.call_later(AGGREGATION_IDLE_TIMEOUT, lambda: asyncio.ensure_future(self.close()))
+
+    def slot_prefix(self, slot: int) -> str:
+        return format(slot, f"0{self.slot_bytes * 2}x")
+
+    async def request(self, sess, msg: dict):
+        """Отправляет запрос майнера в общую сессию, подменяя id на собственный."""
+        uid = self._alloc_id()
+        self._pending[uid] = (sess, msg.get("id"))
+        msg["id"] = uid
+        self.writer.write((json.dumps(msg) + "\n").encode())
+        await self.writer.drain()
+
+    async def _pump(self):
+        """Пул -> майнеры: рассылка уведомлений и маршрутизация ответов по id."""
+        try:
+            while True:
+                line = await self.reader.readline()
+                if not line:
+                    break
+                try:
+                    msg = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                method = msg.get("method")
+                if method:
+                    if method == "mining.set_extranonce":
+                        # Пул сменил extranonce — раздел слотов больше не действителен
+                        logger.info(f"Агрегация: пул сменил extranonce для порта {self.key[0]}, переподключаю майнеров")
+                        break
+                    self._remember(line, method)
+                    for sess in list(self.miners.values()):
+                        self.aggregator.send(sess, line)
+                    continue
+                target = self._pending.pop(msg.get("id"), None)
+                if target is None:
+                    continue
+                sess, orig_id = target
+                msg["id"] = orig_id
+                self.aggregator.server._count_pool_error(sess, msg.get("error"))
+                self.aggregator.send(sess, (json.dumps(msg) + "\n").encode())
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            logger.error(f"Агрегация: ошибка чтения общей сессии порта {self.key[0]}: {e}")
+        finally:
+            await self.close()
+
+    async def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.aggregator._forget(self)
+        if self._idle_handle:
+            self._idle_handle.cancel()
+            self._idle_handle = None
+        if self._pump_task and self._pump_task is not asyncio.current_task():
+            self._pump_task.cancel()
+        if self.writer:
+            try:
+                self.writer.close()
+            except Exception:
+                pass
+        # Майнеры переподключатся и получат новую общую сессию
+        for sess in list(self.miners.values()):
+            sess.task.cancel()
+
+
+class ShareAggregator:
+    """Реестр общих upstream-сессий по (порт, пул, alias)."""
+
+    def __init__(self, server):
+        self.server = server
+        self._groups: Dict[tuple, List[_SharedUpstream]] = {}
+        self._opening: Dict[tuple, asyncio.Lock] = {}
+        # Сколько вызовов _acquire держат или ждут блокировку ключа: пока они есть, блокировка не удаляется
+        self._opening_users: Dict[tuple, int] = {}
+        # Неудачные попытки открыть общую сессию: ключ -> (до какого времени не повторять, ошибка)
+        self._failed: Dict[tuple, Tuple[float, Exception]] = {}
+
+    @staticmethod
+    def _key(port: int, conf: dict) -> tuple:
+        return (port, conf.get("host"), int(conf.get("port", 0)), conf.get("alias"))
+
+    def _forget(self, group: _SharedUpstream):
+        groups = self._groups.get(group.key)
+        if groups and group in groups:
+            groups.remove(group)
+            if not groups:
+                self._groups.pop(group.key, None)
+                if group.key not in self._opening_users:
+                    self._opening.pop(group.key, None)
+
+    async def _acquire(self, port: int, conf: dict) -> _SharedUpstream:
+        key = self._key(port, conf)
+        now = asyncio.get_running_loop().time()
+        failed = self._failed.get(key)
+        if failed is not None:
+            if failed[0] > now:
+                # Пул недавно отказал (например, extranonce2_size мал) — не повторяем рукопожатие на каждого майнера
+                raise failed[1]
+            self._failed.pop(key, None)
+        lock = self._opening.setdefault(key, asyncio.Lock())
+        self._opening_users[key] = self._opening_users.get(key, 0) + 1
+        try:
+            async with lock:
+                for group in self._groups.get(key, []):
+                    if not group.full and not group.closed:
+                        return group
+                group = _SharedUpstream(self, key, conf)
+                try:
+                    await group.open()
+                except Exception as e:
+                    now = asyncio.get_running_loop().time()
+                    for k in [k for k, (until, _) in self._failed.items() if until <= now]:
+                        self._failed.pop(k, None)
+                    self._failed[key] = (now + _OPEN_RETRY_DELAY, e)
+                    raise
+                self._groups.setdefault(key, []).append(group)
+                return group
+        finally:
+            users = self._opening_users.pop(key) - 1
+            if users:
+                self._opening_users[key] = users
+            elif key not in self._groups:
+                # Последний вызов для ключа без общих сессий: блокировка больше не нужна
+                self._opening.pop(key, None)
+
+    def send(self, sess, data: bytes):
+        """Запись майнеру без ожидания drain: медленный майнер не задерживает остальных."""
+        writer = sess.miner_writer
+        if writer.is_closing():
+            return
+        writer.write(data)
+        transport = writer.transport
+        if transport is not None and transport.get_write_buffer_size() > AGGREGATION_MAX_MINER_BUFFER:
+            logger.warning(f"Агрегация: майнер {sess.addr} не успевает читать, отключаю")
+            sess.task.cancel()
+
+    async def serve(self, sess) -> bool:
+        """
+        Обслуживает майнера через общую upstream-сессию до его отключения.
+        Возвращает False, если общую сессию получить не удалось (вызывающий использует обычный режим).
+        """
+        try:
+            group = await self._acquire(sess.port, sess.conf)
+        except Exception as e:
+            logger.warning(f"Агрегация недоступна для порта {sess.port}: {e}. Использую отдельное соединение.")
+            return False
+
+        sess.aggregated = True
+        slot = group.attach(sess)
+        prefix = group.slot_prefix(slot)
+        alias_login = sess.conf.get("alias", "")
+        # Логин майнера -> логин на пуле
+        logins: Dict[str, str] = {}
+        logger.info(f"Майнер {sess.addr}: агрегирован в общую сессию порта {sess.port} (slot={slot})")
+        try:
+            reader = sess.miner_reader
+            while not reader.at_eof() and not group.closed:
+                data = await reader.readline()
+                if not data:
+                    break
+                try:
+                    msg = json.loads(data)
+                except json.JSONDecodeError:
+                    continue
+                if not isinstance(msg, dict):
+                    continue
+                method = msg.get("method")
+                if method == "mining.subscribe":
+                    sess.subscribe_msg = dict(msg)
+                    result = [
+                        [["mining.set_difficulty", prefix], ["mining.notify", prefix]],
+                        group.extranonce1 + prefix,
+                        group.extranonce2_size - group.slot_bytes,
+                    ]
+                    self.send(sess, (json.dumps({"id": msg.get("id"), "result": result, "error": None}) + "\n").encode())
+                    if group.last_difficulty:
+                        self.send(sess, group.last_difficulty)
+                    if group.last_notify:
+                        self.send(sess, group.last_notify)
+                elif method == "mining.extranonce.subscribe":
+                    # extranonce майнера фиксирован слотом и не меняется
+                    self.send(sess, (json.dumps({"id": msg.get("id"), "result": True, "error": None}) + "\n").encode())
+                elif method == "mining.authorize":
+                    params = msg.get("params", [])
+                    original = params[0] if params and isinstance(params[0], str) else None
+                    rewritten = self.server._rewrite_authorize(sess, msg, alias_login)
+                    if rewritten:
+                        _, new_user, worker = rewritten
+                        logins[original] = new_user
+                        logger.info(f"Порт {sess.port}: authorize {original} -> {new_user} (агрегация)")
+                        self.server._upsert_device(sess.port, worker)
+                    await group.request(sess, msg)
+                elif method == "mining.submit":
+                    params = msg.get("params", [])
+                    if len(params) >= 3:
+                        if isinstance(params[0], str):
+                            params[0] = logins.get(params[0], params[0])
+                        params[2] = prefix + str(params[2])
+                    await group.request(sess, msg)
+                elif msg.get("id") is not None:
+                    await group.request(sess, msg)
+        except asyncio.CancelledError:
+            pass
+        except (ConnectionResetError, BrokenPipeError):
+            pass
+        except Exception as e:
+            logger.error(f"Агрегация: ошибка обработки майнера {sess.addr}: {e}")
+        finally:
+            group.detach(slot)
+            try:
+                sess.miner_writer.close()
+            except Exception:
+                pass
+        return True
+
+    def sessions_count(self) -> int:
+        return sum(len(groups) for groups in self._groups.values())
+
+    async def close(self):
+        for groups in list(self._groups.values()):
+            for group in list(groups):
+                await group.close()
+        self._groups.clear()
+
+
+__all__ = ["ShareAggregator"]
@@ -0,0 +1,185 @@
+import asyncio
+import datetime
+import logging
+import re
+from typing import Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+from sqlalchemy import func, select
+from sqlalchemy.dialects import postgresql, sqlite
+
+from config.settings import DEVICE_FLUSH_INTERVAL_MS, DEVICE_FLUSH_MAX_EVENTS
+from db.models import User, Device
+from db.aio import get_async_session
+
+logger = logging.getLogger(__name__)
+
+DeviceKey = Tuple[int, str]
+# (tg_id, имя устройства, воркер) для уведомлений об уходе в оффлайн
+OfflineEvent = Tuple[int, str, str]
+
+# Сколько раз пачка пытается записаться, прежде чем её изменения отбрасываются
+_MAX_ATTEMPTS = 3
+# Строк в одном INSERT ... ON CONFLICT
+_UPSERT_CHUNK = 500
+_INSERTS = {"postgresql": postgresql.insert, "sqlite": sqlite.insert}
+
+
+class DeviceStateWriter:
+    """
+    Фоновая запись состояния устройств (онлайн/оффлайн).
+    Переходы копятся в памяти и схлопываются по (порт, воркер): в БД попадает только
+    итоговое состояние. Сброс — раз в DEVICE_FLUSH_INTERVAL_MS или при DEVICE_FLUSH_MAX_EVENTS
+    событиях, одной транзакцией через асинхронную сессию: INSERT ... ON CONFLICT по
+    (user_id, worker) с RETURNING, без предварительной выборки устройств.
+    """
+
+    def __init__(self, on_offline: Optional[Callable[[List[OfflineEvent]], Awaitable[None]]] = None):
+        self._on_offline = on_offline
+        # (порт, воркер) -> {"online": bool, "connected_at": datetime|None, "seen_at": datetime}
+        self._pending: Dict[DeviceKey, dict] = {}
+        self._events = 0
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def mark_online(self, port: int, worker: str):
+        now = datetime.datetime.utcnow()
+        self._pending[(port, worker or "")] = {"online": True, "connected_at": now, "seen_at": now}
+        self._bump()
+
+    def mark_offline(self, port: int, worker: str):
+        now = datetime.datetime.utcnow()
+        key = (port, worker or "")
+        prev = self._pending.get(key)
+        # Подключение в том же окне должно сохранить время последнего подключения
+        connected_at = prev["connected_at"] if prev else None
+        self._pending[key] = {"online": False, "connected_at": connected_at, "seen_at": now}
+        self._bump()
+
+    def _bump(self):
+        self._events += 1
+        if self._events >= DEVICE_FLUSH_MAX_EVENTS:
+            self._wakeup.set()
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        # Финальный сброс накопленных изменений
+        await self.flush()
+
+    async def _run(self):
+        interval = max(0.01, DEVICE_FLUSH_INTERVAL_MS / 1000.0)
+        while True:
+            try:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), interval)
+                except asyncio.TimeoutError:
+                    pass
+                await self.flush()
+            except asyncio.CancelledError:
+                break
+            except Exception as e:
+                logger.warning(f"Ошибка фоновой записи устройств: {e}")
+
+    async def flush(self):
+        self._wakeup.clear()
+        if not self._pending:
+            return
+        batch, self._pending, self._events = self._pending, {}, 0
+        try:
+            offline = await self._write(batch)
+        except Exception as e:
+            # Вернём несохранённое, не перетирая более свежие события; пачку, которая раз за разом
+            # не записывается (например, из-за некорректной строки), не повторяем бесконечно
+            dropped = 0
+            for key, state in batch.items():
+                state["attempts"] = state.get("attempts", 0) + 1
+                if state["attempts"] >= _MAX_ATTEMPTS:
+                    dropped += 1
+                    continue
+                self._pending.setdefault(key, state)
+            logger.warning(f"Не удалось записать состояние {len(batch)} устройств: {e}"
+                           + (f". Отброшено после {_MAX_ATTEMPTS} попыток: {dropped}" if dropped else ""))
+            return
+        if offline and self._on_offline:
+            try:
+                await self._on_offline(offline)
+            except Exception as e:
+                logger.warning(f"Ошибка обработки уведомлений об оффлайне: {e}")
+
+    async def _write(self, batch: Dict[DeviceKey, dict]) -> List[OfflineEvent]:
+        """Записывает пачку состояний одной транзакцией. Возвращает устройства, ушедшие в оффлайн."""
+        session = get_async_session()
+        try:
+            ports = {port for port, _ in batch}
+            users = {row.port: row for row in (await session.execute(
+                select(User.id, User.port, User.tg_id).where(User.port.in_(ports))
+            )).all()}
+            rows = []
+            for (port, worker), state in batch.items():
+                u = users.get(port)
+                if u is None:
+                    continue
+                # попытка извлечь числовой идентификатор воркера (например, b11 -> 11)
+                m = re.search(r"(\d+)$", worker) if worker else None
+                rows.append({
+                    "user_id": u.id,
+                    "worker": worker,
+                    "worker_number": int(m.group(1)) if m else None,
+                    # имя устройства по умолчанию — воркер
+                    "name": worker or None,
+                    "last_connected_at": state["connected_at"],
+                    "last_seen_at": state["seen_at"],
+                    "is_online": 1 if state["online"] else 0,
+                })
+            if not rows:
+                return []
+            insert = _INSERTS.get(session.bind.dialect.name)
+            if insert is None:
+                raise RuntimeError(f"upsert устройств не поддерживается для БД {session.bind.dialect.name}")
+            tg_ids = {u.id: u.tg_id for u in users.values()}
+            # Уведомление — только об устройствах, которые до этой пачки были онлайн
+            # (не о впервые записанных сразу оффлайн)
+            going_offline = {(r["user_id"], r["worker"]) for r in rows if not r["is_online"]}
+            was_online: Set[DeviceKey] = set()
+            if going_offline:
+                was_online = {(row.user_id, row.worker) for row in (await session.execute(
+                    select(Device.user_id, Device.worker).where(
+                        Device.user_id.in_({uid for uid, _ in going_offline}),
+                        Device.worker.in_({w for _, w in going_offline}),
+                        Device.is_online == 1,
+                    )
+                )).all()} & going_offline
+            offline: List[OfflineEvent] = []
+            for i in range(0, len(rows), _UPSERT_CHUNK):
+                stmt = insert(Device).values(rows[i:i + _UPSERT_CHUNK])
+                stmt = stmt.on_conflict_do_update(
+                    index_elements=[Device.user_id, Device.worker],
+                    set_={
+                        # Пустое имя заменяем воркером, заданное пользователем — сохраняем
+                        "name": func.coalesce(func.nullif(Device.name, ""), stmt.excluded.name),
+                        # Отключение без подключения в этом окне не стирает время подключения
+                        "last_connected_at": func.coalesce(stmt.excluded.last_connected_at, Device.last_connected_at),
+                        "last_seen_at": stmt.excluded.last_seen_at,
+                        "is_online": stmt.excluded.is_online,
+                    },
+                ).returning(Device.user_id, Device.worker, Device.name, Device.is_online)
+                for row in (await session.execute(stmt)).all():
+                    tg_id = tg_ids.get(row.user_id)
+                    if not row.is_online and tg_id and (row.user_id, row.worker) in was_online:
+                        offline.append((tg_id, row.name or row.worker or "Аппарат", row.worker))
+            await session.commit()
+            return offline
+        except Exception:
+            await session.rollback()
+            raise
+        finally:
+            await session.close()
+
+
+__all__ = ["DeviceStateWriter"]
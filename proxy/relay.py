@@ -0,0 +1,239 @@
+"""
+Пересылка строк между майнером и пулом на колбэках asyncio.BufferedProtocol.
+
+Соединения принимаются и устанавливаются как обычно (StreamReader/StreamWriter: рукопожатие,
+парковка, общий порт, подключение к пулу), после чего транспорты обоих сокетов переключаются
+на протоколы Relay. Данные читаются в заранее выделенный буфер (растёт только под длинные строки), строки режутся на месте,
+а подряд идущие строки без перехвата пересылаются одним transport.write. Вместо двух задач
+с readline()/drain() на каждую строку — колбэки цикла событий; обратное давление — через
+pause_reading/resume_reading противоположного сокета.
+"""
+import asyncio
+import logging
+from typing import Callable, Optional
+
+from config.settings import PROXY_RELAY_BUFFER
+
+logger = logging.getLogger(__name__)
+
+# Начальный размер буфера чтения: строки Stratum обычно короче, буфер растёт до PROXY_RELAY_BUFFER
+_INITIAL_BUFFER = 4096
+
+# Обработчик строки buf[start:end] (с переводом строки): None — переслать как есть,
+# b"" — пропустить, иначе — байты для отправки вместо строки
+LineHandler = Callable[[bytearray, int, int], Optional[bytes]]
+
+
+class _Side(asyncio.BufferedProtocol):
+    """Одна сторона пересылки: читает свой сокет и пишет строки в сокет peer."""
+
+    def __init__(self, relay: "Relay", name: str, on_line: LineHandler, limit: int):
+        self._relay: Optional[Relay] = relay
+        self.name = name
+        self._on_line = on_line
+        self._limit = limit
+        self._buf = bytearray(min(_INITIAL_BUFFER, limit))
+        self._view = memoryview(self._buf)
+        self._len = 0
+        self.transport: Optional[asyncio.Transport] = None
+        self.peer: Optional[_Side] = None
+        # Буфер записи нашего транспорта переполнен: чтение peer приостановлено
+        self.paused = False
+
+    def attach(self, transport: asyncio.Transport):
+        """Забирает транспорт у StreamReaderProtocol."""
+        self.transport = transport
+        transport.set_protocol(self)
+
+    def detach(self):
+        """Отключает сторону от пересылки (старый пул при горячем переключении)."""
+        self._relay = None
+        self.peer = None
+
+    def feed(self, data: bytes):
+        """Обрабатывает данные, полученные не через get_buffer (строки с парковки, остаток StreamReader)."""
+        view = memoryview(data)
+        while view and self._relay is not None:
+            n = min(len(view), len(self._buf) - self._len)
+            if not n:
+                break
+            self._buf[self._len:self._len + n] = view[:n]
+            view = view[n:]
+            self.buffer_updated(n)
+
+    def resume(self):
+        """StreamReader мог приостановить чтение при заполненном буфере — возобновляем, если peer не переполнен."""
+        transport = self.transport
+        if transport is not None and not transport.is_closing() and not transport.is_reading():
+            if self.peer is None or not self.peer.paused:
+                transport.resume_reading()
+
+    # --- asyncio.BufferedProtocol ---
+
+    def get_buffer(self, sizehint: int):
+        return self._view[self._len:]
+
+    def buffer_updated(self, nbytes: int):
+        self._len += nbytes
+        relay = self._relay
+        if relay is None:
+            self._len = 0
+            return
+        try:
+            self._process()
+        except Exception as e:
+            logger.error(f"Ошибка пересылки ({self.name}) для {relay.addr}: {e}")
+            relay.close()
+
+    def eof_received(self):
+        # False — транспорт закроется сам и вызовет connection_lost
+        return False
+
+    def connection_lost(self, exc: Optional[Exception]):
+        if self._relay is not None:
+            self._relay._lost(self, exc)
+
+    def pause_writing(self):
+        self.paused = True
+        if self.peer is not None and self.peer.transport is not None:
+            self.peer.transport.pause_reading()
+
+    def resume_writing(self):
+        self.paused = False
+        if self.peer is not None and self.peer.transport is not None:
+            self.peer.transport.resume_reading()
+
+    def _process(self):
+        buf, end = self._buf, self._len
+        write = self.peer.transport.write
+        start = run = 0
+        while True:
+            i = buf.find(b"\n", start, end)
+            if i < 0:
+                break
+            i += 1
+            out = self._on_line(buf, start, i)
+            if out is not None:
+                # Строка перехвачена: сначала пересылаем накопленные до неё строки как есть
+                if run < start:
+                    write(buf[run:start])
+                if out:
+                    write(out)
+                run = i
+            start = i
+        if run < start:
+            write(buf[run:start])
+        if start:
+            rest = end - start
+            if rest:
+                buf[:rest] = buf[start:end]
+            self._len = rest
+        elif end == len(buf):
+            if end < self._limit:
+                # Длинная строка (например, mining.notify с большим merkle) — увеличиваем буфер
+                self._buf = bytearray(min(end * 2, self._limit))
+                self._buf[:end] = buf
+                self._view = memoryview(self._buf)
+                return
+            # Строка длиннее предела (как превышение limit у StreamReader)
+            logger.warning(f"Строка длиннее {end} байт ({self.name}) от {self._relay.addr}. Закрываю соединение.")
+            self._len = 0
+            self._relay.close()
+
+
+class Relay:
+    """
+    Пересылка между майнером и пулом для одной сессии. Пул можно заменить на лету (replace_pool),
+    майнер при этом остаётся подключённым. wait_closed() завершается, когда закрыт майнер или текущий пул.
+    """
+
+    def __init__(self, addr, on_miner_line: LineHandler, on_pool_line: LineHandler, limit: int = PROXY_RELAY_BUFFER):
+        self.addr = addr
+        self._size = max(_INITIAL_BUFFER, limit)
+        self._on_pool_line = on_pool_line
+        self._closed = asyncio.get_running_loop().create_future()
+        self.miner = _Side(self, "майнер -> пул", on_miner_line, self._size)
+        self.pool: Optional[_Side] = None
+        self.error: Optional[Exception] = None
+
+    def start(self, miner_writer: asyncio.StreamWriter, pool_writer: asyncio.StreamWriter,
+              miner_pending: bytes = b"", pool_pending: bytes = b"", eof: bool = False):
+        """
+        Переключает оба сокета на пересылку. *_pending — данные, уже прочитанные из сокетов
+        (строки с парковки, остаток буфера StreamReader); eof — майнер уже закрыл соединение.
+        """
+        self.pool = _Side(self, "пул -> майнер", self._on_pool_line, self._size)
+        self.miner.peer, self.pool.peer = self.pool, self.miner
+        self.miner.attach(miner_writer.transport)
+        self.pool.attach(pool_writer.transport)
+        self.pool.feed(pool_pending)
+        self.miner.feed(miner_pending)
+        if eof:
+            # Как и в потоковом режиме: EOF майнера закрывает оба соединения (после отправки данных)
+            self.close()
+            return
+        self.miner.resume()
+        self.pool.resume()
+
+    def replace_pool(self, pool_writer: asyncio.StreamWriter, pool_pending: bytes = b""):
+        """Горячее переключение: новый пул подключается, старый отсоединяется (закрывает вызывающий)."""
+        old = self.pool
+        if old is not None:
+            old.detach()
+        self.pool = _Side(self, "пул -> майнер", self._on_pool_line, self._size)
+        self.pool.peer = self.miner
+        self.miner.peer = self.pool
+        self.pool.attach(pool_writer.transport)
+        if self.miner.paused:
+            pool_writer.transport.pause_reading()
+        self.pool.feed(pool_pending)
+        self.pool.resume()
+        # Чтение майнера могло быть приостановлено переполненным старым пулом
+        self.miner.resume()
+
+    async def wait_closed(self):
+        await asyncio.shield(self._closed)
+
+    def close(self):
+        for side in (self.miner, self.pool):
+            if side is not None and side.transport is not None:
+                side.transport.close()
+        self._finish()
+
+    def _lost(self, side: _Side, exc: Optional[Exception]):
+        if exc is not None and self.error is None:
+            self.error = exc
+        peer = side.peer
+        if peer is not None and peer.transport is not None:
+            peer.transport.close()
+        self._finish()
+
+    def _finish(self):
+        if not self._closed.done():
+            self._closed.set_result(None)
+
+
+def stream_buffer(reader: asyncio.StreamReader) -> bytearray:
+    """
+    Внутренний буфер StreamReader — приватный атрибут _buffer (bytearray в CPython asyncio).
+    Публичного способа забрать уже прочитанные из сокета байты нет, поэтому при его отсутствии
+    (другая реализация цикла событий или версия Python) — RuntimeError, а не потеря данных.
+    """
+    buf = getattr(reader, "_buffer", None)
+    if not isinstance(buf, bytearray):
+        raise RuntimeError(f"StreamReader без буфера _buffer ({type(reader).__name__}): пересылка на протоколах недоступна")
+    return buf
+
+
+def take_buffered(reader: asyncio.StreamReader) -> bytes:
+    """
+    Забирает данные, которые StreamReader уже прочитал из сокета, но ещё не отдал.
+    Читает приватный StreamReader._buffer (см. stream_buffer); без него — RuntimeError.
+    """
+    buf = stream_buffer(reader)
+    data = bytes(buf)
+    buf.clear()
+    return data
+
+
+__all__ = ["Relay", "stream_buffer", "take_buffered"]
@@ -1,15 +1,37 @@
 import asyncio
 import json
 import logging
-import datetime
+import random
 import re
-from typing import Dict, Set, Optional
+import socket
+import time
+from collections import deque
+from typing import TYPE_CHECKING, Awaitable, Callable, Dict, List, Set, Optional, Iterable, Tuple
 from aiohttp import web
+from sqlalchemy import select
 
-from aiogram import Bot
-from aiogram.enums import ParseMode
-from config.settings import PROXY_HOST, BOT_TOKEN, PROXY_API_HOST, PROXY_API_PORT, PROXY_API_TOKEN
-from db.models import init_db, get_session, User, Mode, Device
+from config.settings import (
+    PROXY_HOST, PROXY_API_HOST, PROXY_API_PORT, PROXY_API_TOKEN, MODE_RESYNC_INTERVAL,
+    MODE_SWITCH_STRATEGY, MODE_SWITCH_DRAIN_TIMEOUT, MODE_SWITCH_CONCURRENCY, PORT_RELOAD_CONCURRENCY,
+    RELOAD_DEBOUNCE_MS, UPSTREAM_CONNECT_TIMEOUT,
+    AGGREGATION_ENABLED, PROXY_REUSEPORT_PORTS, SCHEDULE_PREWARM_LEAD, SCHEDULE_PREWARM_MAX_SOCKETS,
+    UPSTREAM_WARM_MAX_AGE, SLEEP_PARK_MAX_SESSIONS, PROXY_SHARED_PORT, PROXY_SHARED_AUTH_TIMEOUT,
+    PROXY_SNAPSHOT_PATH, PROXY_RELAY_ENGINE,
+)
+from db.models import init_db, User, Mode
+from db.aio import get_async_session
+from db.changes import ModeChangeListener, decode_ports
+from proxy.upstream import UpstreamPool
+from proxy.aggregator import ShareAggregator
+from proxy.devices import DeviceStateWriter
+from proxy.switching import SwitchDispatcher
+from proxy.snapshot import ConfigSnapshot
+from proxy.relay import Relay, stream_buffer, take_buffered
+from proxy.supervisor import port_shard
+
+if TYPE_CHECKING:
+    # Модули бота загружаются только при создании уведомлений (см. __init__)
+    from bot.notifier import Notifier
 
 logger = logging.getLogger(__name__)
 
@@ -22,41 +44,146 @@ class StratumProxyServer:
       проксируем трафик к соответствующему пулу.
     - Перехватываем и переписываем "mining.authorize" так, чтобы логин майнера
       (User.login[.worker]) заменялся на логин/кошелёк пула (Mode.alias[.worker]).
-    - Предоставляем reload_port(port) для точечной перезагрузки порта после изменения режима/настроек.
+    - Предоставляем reload_port(port) для точечной перезагрузки порта после изменения режима/настроек:
+      слушающий сокет не закрывается, активные сессии переносятся на новый пул или дренируются.
+    - Опционально слушаем общий порт PROXY_SHARED_PORT: пользователь определяется по логину
+      из первого mining.authorize, дальше соединение обслуживается как подключение к его порту.
+    - Храним снимок конфигурации портов на диске (PROXY_SNAPSHOT_PATH): при старте порты
+      открываются из него, а сверка с БД выполняется, когда она станет доступна.
+    - Пересылка после подключения к пулу — на потоках (две задачи на соединение) или на колбэках
+      протоколов (PROXY_RELAY_ENGINE=protocol, см. proxy/relay.py); движок можно сменить на лету
+      через relay_engine, он применяется к новым соединениям.
     """
 
-    def __init__(self, host: str = PROXY_HOST):
+    def __init__(self, host: str = PROXY_HOST, notifier: Optional["Notifier"] = None, shard: Optional[Tuple[int, int]] = None):
         self.host = host
-        self._engine = init_db()
+        # (номер процесса, число процессов) в многопроцессном режиме: обслуживаем только свои порты
+        self._shard = shard
+        # Уведомления пользователям (оффлайн устройств): общий Bot и очередь с объединением
+        if notifier is None:
+            from bot.notifier import Notifier
+            notifier = Notifier()
+        self._notifier = notifier
+        # Снимок конфигурации портов на диске (у каждого процесса многопроцессного режима — свой)
+        self._snapshot: Optional[ConfigSnapshot] = None
+        if PROXY_SNAPSHOT_PATH:
+            path = PROXY_SNAPSHOT_PATH if shard is None else f"{PROXY_SNAPSHOT_PATH}.{shard[0]}"
+            self._snapshot = ConfigSnapshot(path, lambda: self._port_mode)
+        self._reconcile_task: Optional[asyncio.Task] = None
+        # Снимок читается сразу: если он загружен, недоступная БД не подменяется пустой локальной
+        # SQLite (порты работают по снимку); без снимка — прежний переход на SQLite
+        self._snapshot_confs = self._snapshot.load() if self._snapshot else None
+        self._engine = init_db(fallback=not self._snapshot_confs)
+        # Движок пересылки для новых соединений: streams или protocol
+        self.relay_engine = PROXY_RELAY_ENGINE
+        if self.relay_engine not in _RELAY_ENGINES:
+            logger.warning(f"Неизвестный PROXY_RELAY_ENGINE={self.relay_engine!r}, использую streams")
+            self.relay_engine = "streams"
         self._servers: Dict[int, asyncio.AbstractServer] = {}
         self._clients: Dict[int, Set[asyncio.Task]] = {}
+        # Активные проксируемые сессии по порту (для горячего переключения режима)
+        self._sessions: Dict[int, Set["_ClientSession"]] = {}
         # Учёт занятых воркеров по порту: базовая строка alias[.worker] -> счётчик
         self._active_workers: Dict[int, Dict[asyncio.Task, str]] = {}
         self._worker_counts: Dict[int, Dict[str, int]] = {}
         self._port_mode: Dict[int, dict] = {}
-        self._lock = asyncio.Lock()
+        # Режим, на который переведены активные сессии порта (кеш может уйти вперёд через set_port_mode)
+        self._port_applied: Dict[int, dict] = {}
+        # Индекс для общего порта: логин пользователя -> его порты
+        self._login_ports: Dict[str, Set[int]] = {}
+        self._shared_server: Optional[asyncio.AbstractServer] = None
+        # Подключения к общему порту, ещё не отправившие mining.authorize
+        self._shared_pending: Set[asyncio.Task] = set()
+        # Подключения к пулам: кеш DNS, тёплые сокеты, лимит одновременных подключений
+        self._upstreams = UpstreamPool()
+        # Общие upstream-сессии для режима агрегации (AGGREGATION_ENABLED)
+        self._aggregator = ShareAggregator(self)
+        # Фоновая пакетная запись состояния устройств (онлайн/оффлайн)
+        self._devices = DeviceStateWriter(on_offline=self._notify_offline)
+        # Переключения по уведомлениям об изменениях: ограничение темпа и нагрузки на пулы
+        self._switches = SwitchDispatcher(self.reload_port)
+        # Пулы предстоящих переключений по расписанию -> до какого времени (time.time()) держать коннектор
+        self._upcoming: Dict[Tuple[str, int], float] = {}
+        # Отложенный прогрев пула перед переключением: пул -> (таймер, момент срабатывания, число сокетов)
+        self._prewarm_timers: Dict[Tuple[str, int], Tuple[asyncio.TimerHandle, float, int]] = {}
+        # Припаркованные соединения портов в режиме сна и события их пробуждения
+        self._parked: Dict[int, int] = {}
+        self._parked_total = 0
+        self._park_events: Dict[int, asyncio.Event] = {}
+        # Блокировки по порту: операции над разными портами идут параллельно
+        self._port_locks: Dict[int, asyncio.Lock] = {}
+        # Очередь запросов перезагрузки: порт -> {"strategy", "waiters"}, объединяется в окне RELOAD_DEBOUNCE_MS
+        self._reload_pending: Dict[int, dict] = {}
+        self._reload_timer: Optional[asyncio.TimerHandle] = None
+        self._reload_tasks: Set[asyncio.Task] = set()
         self._watch_task: Optional[asyncio.Task] = None
+        # Очередь изменений конфигурации: множество портов или None (полная пересинхронизация)
+        self._changes: asyncio.Queue = asyncio.Queue()
+        self._change_listener: Optional[ModeChangeListener] = None
         self._running: bool = False
         self._http_runner: Optional[web.AppRunner] = None
         self._http_site: Optional[web.TCPSite] = None
 
     async def start(self):
-        """Запускает серверы для всех пользователей из БД."""
+        """
+        Запускает серверы для всех пользователей из БД: режимы всех портов загружаются
+        одним запросом, порты открываются параллельно. В лог пишется разбивка времени старта.
+        """
         logger.info("Инициализация StratumProxyServer...")
         self._running = True
-        session = get_session(self._engine)
-        try:
-            users = session.query(User).all()
-            if not users:
-                logger.warning("В БД нет пользователей. Прокси серверы не запущены.")
-                return
-            for user in users:
-                await self._start_port(user.port)
-            logger.info(f"Запущено портов: {len(self._servers)}")
-        finally:
-            session.close()
+        started = time.monotonic()
+        # Заполняем кеш port -> mode до открытия портов: из снимка на диске, если он есть, иначе из БД
+        confs, self._snapshot_confs = self._snapshot_confs, None
+        if confs is None and self._snapshot:
+            confs = self._snapshot.load()
+        from_snapshot = bool(confs)
+        if from_snapshot:
+            source = "снимок"
+        else:
+            source = "БД"
+            session = get_async_session()
+            try:
+                confs = await self._load_port_confs(session)
+            finally:
+                await session.close()
+        for port, conf in confs.items():
+            if self._owns_port(port):
+                self._set_port_conf(port, conf)
+        loaded = time.monotonic()
+        if not self._port_mode:
+            logger.warning("В БД нет пользователей. Прокси серверы не запущены.")
+        ports = list(self._port_mode.keys())
+        results = await asyncio.gather(
+            *(self._start_port(port, refresh=False, quiet=True) for port in ports), return_exceptions=True,
+        )
+        failed = [(port, res) for port, res in zip(ports, results) if isinstance(res, BaseException)]
+        for port, err in failed:
+            logger.error(f"Не удалось открыть порт {port}: {err}")
+        bound = time.monotonic()
+        logger.info(f"Запущено портов: {len(self._servers)}" + (f", ошибок: {len(failed)}" if failed else ""))
+        if PROXY_SHARED_PORT:
+            await self._start_shared_listener(PROXY_SHARED_PORT)
+        await self._sync_upstreams()
+        self._upstreams.start()
+        self._devices.start()
+        self._notifier.start()
+        self._switches.start()
+        ready = time.monotonic()
+        logger.info(f"Холодный старт за {ready - started:.3f} с: загрузка конфигурации ({source}) {loaded - started:.3f} с, "
+                    f"открытие портов {bound - loaded:.3f} с, запуск служб {ready - bound:.3f} с")
+        if from_snapshot:
+            self._reconcile_task = asyncio.create_task(self._reconcile_with_db())
+
+        # Подписка на уведомления об изменениях режимов
+        if self._change_listener is None:
+            try:
+                self._change_listener = ModeChangeListener(self._engine, self._on_mode_change)
+                await self._change_listener.start()
+            except Exception as e:
+                self._change_listener = None
+                logger.warning(f"Не удалось подписаться на изменения режимов: {e}")
 
-        # Запускаем фоновый монитор изменений активных режимов
+        # Запускаем фоновый обработчик изменений активных режимов
         if self._watch_task is None or self._watch_task.done():
             try:
                 self._watch_task = asyncio.create_task(self._watch_active_modes())
@@ -67,6 +194,15 @@ class StratumProxyServer:
         """Останавливает все серверы и активные клиентские соединения."""
         logger.info("Остановка всех портов прокси...")
         self._running = False
+        for timer, _, _ in self._prewarm_timers.values():
+            timer.cancel()
+        self._prewarm_timers.clear()
+        if self._change_listener:
+            try:
+                await self._change_listener.stop()
+            except Exception:
+                pass
+            self._change_listener = None
         if self._watch_task:
             try:
                 self._watch_task.cancel()
@@ -74,71 +210,437 @@ class StratumProxyServer:
             except Exception:
                 pass
             self._watch_task = None
-        # Копии ключей, чтобы безопасно итерироваться
-        for port in list(self._servers.keys()):
-            await self._stop_port(port)
+        if self._reconcile_task:
+            self._reconcile_task.cancel()
+            await asyncio.gather(self._reconcile_task, return_exceptions=True)
+            self._reconcile_task = None
+        # Снимок дописывается до остановки портов (остановка очищает кеш)
+        if self._snapshot:
+            await self._snapshot.close()
+        try:
+            await self._switches.close()
+        except Exception:
+            pass
+        await self._cancel_reloads()
+        await self._stop_shared_listener()
+        # Копии ключей, чтобы безопасно итерироваться; долгий дренаж одного порта не задерживает остальные
+        await self._for_ports(list(self._servers.keys()), self._stop_port)
+        try:
+            await self._aggregator.close()
+        except Exception:
+            pass
+        try:
+            await self._devices.close()
+        except Exception:
+            pass
+        try:
+            await self._notifier.close()
+        except Exception:
+            pass
+        try:
+            await self._upstreams.close()
+        except Exception:
+            pass
         try:
             await self.stop_http_api()
         except Exception:
             pass
         logger.info("Прокси-сервер остановлен")
 
-    async def reload_port(self, port: int):
-        """Точечная перезагрузка сервера на указанном порту."""
-        async with self._lock:
-            logger.info(f"Перезагрузка порта {port}...")
-            await self._stop_port(port)
-            await self._start_port(port)
-            logger.info(f"Порт {port} перезагружен")
+    async def reload_port(self, port: int, strategy: Optional[str] = None):
+        """
+        Точечная перезагрузка порта после изменения режима.
+        strategy: migrate | drain — горячее переключение без закрытия слушающего сокета
+        (см. _switch_sessions); restart — полная остановка и запуск порта. По умолчанию MODE_SWITCH_STRATEGY.
+        """
+        strategy = strategy or MODE_SWITCH_STRATEGY
+        async with self._port_lock(port):
+            logger.info(f"Перезагрузка порта {port} (strategy={strategy})...")
+            if strategy == "restart" or port not in self._servers:
+                await self._stop_port(port)
+                await self._start_port(port)
+                logger.info(f"Порт {port} перезагружен")
+                return
+            new_conf = await self._fetch_port_conf(port)
+            if new_conf is None:
+                logger.warning(f"Пользователь для порта {port} не найден. Останавливаю порт.")
+                await self._stop_port(port)
+                return
+            # Новые подключения сразу идут по новому режиму
+            self._set_port_conf(port, new_conf)
+            self._port_applied[port] = new_conf
+            if not _is_sleep_conf(new_conf):
+                self._upstreams.prewarm(new_conf["host"], int(new_conf["port"]), self._miner_count(port))
+            self._wake_parked(port)
+            # Перенос сессий — тоже под блокировкой порта: иначе перекрывающиеся перезагрузки
+            # переносят одни и те же сессии одновременно и устаревший режим может завершиться последним
+            await self._switch_sessions(port, new_conf, strategy)
+        await self._sync_upstreams()
+        logger.info(f"Порт {port} переключён на режим {new_conf.get('mode_name')}")
+
+    async def request_reload(self, port: int, strategy: Optional[str] = None) -> bool:
+        """
+        Перезагрузка порта через очередь: запросы к одному порту в пределах RELOAD_DEBOUNCE_MS
+        объединяются, а порт, конфигурация которого в БД совпадает с кешем, не перезагружается
+        (кроме strategy=restart). Возвращает True, если порт был перезагружен.
+        """
+        loop = asyncio.get_running_loop()
+        entry = self._reload_pending.get(port)
+        if entry is None:
+            entry = self._reload_pending[port] = {"strategy": strategy, "waiters": []}
+        elif strategy == "restart" or entry["strategy"] is None:
+            # Полный перезапуск поглощает более мягкие запросы
+            entry["strategy"] = strategy
+        waiter = loop.create_future()
+        entry["waiters"].append(waiter)
+        if self._reload_timer is None:
+            self._reload_timer = loop.call_later(max(0, RELOAD_DEBOUNCE_MS) / 1000.0, self._start_reload_flush)
+        return await asyncio.shield(waiter)
+
+    def _start_reload_flush(self):
+        self._reload_timer = None
+        pending, self._reload_pending = self._reload_pending, {}
+        task = asyncio.create_task(self._flush_reloads(pending))
+        self._reload_tasks.add(task)
+        task.add_done_callback(self._reload_tasks.discard)
+
+    async def _flush_reloads(self, pending: Dict[int, dict]):
+        """Одним запросом сверяет порты из очереди с БД и перезагружает только изменившиеся."""
+        def _resolve(port: int, result=None, error: Optional[BaseException] = None):
+            for waiter in pending[port]["waiters"]:
+                if waiter.done():
+                    continue
+                if error is not None:
+                    waiter.set_exception(error)
+                else:
+                    waiter.set_result(result)
+
+        try:
+            session = get_async_session()
+            try:
+                now_map = await self._load_port_confs(session, pending)
+            finally:
+                await session.close()
+        except Exception as e:
+            logger.warning(f"Не удалось загрузить конфигурацию портов для перезагрузки: {e}")
+            for port in pending:
+                _resolve(port, error=e)
+            return
+
+        reloaded: Set[int] = set()
+
+        async def _one(port: int):
+            strategy = pending[port]["strategy"]
+            conf = now_map.get(port)
+            if port in self._servers:
+                # Сравниваем с режимом активных сессий: после invalidate_port кеш уже новый, а сессии — нет
+                unchanged = conf == self._port_applied.get(port)
+            else:
+                unchanged = conf is None
+            if unchanged and strategy != "restart":
+                logger.debug(f"Конфигурация порта {port} не изменилась, перезагрузка пропущена")
+                return
+            await self.reload_port(port, strategy=strategy)
+            reloaded.add(port)
+
+        errors = await self._for_ports(pending, _one)
+        for port in pending:
+            if port in errors:
+                _resolve(port, error=RuntimeError(errors[port]))
+            else:
+                _resolve(port, port in reloaded)
+        if len(pending) > 1:
+            logger.info(f"Очередь перезагрузок: запросов для {len(pending)} портов, перезагружено {len(reloaded)}, "
+                        f"ошибок {len(errors)}")
+
+    async def _cancel_reloads(self):
+        if self._reload_timer is not None:
+            self._reload_timer.cancel()
+            self._reload_timer = None
+        pending, self._reload_pending = self._reload_pending, {}
+        for entry in pending.values():
+            for waiter in entry["waiters"]:
+                if not waiter.done():
+                    waiter.cancel()
+        tasks = list(self._reload_tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def reload_ports(self, ports: Iterable[int], strategy: Optional[str] = None) -> Dict[int, str]:
+        """
+        Массовая перезагрузка портов: не более PORT_RELOAD_CONCURRENCY одновременно.
+        Возвращает ошибки по портам (пустой словарь — все порты перезагружены).
+        """
+        return await self._for_ports(ports, lambda p: self.reload_port(p, strategy=strategy))
 
     async def start_port(self, port: int):
-        async with self._lock:
+        async with self._port_lock(port):
             await self._start_port(port)
             logger.info(f"Порт {port} запущен")
 
     async def stop_port(self, port: int):
-        async with self._lock:
+        async with self._port_lock(port):
             await self._stop_port(port)
             logger.info(f"Порт {port} остановлен")
 
-    async def _start_port(self, port: int):
-        """Запуск прослушивания указанного порта, если для него существует пользователь."""
-        session = get_session(self._engine)
+    def _port_lock(self, port: int) -> asyncio.Lock:
+        lock = self._port_locks.get(port)
+        if lock is None:
+            lock = asyncio.Lock()
+            self._port_locks[port] = lock
+        return lock
+
+    async def _for_ports(self, ports: Iterable[int], action: Callable[[int], Awaitable[None]]) -> Dict[int, str]:
+        """Выполняет action для каждого порта, не более PORT_RELOAD_CONCURRENCY одновременно."""
+        ports = list(dict.fromkeys(int(p) for p in ports))
+        sem = asyncio.Semaphore(max(1, PORT_RELOAD_CONCURRENCY))
+        errors: Dict[int, str] = {}
+
+        async def _one(port: int):
+            async with sem:
+                try:
+                    await action(port)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    errors[port] = str(e) or type(e).__name__
+                    logger.warning(f"Ошибка операции над портом {port}: {e}")
+
+        await asyncio.gather(*(_one(p) for p in ports))
+        return errors
+
+    @staticmethod
+    def _build_conf(row) -> dict:
+        """Собирает запись кеша режима порта из строки запроса _load_port_confs (пользователь и активный режим)."""
+        if row.mode_id is not None:
+            return {
+                "host": row.host,
+                "port": row.mode_port,
+                "alias": row.alias,
+                "mode_name": row.mode_name,
+                "login": row.login,
+            }
+        return {
+            "host": "sleep",
+            "port": 0,
+            "alias": "",
+            "mode_name": "sleep",
+            "login": row.login,
+        }
+
+    def _owns_port(self, port: int) -> bool:
+        """Обслуживает ли этот процесс порт (в однопроцессном режиме — все порты)."""
+        if self._shard is None or port in PROXY_REUSEPORT_PORTS:
+            return True
+        index, workers = self._shard
+        return port_shard(port, workers) == index
+
+    async def _load_port_confs(self, session, ports: Optional[Iterable[int]] = None) -> Dict[int, dict]:
+        """
+        Одним запросом загружает пользователей с активными режимами (всех или указанных портов).
+        Выбираются только нужные колонки, без построения ORM-объектов.
+        """
+        q = select(
+            User.port, User.login, Mode.id.label("mode_id"), Mode.name.label("mode_name"),
+            Mode.host, Mode.port.label("mode_port"), Mode.alias,
+        ).outerjoin(Mode, Mode.id == User.active_mode_id)
+        if ports is not None:
+            q = q.where(User.port.in_(list(ports)))
+        result: Dict[int, dict] = {}
+        for row in (await session.execute(q)).all():
+            if not self._owns_port(row.port):
+                continue
+            result[row.port] = self._build_conf(row)
+        return result
+
+    async def _fetch_port_conf(self, port: int) -> Optional[dict]:
+        """Загружает конфигурацию порта из БД. None — пользователь для порта не найден."""
+        session = get_async_session()
         try:
-            user = session.query(User).filter(User.port == port).first()
-            if not user:
+            return (await self._load_port_confs(session, [port])).get(port)
+        finally:
+            await session.close()
+
+    async def _sync_upstreams(self):
+        """Держит коннекторы (и тёплые сокеты) только для пулов активных режимов и предстоящих переключений."""
+        upstreams = {(c["host"], int(c["port"])) for c in self._port_mode.values() if not _is_sleep_conf(c)}
+        for host, port in upstreams:
+            self._upstreams.prewarm(host, port)
+        now = time.time()
+        self._upcoming = {key: until for key, until in self._upcoming.items() if until > now}
+        await self._upstreams.retain(upstreams | set(self._upcoming))
+
+    async def prewarm_transitions(self, transitions: Iterable[dict]) -> int:
+        """
+        Готовит соединения к пулам, на которые порты переключатся по расписанию.
+        transitions: {"port", "host", "pool_port", "at"}, at — время переключения (unix time).
+        За SCHEDULE_PREWARM_LEAD секунд до переключения к пулу открывается по тёплому сокету
+        на каждого майнера переключаемых портов (не больше SCHEDULE_PREWARM_MAX_SOCKETS на пул).
+        Возвращает число пулов, для которых запланирован прогрев.
+        """
+        now = time.time()
+        # пул -> (число сокетов, самое раннее переключение)
+        plan: Dict[Tuple[str, int], Tuple[int, float]] = {}
+        for t in transitions:
+            port = int(t["port"])
+            upstream = (str(t["host"]), int(t["pool_port"]))
+            at = float(t["at"])
+            miners = self._miner_count(port)
+            if not miners or port not in self._servers or not self._owns_port(port):
+                continue
+            conf = self._port_mode.get(port)
+            if conf and not _is_sleep_conf(conf) and (conf["host"], int(conf["port"])) == upstream:
+                continue
+            count, first_at = plan.get(upstream, (0, at))
+            plan[upstream] = (count + miners, min(first_at, at))
+        loop = asyncio.get_running_loop()
+        for upstream, (count, at) in plan.items():
+            # Коннектор не должен закрыться до переключения (с запасом на очередь переключений)
+            self._upcoming[upstream] = max(self._upcoming.get(upstream, 0.0), at + UPSTREAM_WARM_MAX_AGE)
+            when = at - SCHEDULE_PREWARM_LEAD
+            count = min(count, SCHEDULE_PREWARM_MAX_SOCKETS)
+            pending = self._prewarm_timers.pop(upstream, None)
+            if pending is not None:
+                # Новый план для того же пула заменяет прежний таймер: раньший момент, больший запас
+                timer, pending_when, pending_count = pending
+                timer.cancel()
+                when, count = min(when, pending_when), max(count, pending_count)
+            delay = max(0.0, when - now)
+            timer = loop.call_later(delay, self._fire_prewarm, upstream, count)
+            self._prewarm_timers[upstream] = (timer, when, count)
+            logger.debug(f"Прогрев {upstream[0]}:{upstream[1]} ({count} сокетов) через {delay:.1f} с")
+        return len(plan)
+
+    def _fire_prewarm(self, upstream: Tuple[str, int], count: int):
+        self._prewarm_timers.pop(upstream, None)
+        if self._running:
+            self._upstreams.prewarm(upstream[0], upstream[1], count)
+
+    def get_port_mode(self, port: int) -> Optional[dict]:
+        """Текущая запись кеша режима для порта (без обращения к БД)."""
+        return self._port_mode.get(port)
+
+    def set_port_mode(self, port: int, conf: dict) -> bool:
+        """
+        Явно обновляет кеш режима порта (для ленты изменений).
+        Новые подключения сразу пойдут по новому режиму; активные сессии не трогаются
+        и переводятся следующей перезагрузкой порта (reload_port / request_reload / лента изменений).
+        Возвращает True, если запись изменилась.
+        """
+        old = self._port_mode.get(port)
+        if old == conf:
+            return False
+        self._set_port_conf(port, dict(conf))
+        logger.info(f"Кеш режима порта {port} обновлён: {old} -> {conf}")
+        self._wake_parked(port)
+        return True
+
+    def _set_port_conf(self, port: int, conf: dict):
+        """Записывает режим порта в кеш, обновляет индекс логинов общего порта и снимок на диске."""
+        old = self._port_mode.get(port)
+        self._port_mode[port] = conf
+        if old != conf:
+            self._snapshot_changed()
+        old_login = old.get("login") if old else None
+        if old_login != conf.get("login"):
+            self._unindex_login(old_login, port)
+        login = conf.get("login")
+        if login:
+            ports = self._login_ports.setdefault(login, set())
+            ports.add(port)
+            if len(ports) > 1:
+                logger.warning(f"Логин {login} используется портами {sorted(ports)}: "
+                               f"общий порт направит майнеров на {min(ports)}")
+
+    def _drop_port_conf(self, port: int):
+        old = self._port_mode.pop(port, None)
+        if old:
+            self._unindex_login(old.get("login"), port)
+            self._snapshot_changed()
+
+    def _snapshot_changed(self):
+        # При остановке кеш очищается — это не изменение конфигурации
+        if self._snapshot is not None and self._running:
+            self._snapshot.mark_dirty()
+
+    async def _reconcile_with_db(self):
+        """Сверяет порты, открытые из снимка, с БД; пока БД недоступна, повторяет попытки."""
+        delay = 1.0
+        while self._running:
+            try:
+                session = get_async_session()
+                try:
+                    now_map = await self._load_port_confs(session)
+                finally:
+                    await session.close()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"БД недоступна, порты работают по снимку конфигурации: {e}. Повтор через {delay:.0f} с")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 30.0)
+                continue
+            await self._apply_port_confs(now_map, sorted(set(now_map) | set(self._servers)))
+            logger.info(f"Конфигурация портов сверена с БД: портов {len(now_map)}")
+            return
+
+    def _unindex_login(self, login: Optional[str], port: int):
+        ports = self._login_ports.get(login) if login else None
+        if ports is None:
+            return
+        ports.discard(port)
+        if not ports:
+            self._login_ports.pop(login, None)
+
+    def port_for_login(self, login: str) -> Optional[int]:
+        """Порт пользователя по логину майнера (часть до первой точки); None — логин неизвестен."""
+        ports = self._login_ports.get(login.split(".", 1)[0])
+        return min(ports) if ports else None
+
+    async def invalidate_port(self, port: int) -> bool:
+        """
+        Инвалидирует кеш режима порта: перечитывает его из БД без перезапуска сервера.
+        Возвращает True, если конфигурация изменилась.
+        """
+        conf = await self._fetch_port_conf(port)
+        if conf is None:
+            self._drop_port_conf(port)
+            logger.warning(f"Пользователь для порта {port} не найден. Запись кеша удалена.")
+            return False
+        return self.set_port_mode(port, conf)
+
+    async def _start_port(self, port: int, refresh: bool = True, quiet: bool = False):
+        """
+        Запуск прослушивания указанного порта, если для него существует пользователь.
+        refresh=False — использовать уже заполненный кеш режима без запроса к БД.
+        quiet=True — не писать открытие порта в лог на уровне INFO (массовый старт).
+        """
+        if not self._owns_port(port):
+            logger.info(f"Порт {port} обслуживает другой процесс. Пропускаю запуск.")
+            return
+        if refresh or port not in self._port_mode:
+            conf = await self._fetch_port_conf(port)
+            if conf is None:
                 logger.warning(f"Пользователь для порта {port} не найден. Пропускаю запуск.")
                 return
-            active_mode: Optional[Mode] = session.query(Mode).filter(Mode.user_id == user.id, Mode.is_active == 1).first()
-            if active_mode:
-                self._port_mode[port] = {
-                    "host": active_mode.host,
-                    "port": active_mode.port,
-                    "alias": active_mode.alias,
-                    "mode_name": active_mode.name,
-                    "login": user.login,
-                }
-            else:
-                self._port_mode[port] = {
-                    "host": "sleep",
-                    "port": 0,
-                    "alias": "",
-                    "mode_name": "sleep",
-                    "login": user.login,
-                }
-        finally:
-            session.close()
+            self._set_port_conf(port, conf)
 
         # Уже запущен
         if port in self._servers:
             logger.info(f"Порт {port} уже запущен. Пропускаю старт.")
             return
 
-        server = await asyncio.start_server(lambda r, w: self._handle_client(r, w, port), self.host, port)
+        # Нагруженный порт слушают все процессы, ядро распределяет подключения между ними
+        reuse_port = self._shard is not None and port in PROXY_REUSEPORT_PORTS
+        server = await asyncio.start_server(
+            lambda r, w: self._handle_client(r, w, port), self.host, port, reuse_port=reuse_port or None,
+        )
         self._servers[port] = server
+        self._port_applied[port] = self._port_mode[port]
         self._clients.setdefault(port, set())
         addr = server.sockets[0].getsockname() if server.sockets else (self.host, port)
-        logger.info(f"Слушаю {addr} для пользователя порта {port}")
+        logger.log(logging.DEBUG if quiet else logging.INFO, f"Слушаю {addr} для пользователя порта {port}")
 
     async def _stop_port(self, port: int):
         """Остановка прослушивания порта и завершение клиентских соединений."""
@@ -164,9 +666,12 @@ class StratumProxyServer:
             except Exception:
                 pass
         # Очистить учёт воркеров
+        self._sessions.pop(port, None)
         self._active_workers.pop(port, None)
         self._worker_counts.pop(port, None)
-        self._port_mode.pop(port, None)
+        self._drop_port_conf(port)
+        self._port_applied.pop(port, None)
+        self._park_events.pop(port, None)
         logger.info(f"Порт {port} остановлен")
 
     async def start_http_api(self, host: str = PROXY_API_HOST, port: int = PROXY_API_PORT, token: Optional[str] = PROXY_API_TOKEN):
@@ -190,7 +695,14 @@ class StratumProxyServer:
             if err:
                 return err
             ports = sorted(list(self._servers.keys()))
-            return web.json_response({"ports": ports})
+            clients = sum(len(tasks) for tasks in self._clients.values())
+            return web.json_response({
+                "ports": ports,
+                "clients": clients,
+                "parked": self._parked_total,
+                "relay": self.relay_engine,
+                "switches": self._switches.stats(),
+            })
 
         async def reload_port_handler(request):
             err = await _auth(request)
@@ -198,8 +710,34 @@ class StratumProxyServer:
                 return err
             data = await request.json()
             p = int(data.get("port"))
-            await self.reload_port(p)
-            return web.json_response({"result": "reloaded", "port": p})
+            changed = await self.request_reload(p, strategy=data.get("strategy"))
+            return web.json_response({"result": "reloaded", "port": p, "changed": changed})
+
+        async def reload_ports_handler(request):
+            err = await _auth(request)
+            if err:
+                return err
+            data = await request.json()
+            ports = [int(p) for p in data.get("ports") or []]
+            errors = await self.reload_ports(ports, strategy=data.get("strategy"))
+            return web.json_response({"result": "reloaded", "ports": len(ports), "errors": errors})
+
+        async def invalidate_port_handler(request):
+            err = await _auth(request)
+            if err:
+                return err
+            data = await request.json()
+            p = int(data.get("port"))
+            changed = await self.invalidate_port(p)
+            return web.json_response({"result": "invalidated", "port": p, "changed": changed})
+
+        async def prewarm_handler(request):
+            err = await _auth(request)
+            if err:
+                return err
+            data = await request.json()
+            pools = await self.prewarm_transitions(data.get("transitions") or [])
+            return web.json_response({"result": "scheduled", "pools": pools})
 
         async def start_port_handler(request):
             err = await _auth(request)
@@ -223,8 +761,11 @@ class StratumProxyServer:
             web.get("/health", health),
             web.get("/status", status),
             web.post("/reload-port", reload_port_handler),
+            web.post("/reload-ports", reload_ports_handler),
+            web.post("/invalidate-port", invalidate_port_handler),
             web.post("/start-port", start_port_handler),
             web.post("/stop-port", stop_port_handler),
+            web.post("/prewarm", prewarm_handler),
         ])
 
         self._http_runner = web.AppRunner(app)
@@ -247,351 +788,864 @@ class StratumProxyServer:
                 pass
             self._http_runner = None
 
+    def _on_mode_change(self, payload: str):
+        """Колбэк канала уведомлений: ставит изменившиеся порты в очередь обработки."""
+        self._changes.put_nowait(decode_ports(payload))
+
+    async def _apply_port_confs(self, now_map: Dict[int, dict], ports: Iterable[int]):
+        """
+        Приводит указанные порты к конфигурации now_map: старт, остановка или перезагрузка.
+        Старты и остановки выполняются параллельно (PORT_RELOAD_CONCURRENCY), переключения
+        режимов уходят в очередь переключений.
+        """
+        async def _apply(port: int):
+            new_conf = now_map.get(port)
+            if new_conf is None:
+                if port in self._servers:
+                    logger.info(f"Пользователь для порта {port} больше не найден. Останавливаю порт.")
+                    await self.stop_port(port)
+            elif port not in self._servers:
+                # Появился новый пользователь (новый порт)
+                async with self._port_lock(port):
+                    self._set_port_conf(port, new_conf)
+                    await self._start_port(port, refresh=False)
+            elif self._port_applied.get(port) != new_conf:
+                logger.info(f"Обнаружено изменение режима на порту {port}: {self._port_applied.get(port)} -> {new_conf}. Перезагружаю порт.")
+                pool = None if _is_sleep_conf(new_conf) else (new_conf["host"], int(new_conf["port"]))
+                self._switches.submit(port, pool)
+
+        await self._for_ports(ports, _apply)
+        await self._sync_upstreams()
+
     async def _watch_active_modes(self):
-        """Периодически проверяет активные режимы в БД и перезагружает изменившиеся порты."""
+        """
+        Применяет изменения активных режимов по уведомлениям (только изменившиеся порты).
+        Раз в MODE_RESYNC_INTERVAL секунд выполняет полную сверку с БД одним запросом.
+        """
         while True:
             try:
-                # Останавливаемся, если сервер не в состоянии running
-                if not getattr(self, "_running", False):
-                    await asyncio.sleep(1)
+                try:
+                    item = await asyncio.wait_for(self._changes.get(), MODE_RESYNC_INTERVAL or None)
+                except asyncio.TimeoutError:
+                    item = None
+                if item is not None and RELOAD_DEBOUNCE_MS > 0:
+                    # Даём догнать уведомлениям о том же изменении (бот, API, планировщик)
+                    await asyncio.sleep(RELOAD_DEBOUNCE_MS / 1000.0)
+                # Схлопываем накопившиеся уведомления в один проход
+                full = item is None
+                ports: Set[int] = set(item or ())
+                while not self._changes.empty():
+                    nxt = self._changes.get_nowait()
+                    if nxt is None:
+                        full = True
+                    else:
+                        ports |= nxt
+                if not self._running:
                     continue
-                session = get_session(self._engine)
+
+                session = get_async_session()
                 try:
-                    users = session.query(User).all()
-                    now_map = {}
-                    for u in users:
-                        m = session.query(Mode).filter(Mode.user_id == u.id, Mode.is_active == 1).first()
-                        if m:
-                            now_map[u.port] = {
-                                "host": m.host,
-                                "port": m.port,
-                                "alias": m.alias,
-                                "mode_name": m.name,
-                                "login": u.login,
-                            }
-                        else:
-                            now_map[u.port] = {
-                                "host": "sleep",
-                                "port": 0,
-                                "alias": "",
-                                "mode_name": "sleep",
-                                "login": u.login,
-                            }
+                    now_map = await self._load_port_confs(session, None if full else ports)
                 finally:
                     try:
-                        session.close()
+                        await session.close()
                     except Exception:
                         pass
-
-                # Сравниваем и перезагружаем только изменившиеся порты
-                for port, new_conf in now_map.items():
-                    old_conf = self._port_mode.get(port)
-                    if old_conf != new_conf:
-                        logger.info(f"Обнаружено изменение режима на порту {port}: {old_conf} -> {new_conf}. Перезагружаю порт.")
-                        try:
-                            await self.reload_port(port)
-                        except Exception as e:
-                            logger.warning(f"Ошибка перезагрузки порта {port}: {e}")
-
-                # Если появился новый пользователь (новый порт), запускаем его
-                for port in now_map.keys():
-                    if port not in self._servers:
-                        try:
-                            await self._start_port(port)
-                        except Exception as e:
-                            logger.warning(f"Не удалось запустить новый порт {port}: {e}")
-
-                await asyncio.sleep(5)
+                scope = set(now_map.keys()) | set(self._servers.keys()) if full else ports
+                await self._apply_port_confs(now_map, sorted(scope))
             except asyncio.CancelledError:
                 break
             except Exception as e:
                 logger.warning(f"Ошибка в мониторинге активных режимов: {e}")
                 await asyncio.sleep(5)
 
+    def _rewrite_authorize(self, sess: "_ClientSession", msg: dict, alias_login: str):
+        """
+        Переписывает логин в mining.authorize на alias[.worker] с учётом уникальности воркеров на порту.
+        Возвращает (original, new_user, worker) или None, если переписывать нечего.
+        """
+        port = sess.port
+        params = msg.get("params", [])
+        if not (params and isinstance(params[0], str) and alias_login):
+            return None
+        original = params[0]
+        if "." in original:
+            miner_login, worker = original.split(".", 1)
+        else:
+            miner_login, worker = original, ""
+
+        # Базовое желаемое имя (без уникализации)
+        base_desired = f"{alias_login}.{worker}" if worker else alias_login
+
+        # Учёт уникальности воркеров на порту
+        counts = self._worker_counts.setdefault(port, {})
+        active_map = self._active_workers.setdefault(port, {})
+        prev_base = active_map.get(sess.task)
+        if prev_base == base_desired:
+            # Повторный authorize того же воркера (или перенос на пул с тем же alias) — счётчик уже учтён
+            usage = sess.worker_usage or 1
+        else:
+            if prev_base:
+                # клиент сменил воркера — скорректируем счётчики
+                prev_count = counts.get(prev_base, 0)
+                if prev_count > 1:
+                    counts[prev_base] = prev_count - 1
+                elif prev_count == 1:
+                    counts.pop(prev_base, None)
+            usage = counts.get(base_desired, 0) + 1
+            counts[base_desired] = usage
+            active_map[sess.task] = base_desired
+            sess.worker_usage = usage
+
+        if usage == 1:
+            new_user = base_desired
+        else:
+            # Добавляем суффикс -2, -3... чтобы пул не разрывал первое соединение
+            if worker:
+                new_user = f"{alias_login}.{worker}-{usage}"
+            else:
+                new_user = f"{alias_login}-{usage}"
+
+        msg["params"][0] = new_user
+        return original, new_user, worker
+
+    def _restore_worker(self, sess: "_ClientSession", base: Optional[str], usage: int):
+        """Возвращает учёт воркера сессии к base (откат _rewrite_authorize при неудачном переносе)."""
+        counts = self._worker_counts.get(sess.port)
+        active_map = self._active_workers.get(sess.port)
+        if counts is None or active_map is None:
+            return
+        current = active_map.get(sess.task)
+        if current != base:
+            if current:
+                c = counts.get(current, 0)
+                if c > 1:
+                    counts[current] = c - 1
+                elif c == 1:
+                    counts.pop(current, None)
+            if base:
+                counts[base] = counts.get(base, 0) + 1
+                active_map[sess.task] = base
+            else:
+                active_map.pop(sess.task, None)
+        sess.worker_usage = usage
+
+    def _upsert_device(self, port: int, worker: str):
+        """Отмечает устройство онлайн; запись в БД выполняет фоновый DeviceStateWriter."""
+        self._devices.mark_online(port, worker)
+
+    async def _notify_offline(self, events):
+        """Ставит уведомления об устройствах, ушедших в оффлайн, в очередь Notifier."""
+        for tg_id, name, worker in events:
+            self._notifier.notify_offline(tg_id, name, worker)
+
     async def _handle_client(self, miner_reader: asyncio.StreamReader, miner_writer: asyncio.StreamWriter, port: int):
         addr = miner_writer.get_extra_info('peername')
         client_task = asyncio.current_task()
         self._clients.setdefault(port, set()).add(client_task)
-        logger.info(f"Подключен майнер {addr} -> порт {port}")
 
-        # Актуализируем активный режим из БД, чтобы не требовалась перезагрузка
+        # Активный режим берём только из кеша порта (без запросов к БД);
+        # кеш обновляется через reload_port / invalidate_port / монитор изменений
+        cached = self._port_mode.get(port)
+        if _is_sleep_conf(cached):
+            lines = None
+            if self._parked_total < SLEEP_PARK_MAX_SESSIONS:
+                try:
+                    lines = await self._park_client(miner_reader, miner_writer, port, addr)
+                except asyncio.CancelledError:
+                    miner_writer.close()
+                    self._clients.get(port, set()).discard(client_task)
+                    raise
+            else:
+                logger.info(f"Майнер {addr}: активный режим 'sleep' для пользователя порт {port}. Закрываю соединение.")
+                try:
+                    msg = {"id": None, "result": None, "error": {"code": -1, "message": "proxy sleep"}}
+                    miner_writer.write((json.dumps(msg) + "\n").encode())
+                    await miner_writer.drain()
+                except Exception:
+                    pass
+            if lines is None:
+                try:
+                    miner_writer.close()
+                    await miner_writer.wait_closed()
+                except Exception:
+                    pass
+                self._clients.get(port, set()).discard(client_task)
+                return
+            cached = self._port_mode.get(port)
+            if lines:
+                # Строки, полученные на парковке, обрабатываются первыми
+                miner_reader = _ReplayReader(lines, miner_reader)
+            logger.info(f"Майнер {addr}: режим порта {port} активен, подключение с парковки")
+        else:
+            logger.info(f"Подключен майнер {addr} -> порт {port}")
+
+        sess = _ClientSession(port, addr, client_task, miner_reader, miner_writer)
+        sess.conf = cached
+        self._sessions.setdefault(port, set()).add(sess)
         try:
-            session = get_session(self._engine)
-            u = session.query(User).filter(User.port == port).first()
-            if u:
-                m = session.query(Mode).filter(Mode.user_id == u.id, Mode.is_active == 1).first()
-                if m:
-                    self._port_mode[port] = {
-                        "host": m.host,
-                        "port": m.port,
-                        "alias": m.alias,
-                        "mode_name": m.name,
-                        "login": u.login,
-                    }
-                else:
-                    self._port_mode[port] = {
-                        "host": "sleep",
-                        "port": 0,
-                        "alias": "",
-                        "mode_name": "sleep",
-                        "login": u.login,
-                    }
+            # Режим агрегации: майнер разделяет общее upstream-соединение с другими майнерами порта
+            if AGGREGATION_ENABLED and await self._aggregator.serve(sess):
+                return
+
+            host = cached.get("host")
+            upstream_port = int(cached.get("port"))
+            logger.info(f"Майнер {addr}: подключаем к пулу {host}:{upstream_port} (mode={cached.get('mode_name')})")
+
+            # Подключаемся к пулу
+            try:
+                pool_reader, pool_writer = await self._upstreams.connect(host, upstream_port)
+            except Exception as e:
+                logger.error(f"Майнер {addr}: не удалось подключиться к пулу {host}:{upstream_port}: {e}")
+                miner_writer.close()
+                try:
+                    await miner_writer.wait_closed()
+                except Exception:
+                    pass
+                return
+
+            sess.pool_reader, sess.pool_writer = pool_reader, pool_writer
+            if self.relay_engine == "protocol" and await self._relay_session(sess):
+                return
+            sess.pool_task = asyncio.create_task(self._forward_to_miner(sess, pool_reader))
+            await self._forward_to_pool(sess)
+        finally:
+            if sess.relay is not None:
+                sess.relay.close()
+            if sess.pool_task and not sess.pool_task.done():
+                sess.pool_task.cancel()
+            if sess.pool_task:
+                await asyncio.gather(sess.pool_task, return_exceptions=True)
+            await self._release_session(sess)
+
+    async def _start_shared_listener(self, port: int):
+        if self._shard is not None:
+            logger.warning(f"Общий порт {port} не поддерживается в многопроцессном режиме. Пропускаю запуск.")
+            return
+        if port in self._port_mode:
+            logger.warning(f"Общий порт {port} совпадает с портом пользователя. Пропускаю запуск.")
+            return
+        try:
+            self._shared_server = await asyncio.start_server(self._handle_shared_client, self.host, port)
+        except Exception as e:
+            logger.error(f"Не удалось открыть общий порт {port}: {e}")
+            return
+        logger.info(f"Слушаю общий порт {port} (маршрутизация по логину майнера)")
+
+    async def _stop_shared_listener(self):
+        server, self._shared_server = self._shared_server, None
+        if server:
+            try:
+                server.close()
+                await server.wait_closed()
+            except Exception as e:
+                logger.warning(f"Ошибка при закрытии общего порта: {e}")
+        tasks = list(self._shared_pending)
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _handle_shared_client(self, miner_reader: asyncio.StreamReader, miner_writer: asyncio.StreamWriter):
+        """
+        Подключение к общему порту: строки майнера копятся до первого mining.authorize,
+        по логину из него определяется пользователь, и соединение обслуживается как подключение
+        к его порту (с воспроизведением накопленных строк). Пул подключается только после этого.
+        """
+        addr = miner_writer.get_extra_info('peername')
+        task = asyncio.current_task()
+        self._shared_pending.add(task)
+        try:
+            try:
+                lines, auth = await asyncio.wait_for(_read_until_authorize(miner_reader), PROXY_SHARED_AUTH_TIMEOUT)
+            except asyncio.TimeoutError:
+                auth = None
+            port = None
+            if auth is not None:
+                params = auth.get("params") or []
+                if params and isinstance(params[0], str):
+                    port = self.port_for_login(params[0])
+                if port is None or port not in self._servers:
+                    logger.info(f"Майнер {addr}: неизвестный логин на общем порту: {params[:1]}")
+                    try:
+                        msg = {"id": auth.get("id"), "result": False, "error": [24, "unknown login", None]}
+                        miner_writer.write((json.dumps(msg) + "\n").encode())
+                        await miner_writer.drain()
+                    except Exception:
+                        pass
+                    port = None
+            else:
+                logger.debug(f"Майнер {addr}: не прислал mining.authorize на общий порт")
         except Exception as e:
-            logger.warning(f"Не удалось актуализировать режим для порта {port}: {e}")
+            logger.debug(f"Майнер {addr}: ошибка чтения на общем порту: {e}")
+            port = None
         finally:
+            self._shared_pending.discard(task)
+        if port is None:
             try:
-                session.close()
+                miner_writer.close()
+                await miner_writer.wait_closed()
             except Exception:
                 pass
+            return
+        logger.debug(f"Майнер {addr}: общий порт -> порт {port}")
+        await self._handle_client(_ReplayReader(lines, miner_reader), miner_writer, port)
 
-        # Получаем активный режим из кеша порта (без запросов к БД)
-        cached = self._port_mode.get(port)
-        if not cached or cached.get("mode_name") == "sleep" or not cached.get("host") or int(cached.get("port", 0)) == 0:
-            logger.info(f"Майнер {addr}: активный режим 'sleep' для пользователя порт {port}. Закрываю соединение.")
+    async def _park_client(self, miner_reader: asyncio.StreamReader, miner_writer: asyncio.StreamWriter,
+                           port: int, addr) -> Optional[List[bytes]]:
+        """
+        Парковка соединения, пока порт в режиме сна: майнер остаётся подключённым, его строки
+        (configure/subscribe/authorize) копятся и после пробуждения уходят пулу в исходном порядке.
+        Пока майнер ждёт ответа на subscribe, он не переподключается в цикле и не нагружает прокси.
+        Возвращает накопленные строки после пробуждения или None, если майнер отключился
+        или порт остановлен.
+        """
+        _enable_keepalive(miner_writer)
+        self._parked[port] = self._parked.get(port, 0) + 1
+        self._parked_total += 1
+        logger.debug(f"Майнер {addr}: порт {port} в режиме 'sleep', соединение припарковано")
+        lines: List[bytes] = []
+        read: Optional[asyncio.Future] = None
+        wake: Optional[asyncio.Future] = None
+        try:
+            while True:
+                conf = self._port_mode.get(port)
+                if conf is None:
+                    return None
+                if not _is_sleep_conf(conf):
+                    return lines
+                if wake is None or wake.done():
+                    wake = asyncio.ensure_future(self._park_event(port).wait())
+                if read is None:
+                    read = asyncio.ensure_future(miner_reader.readline())
+                await asyncio.wait((read, wake), return_when=asyncio.FIRST_COMPLETED)
+                if not read.done():
+                    continue
+                try:
+                    data = read.result()
+                except Exception:
+                    return None
+                read = None
+                if not data:
+                    return None
+                if data.isspace():
+                    continue
+                lines.append(data)
+                if len(lines) > _PARK_MAX_LINES:
+                    logger.debug(f"Майнер {addr}: на парковке порта {port} слишком много сообщений, закрываю")
+                    return None
+        finally:
+            for fut in (read, wake):
+                if fut is not None and not fut.done():
+                    fut.cancel()
+            self._parked_total -= 1
+            left = self._parked.get(port, 1) - 1
+            if left > 0:
+                self._parked[port] = left
+            else:
+                self._parked.pop(port, None)
+
+    def _park_event(self, port: int) -> asyncio.Event:
+        event = self._park_events.get(port)
+        if event is None:
+            event = self._park_events[port] = asyncio.Event()
+        return event
+
+    def _wake_parked(self, port: int):
+        """Будит припаркованные соединения порта: они перечитают режим из кеша."""
+        event = self._park_events.pop(port, None)
+        if event is not None:
+            event.set()
+
+    def _miner_count(self, port: int) -> int:
+        """Подключённые майнеры порта, включая припаркованных."""
+        return len(self._sessions.get(port, ())) + self._parked.get(port, 0)
+
+    async def _release_session(self, sess: "_ClientSession"):
+        """Снимает сессию с учёта: счётчики воркеров, статус устройства, итоговая статистика."""
+        port, addr, client_task = sess.port, sess.addr, sess.task
+        self._sessions.get(port, set()).discard(sess)
+        self._clients.get(port, set()).discard(client_task)
+        # Корректировка счётчиков воркеров на порту
+        active_map = self._active_workers.get(port)
+        counts = self._worker_counts.get(port)
+        if active_map is not None and counts is not None:
+            base = active_map.pop(client_task, None)
+            if base:
+                c = counts.get(base, 0)
+                if c > 1:
+                    counts[base] = c - 1
+                elif c == 1:
+                    counts.pop(base, None)
+                    # Отмечаем устройство оффлайн, если это было последнее соединение данного воркера
+                    worker_part = base.split('.', 1)[1] if '.' in base else ''
+                    if worker_part:
+                        worker_part = re.sub(r'-\d+$', '', worker_part)
+                    self._devices.mark_offline(port, worker_part)
+        # Итоговая статистика ошибок пула по данному соединению
+        if sess.error_counts:
             try:
-                msg = {"id": None, "result": None, "error": {"code": -1, "message": "proxy sleep"}}
-                miner_writer.write((json.dumps(msg) + "\n").encode())
-                await miner_writer.drain()
+                summary = ", ".join(f"{k}={v}" for k, v in sess.error_counts.items())
+                logger.info(f"Итог по ошибкам пула для {addr} на порту {port}: {summary}")
             except Exception:
                 pass
-            miner_writer.close()
-            await miner_writer.wait_closed()
-            self._clients.get(port, set()).discard(client_task)
-            return
+        logger.info(f"Соединение закрыто для {addr} на порту {port}")
+
+    def _miner_line(self, sess: "_ClientSession", data, start: int = 0, end: Optional[int] = None) -> Optional[bytes]:
+        """
+        Строка майнера data[start:end] (с переводом строки) перед отправкой в пул.
+        None — переслать как есть, b"" — пропустить, иначе — переписанная строка.
+        """
+        if data[start] in _WHITESPACE and data[start:end].isspace():
+            return b""
+        # Быстрый путь: всё, кроме перехватываемых методов (mining.submit и пр.),
+        # уходит в пул исходными байтами, без декодирования и разбора JSON
+        if not _needs_parse(data, start, end):
+            return None
+        text = data[start:end].decode(errors='ignore').strip()
+        try:
+            msg = json.loads(text)
+        except json.JSONDecodeError:
+            # Непарсибельное — отправляем как есть
+            return None
 
-        host = cached.get("host")
-        upstream_port = int(cached.get("port"))
-        alias_login = cached.get("alias", "")
-        logger.info(f"Майнер {addr}: подключаем к пулу {host}:{upstream_port} (mode={cached.get('mode_name')})")
+        method = msg.get("method")
+        if method == "mining.subscribe":
+            # Запоминаем для повторного воспроизведения на новом пуле
+            sess.subscribe_msg = dict(msg)
+            sess.subscribe_id = msg.get("id")
+        elif method == "mining.extranonce.subscribe":
+            sess.extranonce_subscribed = True
+        elif method == "mining.authorize":
+            # Оригинальный authorize сохраняем до переписывания логина
+            params = msg.get("params", [])
+            sess.authorize_msgs = [m for m in sess.authorize_msgs if m.get("params", [None])[:1] != params[:1]]
+            sess.authorize_msgs.append({"method": method, "params": list(params)})
+            # Используем alias из режима, к которому подключена сессия
+            rewritten = self._rewrite_authorize(sess, msg, sess.conf.get("alias", ""))
+            if rewritten:
+                original, new_user, worker = rewritten
+                logger.info(f"Порт {sess.port}: authorize {original} -> {new_user}")
+                # Устройство онлайн (запись в БД — фоново, пачками)
+                self._upsert_device(sess.port, worker)
+            # Если нет params или alias пуст, отправляем как есть
+            return (json.dumps(msg) + "\n").encode()
+        # Иные сообщения — транзит исходными байтами
+        return None
 
-        # Подключаемся к пулу
+    def _pool_line(self, sess: "_ClientSession", data, start: int = 0, end: Optional[int] = None) -> None:
+        """Строка пула data[start:end]: майнеру пересылается как есть, разбирается только при необходимости."""
+        # Полный разбор только для строк с ошибкой (диагностика stale/unknown и прочих)
+        # и для отслеживания extranonce; mining.notify / set_difficulty идут без разбора
+        waiting_subscribe = sess.subscribe_id is not None and sess.extranonce is None
+        if waiting_subscribe or _has_error(data, start, end) or data.find(b"mining.set_extranonce", start, end) >= 0:
+            try:
+                resp = json.loads(data[start:end])
+                # Extranonce текущего upstream — для проверки совместимости при переключении
+                if waiting_subscribe and resp.get("id") == sess.subscribe_id and resp.get("result"):
+                    sess.extranonce = _extranonce_from_subscribe(resp.get("result"))
+                elif resp.get("method") == "mining.set_extranonce":
+                    sess.extranonce = tuple(resp.get("params") or ()) or None
+                self._count_pool_error(sess, resp.get("error"))
+            except Exception:
+                pass
+
+    async def _relay_session(self, sess: "_ClientSession") -> bool:
+        """
+        Майнер <-> пул на колбэках протоколов (PROXY_RELAY_ENGINE=protocol): до закрытия любой из сторон.
+        False — буфер StreamReader недоступен (см. stream_buffer), сессия остаётся на потоках.
+        """
+        reader, pending = sess.miner_reader, b""
+        base = reader.reader if isinstance(reader, _ReplayReader) else reader
+        try:
+            # Проверяем оба сокета до того, как что-либо забрать из их буферов
+            stream_buffer(base)
+            stream_buffer(sess.pool_reader)
+        except RuntimeError as e:
+            logger.warning(f"Майнер {sess.addr}: {e}. Пересылка через потоки")
+            return False
+        if isinstance(reader, _ReplayReader):
+            # Строки с парковки или общего порта отправляются первыми
+            pending, reader = reader.take_lines(), reader.reader
+        pending += take_buffered(reader)
+        relay = Relay(
+            sess.addr,
+            lambda buf, start, end: self._miner_line(sess, buf, start, end),
+            lambda buf, start, end: self._pool_line(sess, buf, start, end),
+        )
+        sess.relay = relay
+        relay.start(sess.miner_writer, sess.pool_writer, pending, take_buffered(sess.pool_reader), reader.at_eof())
         try:
-            pool_reader, pool_writer = await asyncio.open_connection(host, upstream_port)
+            await relay.wait_closed()
+        except asyncio.CancelledError:
+            pass
+        if relay.error is not None:
+            logger.info(f"Соединение {sess.addr} на порту {sess.port} разорвано: {relay.error}")
+        return True
+
+    async def _forward_to_pool(self, sess: "_ClientSession"):
+        """Майнер -> пул. Пишет в текущий upstream сессии (он может смениться при горячем переключении)."""
+        port, addr = sess.port, sess.addr
+        miner_reader = sess.miner_reader
+        try:
+            while not miner_reader.at_eof():
+                data = await miner_reader.readline()
+                if not data:
+                    break
+                out = self._miner_line(sess, data)
+                if out is None:
+                    out = data
+                elif not out:
+                    continue
+                writer = sess.pool_writer
+                writer.write(out)
+                try:
+                    await writer.drain()
+                except (ConnectionResetError, BrokenPipeError):
+                    # Старый upstream закрыт горячим переключением, пока ждали drain: продолжаем с новым
+                    if writer is sess.pool_writer:
+                        raise
+        except asyncio.CancelledError:
+            pass
+        except (ConnectionResetError, BrokenPipeError):
+            logger.info(f"Пул закрыл соединение для {addr} на порту {port}")
         except Exception as e:
-            logger.error(f"Майнер {addr}: не удалось подключиться к пулу {host}:{upstream_port}: {e}")
-            miner_writer.close()
+            logger.error(f"Ошибка форвардинга к пулу для {addr}: {e}")
+        finally:
             try:
-                await miner_writer.wait_closed()
+                sess.pool_writer.close()
+                await sess.pool_writer.wait_closed()
             except Exception:
                 pass
-            self._clients.get(port, set()).discard(client_task)
+
+    async def _forward_to_miner(self, sess: "_ClientSession", pool_reader: asyncio.StreamReader):
+        """Пул -> майнер для заданного upstream. При горячем переключении задача отменяется без закрытия майнера."""
+        port, addr = sess.port, sess.addr
+        miner_writer = sess.miner_writer
+        try:
+            while not pool_reader.at_eof():
+                data = await pool_reader.readline()
+                if not data:
+                    break
+                self._pool_line(sess, data)
+                miner_writer.write(data)
+                await miner_writer.drain()
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            logger.error(f"Ошибка форвардинга к майнеру для {addr}: {e}")
+        finally:
+            # При горячем переключении майнер остаётся подключённым к новому upstream
+            if not sess.switching:
+                try:
+                    miner_writer.close()
+                    await miner_writer.wait_closed()
+                except Exception:
+                    pass
+
+    def _count_pool_error(self, sess: "_ClientSession", err):
+        """Диагностика ошибки в ответе пула: отличаем нормальные (stale/unknown) от проблемных и считаем их."""
+        if err is None:
             return
+        port, addr = sess.port, sess.addr
+        # Stratum обычно возвращает [code, message, data]
+        code = None
+        message = None
+        if isinstance(err, list) and len(err) >= 2:
+            code, message = err[0], err[1]
+        elif isinstance(err, dict):
+            code = err.get("code")
+            message = err.get("message")
+        m = str(message) if message is not None else str(err)
+        if m in ("stale-work", "unknown-work"):
+            logger.info(f"Ответ пула: {m} для {addr} на порту {port} (code={code})")
+        else:
+            logger.warning(f"Ответ пула с ошибкой для {addr} на порту {port}: {err}")
+        # Счётчики на соединение
+        key = m or "error"
+        sess.error_counts[key] = sess.error_counts.get(key, 0) + 1
 
-        # Счётчики ошибок пула на время данного соединения
-        error_counts = {}
+    async def _switch_sessions(self, port: int, new_conf: dict, strategy: str):
+        """
+        Переводит активные сессии порта на новый режим без закрытия слушающего сокета.
+        migrate — переносит сессии на новый пул (повтор subscribe/authorize), при невозможности — drain;
+        drain — оставляет сессии на старом пуле и закрывает их в случайный момент в пределах
+        MODE_SWITCH_DRAIN_TIMEOUT, чтобы переподключения не шли одной волной.
+        """
+        sessions = [s for s in self._sessions.get(port, set()) if not _same_upstream(s.conf, new_conf)]
+        if not sessions:
+            return
+        if _is_sleep_conf(new_conf):
+            logger.info(f"Порт {port}: режим 'sleep', закрываю {len(sessions)} соединений")
+            for s in sessions:
+                s.task.cancel()
+            return
+
+        # Агрегированные сессии переносятся только переподключением
+        to_drain = [s for s in sessions if s.aggregated]
+        sessions = [s for s in sessions if not s.aggregated]
+        if strategy != "migrate":
+            to_drain += sessions
+        elif sessions:
+            sem = asyncio.Semaphore(max(1, MODE_SWITCH_CONCURRENCY))
+
+            async def _one(s):
+                async with sem:
+                    return await self._migrate_session(s, new_conf)
+
+            results = await asyncio.gather(*(_one(s) for s in sessions), return_exceptions=True)
+            failed = [s for s, ok in zip(sessions, results) if ok is not True]
+            to_drain += failed
+            logger.info(f"Порт {port}: перенесено сессий {len(sessions) - len(failed)}/{len(sessions)} на {new_conf.get('host')}:{new_conf.get('port')}")
+
+        loop = asyncio.get_running_loop()
+        for s in to_drain:
+            delay = random.uniform(0, MODE_SWITCH_DRAIN_TIMEOUT) if MODE_SWITCH_DRAIN_TIMEOUT > 0 else 0
+            loop.call_later(delay, s.task.cancel)
+        if to_drain:
+            logger.info(f"Порт {port}: {len(to_drain)} сессий будут закрыты в течение {MODE_SWITCH_DRAIN_TIMEOUT} с")
 
-        async def forward_to_pool():
+    def _is_superseded(self, port: int, conf: dict) -> bool:
+        """conf — уже не последний режим, применённый к порту (его сменила более новая перезагрузка)."""
+        return self._port_applied.get(port) is not conf
+
+    async def _migrate_session(self, sess: "_ClientSession", new_conf: dict) -> bool:
+        """
+        Переносит сессию майнера на upstream нового режима: subscribe и authorize повторяются на новом пуле
+        от имени прокси, ответы на них майнеру не пересылаются. Возвращает True при успехе, а также
+        если new_conf успел устареть (перенос отменяется, сессию переносит более новая перезагрузка).
+        """
+        async with sess.switch_lock:
+            if sess.task.done():
+                return True
+            if self._is_superseded(sess.port, new_conf):
+                # Режим порта уже сменился: сессию переносит более новая перезагрузка
+                return True
+            host, upstream_port = new_conf.get("host"), int(new_conf.get("port", 0))
             try:
-                while not miner_reader.at_eof():
-                    data = await miner_reader.readline()
-                    if not data:
-                        break
-                    text = data.decode(errors='ignore').strip()
-                    if not text:
-                        continue
+                reader, writer = await self._upstreams.connect(host, upstream_port)
+            except Exception as e:
+                logger.warning(f"Майнер {sess.addr}: не удалось подключиться к новому пулу {host}:{upstream_port}: {e}")
+                return False
+
+            buffered = []
+            next_id = [_REPLAY_ID_BASE]
+
+            async def _call(method, params):
+                next_id[0] += 1
+                req_id = next_id[0]
+                writer.write((json.dumps({"id": req_id, "method": method, "params": params}) + "\n").encode())
+                await writer.drain()
+                while True:
+                    line = await reader.readline()
+                    if not line:
+                        raise ConnectionResetError("pool closed connection")
                     try:
-                        msg = json.loads(text)
+                        resp = json.loads(line)
                     except json.JSONDecodeError:
-                        # Непарсибельное — отправляем как есть
-                        pool_writer.write(data)
-                        await pool_writer.drain()
-                        continue
-
-                    method = msg.get("method")
-                    if method == "mining.authorize":
-                        params = msg.get("params", [])
-                        # Используем alias_login из активного режима, полученного при подключении
-                        # Режимы обновляются через reload_port, который перезапускает сервер
-
-                        if params and isinstance(params[0], str) and alias_login:
-                            original = params[0]
-                            if "." in original:
-                                miner_login, worker = original.split(".", 1)
-                            else:
-                                miner_login, worker = original, ""
-
-                            # Базовое желаемое имя (без уникализации)
-                            base_desired = f"{alias_login}.{worker}" if worker else alias_login
-
-                            # Учёт уникальности воркеров на порту
-                            counts = self._worker_counts.setdefault(port, {})
-                            active_map = self._active_workers.setdefault(port, {})
-                            prev_base = active_map.get(client_task)
-                            if prev_base and prev_base != base_desired:
-                                # клиент сменил воркера — скорректируем счётчики
-                                prev_count = counts.get(prev_base, 0)
-                                if prev_count > 1:
-                                    counts[prev_base] = prev_count - 1
-                                elif prev_count == 1:
-                                    counts.pop(prev_base, None)
-
-                            usage = counts.get(base_desired, 0) + 1
-                            counts[base_desired] = usage
-                            active_map[client_task] = base_desired
-
-                            if usage == 1:
-                                new_user = base_desired
-                            else:
-                                # Добавляем суффикс -2, -3... чтобы пул не разрывал первое соединение
-                                if worker:
-                                    new_user = f"{alias_login}.{worker}-{usage}"
-                                else:
-                                    new_user = f"{alias_login}-{usage}"
-
-                            msg["params"][0] = new_user
-                            data = (json.dumps(msg) + "\n").encode()
-                            logger.info(f"Порт {port}: authorize {original} -> {new_user}")
-
-                            # === Апсерть устройства в БД ===
-                            try:
-                                session = get_session(self._engine)
-                                u = session.query(User).filter(User.port == port).first()
-                                if u:
-                                    worker_key = worker or ""
-                                    # имя устройства по умолчанию — воркер
-                                    name_val = worker_key or None
-                                    # попытка извлечь числовой идентификатор воркера (например, b11 -> 11)
-                                    m = re.search(r"(\d+)$", worker_key) if worker_key else None
-                                    worker_number = int(m.group(1)) if m else None
-                                    now = datetime.datetime.utcnow()
-                                    dev = session.query(Device).filter(Device.user_id == u.id, Device.worker == worker_key).first()
-                                    if dev:
-                                        if not dev.name:
-                                            dev.name = name_val
-                                        dev.last_connected_at = now
-                                        dev.last_seen_at = now
-                                        dev.is_online = 1
-                                    else:
-                                        dev = Device(
-                                            user_id=u.id,
-                                            worker=worker_key,
-                                            worker_number=worker_number,
-                                            name=name_val,
-                                            last_connected_at=now,
-                                            last_seen_at=now,
-                                            is_online=1,
-                                        )
-                                        session.add(dev)
-                                    session.commit()
-                                session.close()
-                            except Exception as e:
-                                logger.warning(f"Не удалось обновить Device для порта {port}: {e}")
-                        else:
-                            # Если нет params или alias пуст, отправляем как есть
-                            data = (json.dumps(msg) + "\n").encode()
-
-                        pool_writer.write(data)
-                        await pool_writer.drain()
                         continue
+                    if resp.get("id") == req_id:
+                        return resp
+                    # Уведомления пула (set_difficulty/notify) передадим майнеру после переключения
+                    buffered.append(line)
 
-                    # Иные сообщения — транзит
-                    pool_writer.write((json.dumps(msg) + "\n").encode())
-                    await pool_writer.drain()
-            except asyncio.CancelledError:
-                pass
-            except (ConnectionResetError, BrokenPipeError):
-                logger.info(f"Пул закрыл соединение для {addr} на порту {port}")
+            # Учёт воркера меняется при переписывании authorize; при неудаче переноса он откатывается
+            prev_base = self._active_workers.get(sess.port, {}).get(sess.task)
+            prev_usage = sess.worker_usage
+            try:
+                set_extranonce = None
+                if sess.subscribe_msg is not None:
+                    resp = await asyncio.wait_for(_call("mining.subscribe", sess.subscribe_msg.get("params", [])), UPSTREAM_CONNECT_TIMEOUT)
+                    new_extranonce = _extranonce_from_subscribe(resp.get("result"))
+                    if new_extranonce is None:
+                        raise ValueError(f"bad subscribe response: {resp}")
+                    if new_extranonce != sess.extranonce:
+                        if not sess.extranonce_subscribed:
+                            raise ValueError("extranonce differs and miner does not support mining.set_extranonce")
+                        set_extranonce = new_extranonce
+                    if sess.extranonce_subscribed:
+                        await asyncio.wait_for(_call("mining.extranonce.subscribe", []), UPSTREAM_CONNECT_TIMEOUT)
+                for auth in sess.authorize_msgs:
+                    msg = {"method": auth["method"], "params": list(auth["params"])}
+                    self._rewrite_authorize(sess, msg, new_conf.get("alias", ""))
+                    resp = await asyncio.wait_for(_call(msg["method"], msg["params"]), UPSTREAM_CONNECT_TIMEOUT)
+                    if resp.get("result") is not True:
+                        raise ValueError(f"authorize rejected: {resp.get('error')}")
+                # Остаток буфера нового пула забираем до переключения: без _buffer перенос не выполняется
+                pool_pending = take_buffered(reader) if sess.relay is not None else b""
             except Exception as e:
-                logger.error(f"Ошибка форвардинга к пулу для {addr}: {e}")
-            finally:
-                try:
-                    pool_writer.close()
-                    await pool_writer.wait_closed()
-                except Exception:
-                    pass
+                logger.warning(f"Майнер {sess.addr}: перенос на {host}:{upstream_port} не удался: {e}")
+                self._restore_worker(sess, prev_base, prev_usage)
+                writer.close()
+                return False
+            if self._is_superseded(sess.port, new_conf):
+                self._restore_worker(sess, prev_base, prev_usage)
+                writer.close()
+                return True
 
-        async def forward_to_miner():
+            # Переключаем upstream: старая задача пул->майнер останавливается без закрытия майнера
+            old_writer = sess.pool_writer
+            sess.switching = True
             try:
-                while not pool_reader.at_eof():
-                    data = await pool_reader.readline()
-                    if not data:
-                        break
-                    # Диагностика ответов пула: отличаем нормальные ошибки (stale/unknown) от проблемных
-                    try:
-                        resp_text = data.decode(errors='ignore').strip()
-                        if resp_text:
-                            resp = json.loads(resp_text)
-                            err = resp.get("error")
-                            if err is not None:
-                                # Stratum обычно возвращает [code, message, data]
-                                code = None
-                                message = None
-                                if isinstance(err, list) and len(err) >= 2:
-                                    code, message = err[0], err[1]
-                                elif isinstance(err, dict):
-                                    code = err.get("code")
-                                    message = err.get("message")
-                                m = str(message) if message is not None else str(err)
-                                if m in ("stale-work", "unknown-work"):
-                                    logger.info(f"Ответ пула: {m} для {addr} на порту {port} (code={code})")
-                                else:
-                                    logger.warning(f"Ответ пула с ошибкой для {addr} на порту {port}: {err}")
-                                # Счётчики на соединение
-                                key = m or "error"
-                                error_counts[key] = error_counts.get(key, 0) + 1
-                    except Exception:
-                        pass
-
-                    miner_writer.write(data)
-                    await miner_writer.drain()
-            except asyncio.CancelledError:
-                pass
-            except Exception as e:
-                logger.error(f"Ошибка форвардинга к майнеру для {addr}: {e}")
+                if sess.pool_task:
+                    sess.pool_task.cancel()
+                    await asyncio.gather(sess.pool_task, return_exceptions=True)
             finally:
-                try:
-                    miner_writer.close()
-                    await miner_writer.wait_closed()
-                except Exception:
-                    pass
+                sess.switching = False
+            sess.pool_reader, sess.pool_writer = reader, writer
+            sess.conf = new_conf
+            if set_extranonce is not None:
+                sess.extranonce = set_extranonce
+                notify = {"id": None, "method": "mining.set_extranonce", "params": list(set_extranonce)}
+                sess.miner_writer.write((json.dumps(notify) + "\n").encode())
+            for line in buffered:
+                sess.miner_writer.write(line)
+            if sess.relay is not None:
+                sess.relay.replace_pool(writer, pool_pending)
+            else:
+                sess.pool_task = asyncio.create_task(self._forward_to_miner(sess, reader))
+            try:
+                old_writer.close()
+            except Exception:
+                pass
+            logger.info(f"Майнер {sess.addr}: перенесён на пул {host}:{upstream_port} (mode={new_conf.get('mode_name')})")
+            return True
 
+
+_REPLAY_ID_BASE = 0x7F000000
+
+# Сколько строк майнера держится на парковке и на общем порту до authorize (рукопожатие — несколько строк)
+_PARK_MAX_LINES = 64
+
+# Методы майнера, которые прокси перехватывает; остальные строки пересылаются без разбора
+_INTERCEPTED_METHODS = (b"mining.authorize", b"mining.subscribe", b"mining.extranonce.subscribe")
+
+_WHITESPACE = b" \t\r\n\x0b\x0c"
+
+_RELAY_ENGINES = ("streams", "protocol")
+
+
+def _enable_keepalive(writer: asyncio.StreamWriter):
+    """TCP keepalive для долгих соединений без трафика (обнаружение пропавших майнеров)."""
+    sock = writer.get_extra_info("socket")
+    if sock is None:
+        return
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    except OSError:
+        pass
+
+
+async def _read_until_authorize(reader: asyncio.StreamReader) -> Tuple[List[bytes], Optional[dict]]:
+    """Читает строки майнера до первого mining.authorize включительно. Возвращает (строки, authorize или None)."""
+    lines: List[bytes] = []
+    while len(lines) < _PARK_MAX_LINES:
+        data = await reader.readline()
+        if not data:
+            break
+        if data.isspace():
+            continue
+        lines.append(data)
+        if b"mining.authorize" not in data:
+            continue
         try:
-            await asyncio.gather(forward_to_pool(), forward_to_miner())
-        finally:
-            self._clients.get(port, set()).discard(client_task)
-            # Корректировка счётчиков воркеров на порту
-            active_map = self._active_workers.get(port)
-            counts = self._worker_counts.get(port)
-            if active_map is not None and counts is not None:
-                base = active_map.pop(client_task, None)
-                if base:
-                    c = counts.get(base, 0)
-                    if c > 1:
-                        counts[base] = c - 1
-                    elif c == 1:
-                        counts.pop(base, None)
-                        # Отмечаем устройство оффлайн, если это было последнее соединение данного воркера
-                        try:
-                            session = get_session(self._engine)
-                            u = session.query(User).filter(User.port == port).first()
-                            if u:
-                                worker_part = base.split('.', 1)[1] if '.' in base else ''
-                                if worker_part:
-                                    worker_part = re.sub(r'-\d+$', '', worker_part)
-                                dev = session.query(Device).filter(Device.user_id == u.id, Device.worker == worker_part).first()
-                                if dev:
-                                    dev.is_online = 0
-                                    dev.last_seen_at = datetime.datetime.utcnow()
-                                    session.commit()
-                                    # Попробуем отправить уведомление пользователю о отключении устройства
-                                    try:
-                                        if BOT_TOKEN and getattr(u, "tg_id", None):
-                                            bot = Bot(token=BOT_TOKEN, parse_mode=ParseMode.HTML)
-                                            name = dev.name or dev.worker or "Аппарат"
-                                            worker_info = f" ({dev.worker})" if dev.worker else ""
-                                            text = f"❗️ {name}{worker_info} стал оффлайн."
-                                            await bot.send_message(chat_id=u.tg_id, text=text)
-                                            await bot.session.close()
-                                    except Exception as e:
-                                        logger.warning(f"Ошибка отправки уведомления об оффлайне: {e}")
-                            session.close()
-                        except Exception as e:
-                            logger.warning(f"Не удалось отметить оффлайн Device для порта {port}: {e}")
-            # Итоговая статистика ошибок пула по данному соединению
-            if error_counts:
-                try:
-                    summary = ", ".join(f"{k}={v}" for k, v in error_counts.items())
-                    logger.info(f"Итог по ошибкам пула для {addr} на порту {port}: {summary}")
-                except Exception:
-                    pass
-            logger.info(f"Соединение закрыто для {addr} на порту {port}")
\ No newline at end of file
+            msg = json.loads(data)
+        except json.JSONDecodeError:
+            continue
+        if isinstance(msg, dict) and msg.get("method") == "mining.authorize":
+            return lines, msg
+    return lines, None
+
+
+class _ReplayReader:
+    """Читатель майнера, который сначала отдаёт строки, накопленные на парковке."""
+
+    __slots__ = ("_lines", "_reader")
+
+    def __init__(self, lines: Iterable[bytes], reader: asyncio.StreamReader):
+        self._lines = deque(lines)
+        self._reader = reader
+
+    def at_eof(self) -> bool:
+        return not self._lines and self._reader.at_eof()
+
+    async def readline(self) -> bytes:
+        if self._lines:
+            return self._lines.popleft()
+        return await self._reader.readline()
+
+    @property
+    def reader(self) -> asyncio.StreamReader:
+        return self._reader
+
+    def take_lines(self) -> bytes:
+        """Забирает ещё не прочитанные строки (при переключении сессии на Relay)."""
+        data = b"".join(self._lines)
+        self._lines.clear()
+        return data
+
+
+def _has_error(data: bytes, start: int = 0, end: Optional[int] = None) -> bool:
+    """Проверка по сырым байтам: есть ли в строке data[start:end] поле "error" с непустым (не null) значением."""
+    i = data.find(b'"error"', start, end)
+    if i < 0:
+        return False
+    rest = data[i + 7:i + 24].lstrip()
+    if not rest.startswith(b":"):
+        # "error" встретилось не как ключ — разберём строку полностью
+        return True
+    return not rest[1:].lstrip().startswith(b"null")
+
+
+def _needs_parse(data: bytes, start: int = 0, end: Optional[int] = None) -> bool:
+    """Проверка по сырым байтам: может ли строка data[start:end] содержать перехватываемый метод."""
+    for marker in _INTERCEPTED_METHODS:
+        if data.find(marker, start, end) >= 0:
+            return True
+    return False
+
+
+def _is_sleep_conf(conf: Optional[dict]) -> bool:
+    return not conf or conf.get("mode_name") == "sleep" or not conf.get("host") or int(conf.get("port", 0)) == 0
+
+
+def _same_upstream(a: Optional[dict], b: Optional[dict]) -> bool:
+    if not a or not b:
+        return False
+    return (a.get("host"), int(a.get("port", 0)), a.get("alias")) == (b.get("host"), int(b.get("port", 0)), b.get("alias"))
+
+
+def _extranonce_from_subscribe(result) -> Optional[tuple]:
+    """Из ответа mining.subscribe ([subscriptions, extranonce1, extranonce2_size]) извлекает extranonce."""
+    if isinstance(result, list) and len(result) >= 3:
+        return (result[1], result[2])
+    return None
+
+
+class _ClientSession:
+    """Состояние одного подключения майнера: текущий upstream и данные для повторного входа на новый пул."""
+
+    def __init__(self, port: int, addr, task: asyncio.Task, miner_reader: asyncio.StreamReader, miner_writer: asyncio.StreamWriter):
+        self.port = port
+        self.addr = addr
+        self.task = task
+        self.miner_reader = miner_reader
+        self.miner_writer = miner_writer
+        self.pool_reader: Optional[asyncio.StreamReader] = None
+        self.pool_writer: Optional[asyncio.StreamWriter] = None
+        self.pool_task: Optional[asyncio.Task] = None
+        # Пересылка на протоколах (PROXY_RELAY_ENGINE=protocol) вместо pool_task и цикла чтения майнера
+        self.relay: Optional[Relay] = None
+        self.conf: Optional[dict] = None
+        self.subscribe_msg: Optional[dict] = None
+        self.subscribe_id = None
+        self.authorize_msgs: List[dict] = []
+        self.extranonce_subscribed = False
+        self.extranonce: Optional[tuple] = None
+        self.worker_usage = 0
+        # Сессия обслуживается через общую upstream-сессию (режим агрегации)
+        self.aggregated = False
+        self.switching = False
+        self.switch_lock = asyncio.Lock()
+        # Счётчики ошибок пула на время данного соединения
+        self.error_counts: Dict[str, int] = {}
@@ -0,0 +1,126 @@
+"""
+Снимок конфигурации портов на диске (порт -> запись кеша режима).
+
+Прокси поднимает порты из снимка без обращения к БД и сверяется с БД, когда она доступна,
+поэтому перезапуск не зависит от задержек и доступности БД. Снимок перезаписывается после
+изменений конфигурации (с задержкой, объединяющей серию изменений в одну запись).
+Файл заменяется атомарно: запись во временный файл рядом и os.replace, так что при сбое
+во время записи остаётся предыдущий снимок.
+"""
+import asyncio
+import json
+import logging
+import os
+import tempfile
+import time
+from typing import Callable, Dict, Optional
+
+from config.settings import PROXY_SNAPSHOT_SAVE_DELAY
+
+logger = logging.getLogger(__name__)
+
+_VERSION = 1
+
+
+class ConfigSnapshot:
+    """Снимок конфигурации портов. source — функция, возвращающая текущий кеш port -> conf."""
+
+    def __init__(self, path: str, source: Callable[[], Dict[int, dict]], delay: float = PROXY_SNAPSHOT_SAVE_DELAY):
+        self.path = path
+        self._source = source
+        self.delay = max(0.0, delay)
+        self._dirty = False
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def load(self, quiet: bool = False) -> Optional[Dict[int, dict]]:
+        """Читает снимок. None — снимка нет или он повреждён. quiet — не писать в лог успешную загрузку."""
+        try:
+            with open(self.path, "rb") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.warning(f"Не удалось прочитать снимок конфигурации {self.path}: {e}")
+            return None
+        if not isinstance(data, dict) or data.get("version") != _VERSION or not isinstance(data.get("ports"), dict):
+            logger.warning(f"Снимок конфигурации {self.path} имеет неизвестный формат. Пропускаю.")
+            return None
+        try:
+            confs = {int(port): dict(conf) for port, conf in data["ports"].items()}
+        except (TypeError, ValueError) as e:
+            logger.warning(f"Снимок конфигурации {self.path} повреждён: {e}")
+            return None
+        if quiet:
+            return confs
+        age = time.time() - float(data.get("saved_at") or 0)
+        logger.info(f"Загружен снимок конфигурации {self.path}: портов {len(confs)}, возраст {age:.0f} с")
+        return confs
+
+    def save(self, confs: Dict[int, dict]):
+        """Синхронно и атомарно записывает снимок."""
+        payload = json.dumps(
+            {"version": _VERSION, "saved_at": time.time(), "ports": {str(p): c for p, c in confs.items()}},
+            ensure_ascii=False, separators=(",", ":"),
+        )
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(prefix=".snapshot-", dir=directory)
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                f.write(payload)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.path)
+        except Exception:
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+            raise
+
+    def mark_dirty(self):
+        """Конфигурация изменилась: снимок будет перезаписан через delay секунд."""
+        self._dirty = True
+        if self._timer is None and self._task is None:
+            self._timer = asyncio.get_running_loop().call_later(self.delay, self._start_write)
+
+    def _start_write(self):
+        self._timer = None
+        self._task = asyncio.create_task(self._write())
+
+    async def _write(self):
+        try:
+            while self._dirty:
+                self._dirty = False
+                # Копия делается в цикле событий, сериализация и запись — в пуле потоков
+                confs = dict(self._source())
+                try:
+                    await asyncio.get_running_loop().run_in_executor(None, self.save, confs)
+                    logger.debug(f"Снимок конфигурации записан: портов {len(confs)}")
+                except Exception as e:
+                    logger.warning(f"Не удалось записать снимок конфигурации {self.path}: {e}")
+        finally:
+            self._task = None
+
+    async def close(self):
+        """Дописывает отложенные изменения (вызывать до очистки кеша при остановке)."""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._task is not None:
+            await asyncio.gather(self._task, return_exceptions=True)
+        if self._dirty:
+            self._dirty = False
+            try:
+                self.save(dict(self._source()))
+            except Exception as e:
+                logger.warning(f"Не удалось записать снимок конфигурации {self.path}: {e}")
+
+
+def has_snapshot(path: str) -> bool:
+    """Есть ли по пути непустой читаемый снимок (без него недоступная БД подменяется локальной SQLite)."""
+    return bool(path) and bool(ConfigSnapshot(path, dict).load(quiet=True))
+
+
+__all__ = ["ConfigSnapshot", "has_snapshot"]
@@ -0,0 +1,430 @@
+"""
+Многопроцессный режим прокси (--workers N).
+
+Супервизор запускает N дочерних процессов `main.py --proxy-only --worker-index i`, каждый из которых
+обслуживает свою часть портов (port_shard(port, N) == i). Порты из PROXY_REUSEPORT_PORTS слушают все
+процессы сразу через SO_REUSEPORT, ядро распределяет подключения между ними.
+
+Супервизор:
+- перезапускает упавшие процессы (с нарастающей паузой при частых падениях);
+- держит общий HTTP API прокси (PROXY_API_PORT) и перенаправляет команды процессам-владельцам порта,
+  /status объединяет ответы всех процессов;
+- для SQLite/UDP-канала изменений принимает уведомления и рассылает их каждому процессу
+  (PostgreSQL LISTEN процессы слушают сами).
+"""
+import asyncio
+import hashlib
+import logging
+import os
+import signal
+import socket
+import sys
+import time
+from typing import Dict, Iterable, List, Optional
+
+from aiohttp import ClientSession, ClientTimeout, web
+
+from config.settings import (
+    BASE_DIR,
+    PROXY_API_HOST, PROXY_API_PORT, PROXY_API_TOKEN,
+    PROXY_WORKER_API_BASE_PORT, PROXY_WORKER_RESTART_DELAY, PROXY_WORKER_RESTART_MAX_DELAY,
+    PROXY_REUSEPORT_PORTS,
+    MODE_CHANGES_UDP_HOST, MODE_CHANGES_UDP_PORT,
+)
+from db.changes import ModeChangeListener
+
+logger = logging.getLogger(__name__)
+
+# Процесс, проработавший дольше, считается стабильным: пауза перезапуска сбрасывается
+_STABLE_UPTIME = 60.0
+
+
+def port_shard(port: int, workers: int) -> int:
+    """Номер процесса, обслуживающего порт. Не зависит от запуска и порядка пользователей в БД."""
+    if workers <= 1:
+        return 0
+    digest = hashlib.blake2b(str(int(port)).encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big") % workers
+
+
+def worker_api_port(index: int) -> int:
+    return PROXY_WORKER_API_BASE_PORT + index
+
+
+def worker_udp_port(index: int) -> int:
+    return MODE_CHANGES_UDP_PORT + 1 + index
+
+
+class _Worker:
+    def __init__(self, index: int):
+        self.index = index
+        self.proc: Optional[asyncio.subprocess.Process] = None
+        self.task: Optional[asyncio.Task] = None
+        self.started_at = 0.0
+        self.restarts = 0
+
+    @property
+    def alive(self) -> bool:
+        return self.proc is not None and self.proc.returncode is None
+
+
+class ProxySupervisor:
+    """
+    Управляет процессами прокси. Повторяет управляющие методы StratumProxyServer
+    (reload_port, request_reload, reload_ports, start_port, stop_port, invalidate_port, start_http_api), поэтому
+    планировщик и обработчики бота работают с ним так же, как с однопроцессным сервером.
+    """
+
+    def __init__(self, workers: int, engine=None):
+        self.workers = max(1, int(workers))
+        self._engine = engine
+        self._workers: List[_Worker] = [_Worker(i) for i in range(self.workers)]
+        self._running = False
+        self._http: Optional[ClientSession] = None
+        self._http_runner: Optional[web.AppRunner] = None
+        self._http_site: Optional[web.TCPSite] = None
+        self._change_listener = None
+        self._relay_sock: Optional[socket.socket] = None
+
+    # ===== Процессы =====
+
+    def _worker_cmd(self, index: int) -> List[str]:
+        return [
+            sys.executable, os.path.join(str(BASE_DIR), "main.py"), "--proxy-only",
+            "--workers", str(self.workers), "--worker-index", str(index),
+        ]
+
+    def _worker_env(self, index: int) -> Dict[str, str]:
+        env = dict(os.environ)
+        env["MODE_CHANGES_UDP_PORT"] = str(worker_udp_port(index))
+        return env
+
+    async def _run_worker(self, w: _Worker):
+        delay = PROXY_WORKER_RESTART_DELAY
+        while self._running:
+            try:
+                w.proc = await asyncio.create_subprocess_exec(*self._worker_cmd(w.index), env=self._worker_env(w.index))
+                w.started_at = time.monotonic()
+                logger.info(f"Процесс прокси #{w.index} запущен (pid={w.proc.pid})")
+                rc = await w.proc.wait()
+            except asyncio.CancelledError:
+                break
+            except Exception as e:
+                rc = None
+                logger.error(f"Не удалось запустить процесс прокси #{w.index}: {e}")
+            if not self._running:
+                break
+            if time.monotonic() - w.started_at > _STABLE_UPTIME:
+                delay = PROXY_WORKER_RESTART_DELAY
+            w.restarts += 1
+            logger.warning(f"Процесс прокси #{w.index} завершился (код {rc}). Перезапуск через {delay:.0f} с")
+            try:
+                await asyncio.sleep(delay)
+            except asyncio.CancelledError:
+                break
+            delay = min(delay * 2, PROXY_WORKER_RESTART_MAX_DELAY)
+
+    async def start(self):
+        """Запускает процессы прокси и ретрансляцию уведомлений об изменениях."""
+        logger.info(f"Запуск прокси в {self.workers} процессах...")
+        self._running = True
+        if self._http is None:
+            self._http = ClientSession(timeout=ClientTimeout(total=30))
+        for w in self._workers:
+            if w.task is None or w.task.done():
+                w.task = asyncio.create_task(self._run_worker(w))
+        await self._start_change_relay()
+
+    async def stop(self):
+        logger.info("Остановка процессов прокси...")
+        self._running = False
+        await self._stop_change_relay()
+        for w in self._workers:
+            if w.alive:
+                try:
+                    w.proc.send_signal(signal.SIGTERM)
+                except Exception:
+                    pass
+        for w in self._workers:
+            if w.proc is not None:
+                try:
+                    await asyncio.wait_for(w.proc.wait(), 15)
+                except asyncio.TimeoutError:
+                    logger.warning(f"Процесс прокси #{w.index} не завершился, принудительная остановка")
+                    w.proc.kill()
+                    await w.proc.wait()
+                except Exception:
+                    pass
+            if w.task:
+                w.task.cancel()
+                await asyncio.gather(w.task, return_exceptions=True)
+                w.task = None
+        try:
+            await self.stop_http_api()
+        except Exception:
+            pass
+        if self._http:
+            await self._http.close()
+            self._http = None
+        logger.info("Процессы прокси остановлены")
+
+    # ===== Канал изменений =====
+
+    async def _start_change_relay(self):
+        """Для SQLite/UDP-канала: принимаем уведомления на общем порту и рассылаем процессам."""
+        if self._change_listener is not None:
+            return
+        try:
+            if self._engine is not None and self._engine.dialect.name == "postgresql":
+                return
+        except Exception:
+            pass
+        self._relay_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._relay_sock.setblocking(False)
+        try:
+            self._change_listener = ModeChangeListener(self._engine, self._relay_change)
+            await self._change_listener.start()
+        except Exception as e:
+            self._change_listener = None
+            logger.warning(f"Не удалось запустить ретрансляцию изменений режимов: {e}")
+
+    async def _stop_change_relay(self):
+        if self._change_listener:
+            try:
+                await self._change_listener.stop()
+            except Exception:
+                pass
+            self._change_listener = None
+        if self._relay_sock:
+            self._relay_sock.close()
+            self._relay_sock = None
+
+    def _relay_change(self, payload: str):
+        if not self._relay_sock:
+            return
+        data = payload.encode()
+        for w in self._workers:
+            try:
+                self._relay_sock.sendto(data, (MODE_CHANGES_UDP_HOST, worker_udp_port(w.index)))
+            except Exception as e:
+                logger.warning(f"Не удалось передать уведомление процессу #{w.index}: {e}")
+
+    # ===== Маршрутизация команд =====
+
+    def owners(self, port: int) -> List[int]:
+        """Процессы, слушающие порт."""
+        if port in PROXY_REUSEPORT_PORTS:
+            return list(range(self.workers))
+        return [port_shard(port, self.workers)]
+
+    def _headers(self) -> Dict[str, str]:
+        return {"X-Proxy-Token": PROXY_API_TOKEN} if PROXY_API_TOKEN else {}
+
+    async def _worker_request(self, index: int, method: str, path: str, payload: Optional[dict] = None) -> dict:
+        if self._http is None:
+            raise RuntimeError("supervisor is not started")
+        url = f"http://{PROXY_API_HOST}:{worker_api_port(index)}{path}"
+        async with self._http.request(method, url, json=payload, headers=self._headers()) as resp:
+            if resp.status >= 400:
+                text = await resp.text()
+                raise RuntimeError(f"worker #{index} api error {resp.status}: {text}")
+            return await resp.json()
+
+    async def _post_owners(self, port: int, path: str, payload: dict) -> List[dict]:
+        results = await asyncio.gather(
+            *(self._worker_request(i, "POST", path, payload) for i in self.owners(port)),
+            return_exceptions=True,
+        )
+        errors = [r for r in results if isinstance(r, Exception)]
+        if errors:
+            raise errors[0]
+        return results
+
+    async def request_reload(self, port: int, strategy: Optional[str] = None) -> bool:
+        """Перезагрузка через очереди процессов-владельцев. Возвращает True, если порт был перезагружен."""
+        payload = {"port": port}
+        if strategy:
+            payload["strategy"] = strategy
+        results = await self._post_owners(port, "/reload-port", payload)
+        return any(r.get("changed", True) for r in results)
+
+    async def reload_port(self, port: int, strategy: Optional[str] = None):
+        await self.request_reload(port, strategy=strategy)
+
+    async def reload_ports(self, ports: Iterable[int], strategy: Optional[str] = None) -> Dict[int, str]:
+        """Массовая перезагрузка: каждый процесс получает свои порты одним запросом."""
+        by_worker: Dict[int, List[int]] = {}
+        for port in dict.fromkeys(int(p) for p in ports):
+            for index in self.owners(port):
+                by_worker.setdefault(index, []).append(port)
+
+        async def _one(index: int, items: List[int]) -> Dict[int, str]:
+            payload = {"ports": items}
+            if strategy:
+                payload["strategy"] = strategy
+            try:
+                res = await self._worker_request(index, "POST", "/reload-ports", payload)
+            except Exception as e:
+                return {p: str(e) or type(e).__name__ for p in items}
+            return {int(p): err for p, err in (res.get("errors") or {}).items()}
+
+        errors: Dict[int, str] = {}
+        for res in await asyncio.gather(*(_one(i, items) for i, items in by_worker.items())):
+            errors.update(res)
+        return errors
+
+    async def start_port(self, port: int):
+        await self._post_owners(port, "/start-port", {"port": port})
+
+    async def stop_port(self, port: int):
+        await self._post_owners(port, "/stop-port", {"port": port})
+
+    async def invalidate_port(self, port: int) -> bool:
+        results = await self._post_owners(port, "/invalidate-port", {"port": port})
+        return any(r.get("changed") for r in results)
+
+    async def prewarm_transitions(self, transitions: Iterable[dict]) -> int:
+        """Раздаёт предстоящие переключения процессам, обслуживающим порты."""
+        by_worker: Dict[int, List[dict]] = {}
+        for t in transitions:
+            for index in self.owners(int(t["port"])):
+                by_worker.setdefault(index, []).append(t)
+        results = await asyncio.gather(
+            *(self._worker_request(i, "POST", "/prewarm", {"transitions": items}) for i, items in by_worker.items()),
+            return_exceptions=True,
+        )
+        pools = 0
+        for index, res in zip(by_worker, results):
+            if isinstance(res, Exception):
+                logger.warning(f"Не удалось передать прогрев процессу #{index}: {res}")
+            else:
+                pools += int(res.get("pools", 0))
+        return pools
+
+    async def status(self) -> dict:
+        """Объединённый статус всех процессов."""
+        async def _one(w: _Worker) -> dict:
+            info = {
+                "index": w.index,
+                "pid": w.proc.pid if w.proc else None,
+                "alive": w.alive,
+                "restarts": w.restarts,
+            }
+            if not w.alive:
+                return info
+            try:
+                info.update(await asyncio.wait_for(self._worker_request(w.index, "GET", "/status"), 5))
+            except Exception as e:
+                info["error"] = str(e) or type(e).__name__
+            return info
+
+        workers = await asyncio.gather(*(_one(w) for w in self._workers))
+        ports = sorted({p for w in workers for p in w.get("ports", [])})
+        return {"ports": ports, "workers": list(workers)}
+
+    # ===== HTTP API =====
+
+    async def start_http_api(self, host: str = PROXY_API_HOST, port: int = PROXY_API_PORT, token: Optional[str] = PROXY_API_TOKEN):
+        if self._http is None:
+            self._http = ClientSession(timeout=ClientTimeout(total=30))
+        app = web.Application()
+
+        async def _auth(request):
+            t = token or ""
+            if t:
+                if request.headers.get("X-Proxy-Token", "") != t:
+                    return web.json_response({"error": "unauthorized"}, status=401)
+            return None
+
+        async def health(request):
+            err = await _auth(request)
+            if err:
+                return err
+            alive = sum(1 for w in self._workers if w.alive)
+            return web.json_response({"status": "ok" if alive == self.workers else "degraded", "workers": self.workers, "alive": alive})
+
+        async def status(request):
+            err = await _auth(request)
+            if err:
+                return err
+            return web.json_response(await self.status())
+
+        def _forward(action, result: str, with_strategy: bool = False):
+            async def handler(request):
+                err = await _auth(request)
+                if err:
+                    return err
+                data = await request.json()
+                p = int(data.get("port"))
+                try:
+                    if with_strategy:
+                        await action(p, strategy=data.get("strategy"))
+                    else:
+                        await action(p)
+                except Exception as e:
+                    return web.json_response({"error": str(e), "port": p}, status=502)
+                return web.json_response({"result": result, "port": p, "workers": self.owners(p)})
+            return handler
+
+        async def reload_ports_handler(request):
+            err = await _auth(request)
+            if err:
+                return err
+            data = await request.json()
+            ports = [int(p) for p in data.get("ports") or []]
+            errors = await self.reload_ports(ports, strategy=data.get("strategy"))
+            return web.json_response({"result": "reloaded", "ports": len(ports), "errors": errors})
+
+        async def invalidate_port_handler(request):
+            err = await _auth(request)
+            if err:
+                return err
+            data = await request.json()
+            p = int(data.get("port"))
+            try:
+                changed = await self.invalidate_port(p)
+            except Exception as e:
+                return web.json_response({"error": str(e), "port": p}, status=502)
+            return web.json_response({"result": "invalidated", "port": p, "changed": changed})
+
+        async def prewarm_handler(request):
+            err = await _auth(request)
+            if err:
+                return err
+            data = await request.json()
+            pools = await self.prewarm_transitions(data.get("transitions") or [])
+            return web.json_response({"result": "scheduled", "pools": pools})
+
+        app.add_routes([
+            web.get("/health", health),
+            web.get("/status", status),
+            web.post("/prewarm", prewarm_handler),
+            web.post("/reload-port", _forward(self.reload_port, "reloaded", with_strategy=True)),
+            web.post("/reload-ports", reload_ports_handler),
+            web.post("/invalidate-port", invalidate_port_handler),
+            web.post("/start-port", _forward(self.start_port, "started")),
+            web.post("/stop-port", _forward(self.stop_port, "stopped")),
+        ])
+
+        self._http_runner = web.AppRunner(app)
+        await self._http_runner.setup()
+        self._http_site = web.TCPSite(self._http_runner, host, port)
+        await self._http_site.start()
+        logger.info(f"HTTP API супервизора запущен на {host}:{port}")
+
+    async def stop_http_api(self):
+        if self._http_site:
+            try:
+                await self._http_site.stop()
+            except Exception:
+                pass
+            self._http_site = None
+        if self._http_runner:
+            try:
+                await self._http_runner.cleanup()
+            except Exception:
+                pass
+            self._http_runner = None
+
+
+__all__ = ["ProxySupervisor", "port_shard", "worker_api_port", "worker_udp_port"]
@@ -0,0 +1,188 @@
+import asyncio
+import datetime
+import heapq
+import itertools
+import logging
+import random
+import time
+from typing import Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+from config.settings import SWITCH_RATE, SWITCH_POOL_CONCURRENCY, SWITCH_JITTER
+
+logger = logging.getLogger(__name__)
+
+# Пул назначения (host, port); None — режим сна
+PoolKey = Optional[Tuple[str, int]]
+
+
+class SwitchDispatcher:
+    """
+    Очередь переключений режимов портов.
+    Расписания часто совпадают по времени (00:00, 08:00), и без очереди все порты
+    переключались бы в одну секунду, а майнеры одновременно переподключались бы к пулам.
+    - запуск не чаще SWITCH_RATE переключений в секунду (0 — без ограничения);
+    - не более SWITCH_POOL_CONCURRENCY одновременных переключений на один пул назначения;
+    - случайная задержка до SWITCH_JITTER секунд перед каждым переключением;
+    - «волна» — период от первого запроса до опустошения очереди: её длительность
+      пишется в лог и отдаётся в stats().
+    """
+
+    def __init__(self, switch: Callable[[int], Awaitable[None]], rate: float = SWITCH_RATE,
+                 pool_concurrency: int = SWITCH_POOL_CONCURRENCY, jitter: float = SWITCH_JITTER):
+        self._switch = switch
+        self.rate = max(0.0, rate)
+        self.pool_concurrency = max(0, pool_concurrency)
+        self.jitter = max(0.0, jitter)
+        # (не раньше, порядковый номер, порт)
+        self._queue: List[Tuple[float, int, int]] = []
+        self._seq = itertools.count()
+        # Порты в очереди и их пулы назначения
+        self._queued: Dict[int, PoolKey] = {}
+        # Порты, которые переключаются сейчас, и повторные запросы для них
+        self._running: Set[int] = set()
+        self._again: Dict[int, PoolKey] = {}
+        self._pool_sems: Dict[PoolKey, asyncio.Semaphore] = {}
+        self._tasks: Set[asyncio.Task] = set()
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._next_slot = 0.0
+        self._wave: Optional[dict] = None
+        self.last_wave: Optional[dict] = None
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        tasks = list(self._tasks)
+        if self._task:
+            tasks.append(self._task)
+            self._task = None
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._queue.clear()
+        self._queued.clear()
+        self._again.clear()
+        self._running.clear()
+        self._wave = None
+
+    def submit(self, port: int, pool: PoolKey = None):
+        """Ставит переключение порта в очередь. Повторный запрос для порта в очереди не дублируется."""
+        if port in self._queued:
+            self._queued[port] = pool
+            return
+        if port in self._running:
+            # Порт переключается сейчас — повторим после завершения
+            self._again[port] = pool
+            return
+        delay = random.uniform(0, self.jitter) if self.jitter > 0 else 0.0
+        heapq.heappush(self._queue, (asyncio.get_running_loop().time() + delay, next(self._seq), port))
+        self._queued[port] = pool
+        if self._wave is None:
+            self._wave = {"started": time.monotonic(), "ports": 0, "errors": 0, "max_queue": 0}
+        self._wave["ports"] += 1
+        self._wave["max_queue"] = max(self._wave["max_queue"], len(self._queue))
+        self._wakeup.set()
+
+    def stats(self) -> dict:
+        current = None
+        if self._wave is not None:
+            current = {
+                "ports": self._wave["ports"],
+                "errors": self._wave["errors"],
+                "max_queue": self._wave["max_queue"],
+                "elapsed": round(time.monotonic() - self._wave["started"], 3),
+            }
+        return {
+            "queued": len(self._queue),
+            "running": len(self._running),
+            "rate": self.rate,
+            "pool_concurrency": self.pool_concurrency,
+            "jitter": self.jitter,
+            "current_wave": current,
+            "last_wave": self.last_wave,
+        }
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                now = loop.time()
+                if self._queue:
+                    ready_at = max(self._queue[0][0], self._next_slot)
+                else:
+                    ready_at = None
+                if ready_at is None or ready_at > now:
+                    self._wakeup.clear()
+                    try:
+                        await asyncio.wait_for(self._wakeup.wait(), None if ready_at is None else ready_at - now)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                _, _, port = heapq.heappop(self._queue)
+                pool = self._queued.pop(port)
+                if self.rate > 0:
+                    self._next_slot = max(now, self._next_slot) + 1.0 / self.rate
+                self._running.add(port)
+                task = asyncio.create_task(self._run_one(port, pool))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+            except asyncio.CancelledError:
+                break
+            except Exception as e:
+                logger.warning(f"Ошибка очереди переключений: {e}")
+                await asyncio.sleep(1)
+
+    def _pool_sem(self, pool: PoolKey) -> Optional[asyncio.Semaphore]:
+        if pool is None or self.pool_concurrency <= 0:
+            return None
+        sem = self._pool_sems.get(pool)
+        if sem is None:
+            sem = asyncio.Semaphore(self.pool_concurrency)
+            self._pool_sems[pool] = sem
+        return sem
+
+    async def _run_one(self, port: int, pool: PoolKey):
+        failed = False
+        try:
+            sem = self._pool_sem(pool)
+            if sem is None:
+                await self._switch(port)
+            else:
+                async with sem:
+                    await self._switch(port)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            failed = True
+            logger.warning(f"Ошибка переключения порта {port}: {e}")
+        finally:
+            self._running.discard(port)
+        if failed and self._wave is not None:
+            self._wave["errors"] += 1
+        if port in self._again:
+            self.submit(port, self._again.pop(port))
+        self._finish_wave()
+
+    def _finish_wave(self):
+        if self._wave is None or self._queue or self._running:
+            return
+        wave, self._wave = self._wave, None
+        duration = time.monotonic() - wave["started"]
+        self.last_wave = {
+            "ports": wave["ports"],
+            "errors": wave["errors"],
+            "max_queue": wave["max_queue"],
+            "duration": round(duration, 3),
+            "finished_at": datetime.datetime.utcnow().replace(microsecond=0).isoformat(),
+        }
+        message = (f"Волна переключений завершена: портов {wave['ports']} за {duration:.1f} с "
+                   f"(очередь до {wave['max_queue']}, ошибок {wave['errors']})")
+        if wave["ports"] > 1:
+            logger.info(message)
+        else:
+            logger.debug(message)
+
+
+__all__ = ["SwitchDispatcher"]
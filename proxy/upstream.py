@@ -0,0 +1,200 @@
+import asyncio
+import logging
+import socket
+import time
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from config.settings import (
+    UPSTREAM_CONNECT_TIMEOUT,
+    UPSTREAM_CONNECT_CONCURRENCY,
+    UPSTREAM_DNS_TTL,
+    UPSTREAM_WARM_POOL_SIZE,
+    UPSTREAM_WARM_MAX_AGE,
+)
+
+logger = logging.getLogger(__name__)
+
+Upstream = Tuple[str, int]
+
+
+class UpstreamConnector:
+    """
+    Подключения к одному пулу (host, port):
+    - кешированный результат DNS (UPSTREAM_DNS_TTL), адреса перебираются по кругу;
+    - небольшой запас заранее открытых («тёплых») сокетов, живущих не дольше UPSTREAM_WARM_MAX_AGE;
+    - ограничение числа одновременных попыток подключения.
+    """
+
+    def __init__(self, host: str, port: int, warm_size: int = UPSTREAM_WARM_POOL_SIZE,
+                 concurrency: int = UPSTREAM_CONNECT_CONCURRENCY):
+        self.host = host
+        self.port = port
+        self.warm_size = max(0, warm_size)
+        self._sem = asyncio.Semaphore(max(1, concurrency))
+        self._addrs: List[tuple] = []
+        self._addrs_expire: float = 0.0
+        self._rr = 0
+        # Тёплые сокеты: (reader, writer, created_at)
+        self._warm: List[tuple] = []
+        self._refill_task: Optional[asyncio.Task] = None
+        # Наибольший запрошенный запас для идущего пополнения (refill во время пополнения его повышает)
+        self._refill_target = 0
+        self._closed = False
+
+    async def _resolve(self) -> List[tuple]:
+        now = time.monotonic()
+        if self._addrs and now < self._addrs_expire:
+            return self._addrs
+        loop = asyncio.get_running_loop()
+        infos = await loop.getaddrinfo(self.host, self.port, type=socket.SOCK_STREAM)
+        addrs = list(dict.fromkeys(info[4][:2] for info in infos))
+        if not addrs:
+            raise OSError(f"no addresses for {self.host}")
+        self._addrs = addrs
+        self._addrs_expire = now + UPSTREAM_DNS_TTL
+        return addrs
+
+    async def _open(self) -> Tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+        async with self._sem:
+            addrs = await self._resolve()
+            last_exc: Optional[Exception] = None
+            for _ in range(len(addrs)):
+                addr = addrs[self._rr % len(addrs)]
+                self._rr += 1
+                try:
+                    return await asyncio.wait_for(asyncio.open_connection(addr[0], addr[1]), UPSTREAM_CONNECT_TIMEOUT)
+                except Exception as e:
+                    last_exc = e
+            # Все адреса недоступны — при следующей попытке разрешаем имя заново
+            self._addrs_expire = 0.0
+            raise last_exc or OSError(f"cannot connect to {self.host}:{self.port}")
+
+    def _take_warm(self) -> Optional[Tuple[asyncio.StreamReader, asyncio.StreamWriter]]:
+        now = time.monotonic()
+        while self._warm:
+            reader, writer, created = self._warm.pop()
+            if now - created <= UPSTREAM_WARM_MAX_AGE and not reader.at_eof() and not writer.is_closing():
+                return reader, writer
+            writer.close()
+        return None
+
+    async def connect(self) -> Tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+        """Возвращает соединение с пулом: тёплое, если есть, иначе новое."""
+        conn = self._take_warm()
+        self.refill()
+        if conn:
+            return conn
+        return await self._open()
+
+    def refill(self, count: Optional[int] = None):
+        """Фоново пополняет запас тёплых сокетов до count (по умолчанию warm_size)."""
+        target = self.warm_size if count is None else max(count, self.warm_size)
+        if self._closed or target <= 0:
+            return
+        self._refill_target = max(self._refill_target, target)
+        if self._refill_task and not self._refill_task.done():
+            # Идущее пополнение доберёт и увеличенный запас (например, прогрев перед переключением)
+            return
+        self._refill_task = asyncio.create_task(self._refill())
+
+    async def _refill(self):
+        try:
+            done = 0
+            while self._refill_target > done:
+                target = done = self._refill_target
+                # Выбрасываем устаревшие сокеты, пока они не достались майнеру
+                now = time.monotonic()
+                fresh = []
+                for reader, writer, created in self._warm:
+                    if now - created <= UPSTREAM_WARM_MAX_AGE and not reader.at_eof() and not writer.is_closing():
+                        fresh.append((reader, writer, created))
+                    else:
+                        writer.close()
+                self._warm = fresh
+                need = target - len(self._warm)
+                if need <= 0:
+                    continue
+                results = await asyncio.gather(*(self._open() for _ in range(need)), return_exceptions=True)
+                for res in results:
+                    if isinstance(res, Exception):
+                        logger.debug(f"Не удалось открыть тёплое соединение к {self.host}:{self.port}: {res}")
+                        continue
+                    if self._closed:
+                        res[1].close()
+                        continue
+                    self._warm.append((res[0], res[1], time.monotonic()))
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            logger.warning(f"Ошибка пополнения тёплых соединений {self.host}:{self.port}: {e}")
+        finally:
+            self._refill_target = 0
+
+    async def close(self):
+        self._closed = True
+        if self._refill_task:
+            self._refill_task.cancel()
+            await asyncio.gather(self._refill_task, return_exceptions=True)
+            self._refill_task = None
+        for _, writer, _ in self._warm:
+            writer.close()
+        self._warm = []
+
+
+class UpstreamPool:
+    """Реестр UpstreamConnector по (host, port)."""
+
+    def __init__(self):
+        self._connectors: Dict[Upstream, UpstreamConnector] = {}
+        self._maintain_task: Optional[asyncio.Task] = None
+
+    def get(self, host: str, port: int) -> UpstreamConnector:
+        key = (host, int(port))
+        conn = self._connectors.get(key)
+        if conn is None:
+            conn = UpstreamConnector(host, int(port))
+            self._connectors[key] = conn
+        return conn
+
+    async def connect(self, host: str, port: int) -> Tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+        return await self.get(host, port).connect()
+
+    def prewarm(self, host: str, port: int, count: Optional[int] = None):
+        """Заранее открывает соединения к пулу (например, перед переключением режима)."""
+        self.get(host, port).refill(count)
+
+    async def retain(self, upstreams: Iterable[Upstream]):
+        """Оставляет коннекторы только для используемых пулов, остальные закрывает."""
+        keep: Set[Upstream] = {(h, int(p)) for h, p in upstreams}
+        for key in [k for k in self._connectors if k not in keep]:
+            conn = self._connectors.pop(key)
+            await conn.close()
+
+    def start(self):
+        """Периодически обновляет тёплые сокеты, чтобы они не устаревали без подключений."""
+        if self._maintain_task is None or self._maintain_task.done():
+            self._maintain_task = asyncio.create_task(self._maintain())
+
+    async def _maintain(self):
+        interval = max(1.0, UPSTREAM_WARM_MAX_AGE / 2)
+        while True:
+            try:
+                await asyncio.sleep(interval)
+                for conn in list(self._connectors.values()):
+                    conn.refill()
+            except asyncio.CancelledError:
+                break
+            except Exception as e:
+                logger.warning(f"Ошибка обслуживания тёплых соединений: {e}")
+
+    async def close(self):
+        if self._maintain_task:
+            self._maintain_task.cancel()
+            await asyncio.gather(self._maintain_task, return_exceptions=True)
+            self._maintain_task = None
+        for conn in list(self._connectors.values()):
+            await conn.close()
+        self._connectors.clear()
+
+
+__all__ = ["UpstreamConnector", "UpstreamPool"]
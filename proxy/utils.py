@@ -1,4 +1,5 @@
 import logging
+from typing import List
 
 logger = logging.getLogger(__name__)
 
@@ -43,4 +44,17 @@ def is_time_in_range(current_time: str, start_time: str, end_time: str) -> bool:
         return cur >= start or cur <= end
 
 
-__all__ = ["is_time_in_range"]
\ No newline at end of file
+def range_boundaries(start_time: str, end_time: str) -> List[int]:
+    """
+    Минуты суток, в которые меняется результат is_time_in_range для диапазона:
+    начало и минута после конца (конец включён). Для круглосуточного или
+    некорректного диапазона границ нет.
+    """
+    start = _to_minutes(start_time)
+    end = _to_minutes(end_time)
+    if start < 0 or end < 0 or start == end:
+        return []
+    return [start, (end + 1) % (24 * 60)]
+
+
+__all__ = ["is_time_in_range", "range_boundaries"]
\ No newline at end of file
@@ -0,0 +1,433 @@
+#!/usr/bin/env python3
+"""
+Нагрузочный стенд Stratum-прокси.
+
+Поднимает:
+- SQLite-базу с N пользователями (порты base_port..base_port+N-1) и активным режимом,
+  указывающим на локальный фейковый пул;
+- фейковый Stratum-пул (subscribe, authorize, mining.notify с заданным интервалом, ответы на submit);
+- StratumProxyServer в отдельном процессе (чтобы CPU и RSS считались только для прокси);
+- M симулированных майнеров, равномерно распределённых по портам.
+
+Отчёт: шар/с, p50/p99 времени ответа на submit через прокси, задержка подключения и авторизации,
+CPU прокси на одну шару и прирост RSS на одно соединение.
+
+Пример:
+    python scripts/bench_proxy.py --users 50 --miners 500 --duration 30 --output bench_output.txt
+    python scripts/bench_proxy.py --users 50 --miners 500 --duration 30 --relay protocol --output bench_output.txt
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from typing import List, Optional
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if PROJECT_ROOT not in sys.path:
+    sys.path.insert(0, PROJECT_ROOT)
+
+
+def _free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _percentile(values: List[float], pct: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    idx = min(len(ordered) - 1, max(0, int(round(pct / 100.0 * (len(ordered) - 1)))))
+    return ordered[idx]
+
+
+def _fmt_ms(value: Optional[float]) -> str:
+    return "n/a" if value is None else f"{value * 1000:.2f} мс"
+
+
+# ===== Замеры процесса прокси (Linux /proc) =====
+
+def _proc_cpu_seconds(pid: int) -> Optional[float]:
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        # utime и stime — 12-е и 13-е поля после имени процесса
+        ticks = int(fields[11]) + int(fields[12])
+        return ticks / os.sysconf("SC_CLK_TCK")
+    except Exception:
+        return None
+
+
+def _proc_rss_bytes(pid: int) -> Optional[int]:
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except Exception:
+        pass
+    return None
+
+
+# ===== База данных =====
+
+def seed_db(db_url: str, users: int, base_port: int, pool_port: int):
+    """Создаёт пользователей с активным режимом на фейковый пул."""
+    from db.models import init_db, get_session, User, Mode
+
+    engine = init_db(db_url)
+    session = get_session(engine)
+    try:
+        until = datetime.datetime.now() + datetime.timedelta(days=365)
+        for i in range(users):
+            user = User(tg_id=10_000_000 + i, username=f"bench{i}", port=base_port + i,
+                        login=f"bench{i}", subscription_until=until)
+            session.add(user)
+            session.flush()
+            mode = Mode(user_id=user.id, name="bench", host="127.0.0.1", port=pool_port,
+                        alias=f"pool{i}", is_active=1)
+            session.add(mode)
+            session.flush()
+            user.active_mode_id = mode.id
+        session.commit()
+    finally:
+        session.close()
+    engine.dispose()
+
+
+# ===== Фейковый пул =====
+
+class FakePool:
+    """Минимальный Stratum-пул: отвечает на subscribe/authorize/submit и рассылает mining.notify."""
+
+    def __init__(self, notify_interval: float, reject_every: int = 0):
+        self.notify_interval = notify_interval
+        self.reject_every = reject_every
+        self.writers: set = set()
+        self.submits = 0
+        self._conn_id = 0
+        self._job = 0
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._notify_task: Optional[asyncio.Task] = None
+
+    async def start(self, port: int):
+        self._server = await asyncio.start_server(self._handle, "127.0.0.1", port, limit=1 << 20)
+        if self.notify_interval > 0:
+            self._notify_task = asyncio.create_task(self._notify_loop())
+
+    async def stop(self):
+        if self._notify_task:
+            self._notify_task.cancel()
+        for w in list(self.writers):
+            w.close()
+        if self._server:
+            self._server.close()
+
+    def _notify_line(self) -> bytes:
+        job = format(self._job, "x")
+        params = [job, "00" * 32, "01" * 40, "02" * 40, [], "20000000", "1d00ffff", format(int(time.time()), "x"), True]
+        return (json.dumps({"id": None, "method": "mining.notify", "params": params}) + "\n").encode()
+
+    async def _notify_loop(self):
+        while True:
+            await asyncio.sleep(self.notify_interval)
+            self._job += 1
+            line = self._notify_line()
+            for w in list(self.writers):
+                if not w.is_closing():
+                    w.write(line)
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self._conn_id += 1
+        extranonce1 = format(self._conn_id, "08x")
+        self.writers.add(writer)
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    msg = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                method, req_id = msg.get("method"), msg.get("id")
+                if method == "mining.subscribe":
+                    resp = {"id": req_id, "result": [[["mining.notify", extranonce1]], extranonce1, 4], "error": None}
+                elif method == "mining.authorize":
+                    resp = {"id": req_id, "result": True, "error": None}
+                elif method == "mining.submit":
+                    self.submits += 1
+                    if self.reject_every and self.submits % self.reject_every == 0:
+                        resp = {"id": req_id, "result": None, "error": [21, "Stale share", None]}
+                    else:
+                        resp = {"id": req_id, "result": True, "error": None}
+                else:
+                    resp = {"id": req_id, "result": True, "error": None}
+                writer.write((json.dumps(resp) + "\n").encode())
+                if method == "mining.authorize":
+                    writer.write(b'{"id":null,"method":"mining.set_difficulty","params":[1024]}\n')
+                    writer.write(self._notify_line())
+                await writer.drain()
+        except (asyncio.CancelledError, ConnectionResetError, BrokenPipeError):
+            pass
+        finally:
+            self.writers.discard(writer)
+            writer.close()
+
+
+# ===== Симулированный майнер =====
+
+class MinerStats:
+    def __init__(self):
+        self.connect_latency: List[float] = []
+        self.authorize_latency: List[float] = []
+        self.submit_rtt: List[float] = []
+        self.accepted = 0
+        self.rejected = 0
+        self.failed = 0
+
+
+async def _read_reply(reader: asyncio.StreamReader, req_id: int, timeout: float) -> dict:
+    """Читает строки до ответа с нужным id (mining.notify и прочие уведомления пропускаются)."""
+    deadline = time.perf_counter() + timeout
+    while True:
+        line = await asyncio.wait_for(reader.readline(), max(0.001, deadline - time.perf_counter()))
+        if not line:
+            raise ConnectionResetError("proxy closed connection")
+        if b'"method"' in line:
+            continue
+        msg = json.loads(line)
+        if msg.get("id") == req_id:
+            return msg
+
+
+async def run_miner(idx: int, port: int, login: str, stats: MinerStats, ready: asyncio.Event,
+                    measure: asyncio.Event, done: asyncio.Event, submit_interval: float, timeout: float):
+    writer = None
+    try:
+        t0 = time.perf_counter()
+        reader, writer = await asyncio.wait_for(asyncio.open_connection("127.0.0.1", port), timeout)
+        t1 = time.perf_counter()
+        writer.write((json.dumps({"id": 1, "method": "mining.subscribe", "params": ["bench-miner/1.0"]}) + "\n").encode())
+        writer.write((json.dumps({"id": 2, "method": "mining.authorize", "params": [f"{login}.w{idx}", "x"]}) + "\n").encode())
+        await writer.drain()
+        await _read_reply(reader, 1, timeout)
+        auth = await _read_reply(reader, 2, timeout)
+        t2 = time.perf_counter()
+        if not auth.get("result"):
+            raise RuntimeError(f"authorize rejected: {auth}")
+        stats.connect_latency.append(t1 - t0)
+        stats.authorize_latency.append(t2 - t1)
+    except Exception:
+        stats.failed += 1
+        if writer:
+            writer.close()
+        return
+    finally:
+        ready.set()
+
+    req_id = 2
+    nonce = 0
+    try:
+        await measure.wait()
+        while not done.is_set():
+            req_id += 1
+            nonce += 1
+            params = [f"{login}.w{idx}", "1", format(nonce, "08x"), format(int(time.time()), "x"), format(nonce, "08x")]
+            started = time.perf_counter()
+            writer.write((json.dumps({"id": req_id, "method": "mining.submit", "params": params}) + "\n").encode())
+            await writer.drain()
+            reply = await _read_reply(reader, req_id, timeout)
+            if done.is_set():
+                break
+            stats.submit_rtt.append(time.perf_counter() - started)
+            if reply.get("result"):
+                stats.accepted += 1
+            else:
+                stats.rejected += 1
+            if submit_interval > 0:
+                await asyncio.sleep(submit_interval)
+    except Exception:
+        if not done.is_set():
+            stats.failed += 1
+    finally:
+        writer.close()
+
+
+# ===== Процесс прокси =====
+
+def serve(args):
+    """Точка входа дочернего процесса: только StratumProxyServer, настройки берутся из окружения."""
+    import logging
+    logging.basicConfig(level=args.log_level, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    from proxy.server import StratumProxyServer
+
+    async def _main():
+        server = StratumProxyServer(host="127.0.0.1")
+        await server.start()
+        try:
+            await asyncio.Event().wait()
+        finally:
+            await server.stop()
+
+    try:
+        asyncio.run(_main())
+    except KeyboardInterrupt:
+        pass
+
+
+async def _wait_ports(ports: List[int], timeout: float):
+    deadline = time.monotonic() + timeout
+    for port in ports:
+        while True:
+            try:
+                _, w = await asyncio.open_connection("127.0.0.1", port)
+                w.close()
+                break
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise TimeoutError(f"прокси не открыл порт {port} за {timeout} с")
+                await asyncio.sleep(0.1)
+
+
+async def bench(args) -> str:
+    workdir = tempfile.mkdtemp(prefix="bench_proxy_")
+    db_url = f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+    pool_port = args.pool_port or _free_port()
+    ports = [args.base_port + i for i in range(args.users)]
+    seed_db(db_url, args.users, args.base_port, pool_port)
+
+    pool = FakePool(args.notify_interval, args.reject_every)
+    await pool.start(pool_port)
+
+    env = dict(os.environ)
+    env.update({
+        "DATABASE_URL": db_url,
+        "BOT_TOKEN": "",
+        "TELEGRAM_TOKEN": "",
+        "MODE_CHANGES_UDP_PORT": str(_free_port()),
+        "MODE_RESYNC_INTERVAL": "0",
+        # Стенд не должен читать и перезаписывать снимок конфигурации рабочего прокси
+        "PROXY_SNAPSHOT_PATH": os.path.join(workdir, "snapshot.json"),
+        "PROXY_RELAY_ENGINE": args.relay,
+    })
+    proc = subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__), "--serve", "--log-level", args.log_level],
+        cwd=PROJECT_ROOT, env=env,
+    )
+    try:
+        # Ждём, пока прокси откроет все порты
+        t_start = time.perf_counter()
+        await _wait_ports(ports, args.startup_timeout)
+        startup = time.perf_counter() - t_start
+        await asyncio.sleep(0.5)
+        rss_idle = _proc_rss_bytes(proc.pid)
+
+        stats = MinerStats()
+        measure, done = asyncio.Event(), asyncio.Event()
+        readies = []
+        tasks = []
+        t_conn = time.perf_counter()
+        for i in range(args.miners):
+            ready = asyncio.Event()
+            readies.append(ready)
+            user_idx = i % args.users
+            tasks.append(asyncio.create_task(run_miner(
+                i, ports[user_idx], f"bench{user_idx}", stats, ready, measure, done,
+                args.submit_interval, args.timeout,
+            )))
+            if args.connect_rate > 0:
+                await asyncio.sleep(1.0 / args.connect_rate)
+        await asyncio.gather(*(r.wait() for r in readies))
+        connect_all = time.perf_counter() - t_conn
+        await asyncio.sleep(0.5)
+        rss_loaded = _proc_rss_bytes(proc.pid)
+        connected = args.miners - stats.failed
+
+        # Прогрев, затем замер
+        measure.set()
+        await asyncio.sleep(args.warmup)
+        stats.submit_rtt.clear()
+        accepted0, rejected0 = stats.accepted, stats.rejected
+        cpu0 = _proc_cpu_seconds(proc.pid)
+        t0 = time.perf_counter()
+        await asyncio.sleep(args.duration)
+        elapsed = time.perf_counter() - t0
+        cpu1 = _proc_cpu_seconds(proc.pid)
+        shares = (stats.accepted - accepted0) + (stats.rejected - rejected0)
+        rtts = list(stats.submit_rtt)
+        done.set()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    finally:
+        proc.terminate()
+        try:
+            proc.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+        await pool.stop()
+
+    cpu = None if cpu0 is None or cpu1 is None else cpu1 - cpu0
+    rss_per_conn = None
+    if rss_idle is not None and rss_loaded is not None and connected > 0:
+        rss_per_conn = (rss_loaded - rss_idle) / connected
+
+    lines = [
+        f"=== bench_proxy {datetime.datetime.now().isoformat(timespec='seconds')} ===",
+        f"пользователей/портов: {args.users}, майнеров: {args.miners} (подключено {connected}, ошибок {stats.failed})",
+        f"движок пересылки: {args.relay}",
+        f"notify каждые {args.notify_interval} с, пауза между submit: {args.submit_interval} с, замер {args.duration} с",
+        f"запуск прокси (все порты открыты): {startup:.2f} с",
+        f"подключение всех майнеров: {connect_all:.2f} с",
+        f"connect: p50 {_fmt_ms(_percentile(stats.connect_latency, 50))}, p99 {_fmt_ms(_percentile(stats.connect_latency, 99))}",
+        f"subscribe+authorize: p50 {_fmt_ms(_percentile(stats.authorize_latency, 50))}, p99 {_fmt_ms(_percentile(stats.authorize_latency, 99))}",
+        f"шар/с: {shares / elapsed:.1f} (всего {shares}, отклонено {stats.rejected - rejected0})",
+        f"submit RTT: p50 {_fmt_ms(_percentile(rtts, 50))}, p99 {_fmt_ms(_percentile(rtts, 99))}",
+        "CPU прокси на шару: " + ("n/a" if cpu is None or not shares else f"{cpu / shares * 1e6:.1f} мкс (CPU {cpu:.2f} с за {elapsed:.1f} с)"),
+        "RSS прокси: " + ("n/a" if rss_loaded is None else f"{rss_loaded / 1048576:.1f} МБ")
+        + ("" if rss_per_conn is None else f", на соединение {rss_per_conn / 1024:.1f} КБ"),
+    ]
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный стенд Stratum-прокси с локальным фейковым пулом")
+    parser.add_argument("--users", type=int, default=10, help="Число пользователей (портов прокси)")
+    parser.add_argument("--miners", type=int, default=100, help="Число симулированных майнеров")
+    parser.add_argument("--base-port", type=int, default=14000, help="Первый порт прокси")
+    parser.add_argument("--pool-port", type=int, default=0, help="Порт фейкового пула (0 — любой свободный)")
+    parser.add_argument("--duration", type=float, default=15.0, help="Длительность замера, с")
+    parser.add_argument("--warmup", type=float, default=2.0, help="Прогрев перед замером, с")
+    parser.add_argument("--notify-interval", type=float, default=1.0, help="Интервал mining.notify от пула, с (0 — не слать)")
+    parser.add_argument("--submit-interval", type=float, default=0.0, help="Пауза майнера между submit, с (0 — без пауз)")
+    parser.add_argument("--reject-every", type=int, default=0, help="Каждую N-ю шару пул отклоняет как stale (0 — не отклонять)")
+    parser.add_argument("--connect-rate", type=float, default=0.0, help="Подключений майнеров в секунду (0 — все сразу)")
+    parser.add_argument("--timeout", type=float, default=10.0, help="Таймаут ответа прокси, с")
+    parser.add_argument("--startup-timeout", type=float, default=60.0, help="Таймаут запуска прокси, с")
+    parser.add_argument("--relay", choices=("streams", "protocol"), default=os.getenv("PROXY_RELAY_ENGINE", "streams"),
+                        help="Движок пересылки прокси (PROXY_RELAY_ENGINE) для сравнения")
+    parser.add_argument("--log-level", default="WARNING", help="Уровень логов процесса прокси")
+    parser.add_argument("--output", help="Дописать отчёт в файл (например, bench_output.txt)")
+    parser.add_argument("--serve", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args)
+        return
+    if args.users < 1 or args.miners < 1:
+        parser.error("--users и --miners должны быть положительными")
+
+    report = asyncio.run(bench(args))
+    print(report)
+    if args.output:
+        with open(args.output, "a", encoding="utf-8") as f:
+            f.write(report + "\n\n")
+
+
+if __name__ == "__main__":
+    main()
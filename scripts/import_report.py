@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""
+Отчёт о времени импорта модулей прокси (python -X importtime).
+
+Каждая цель импортируется в отдельном чистом процессе. Отчёт: общее время импорта,
+число загруженных модулей, самые тяжёлые пакеты верхнего уровня и запрещённые модули.
+По умолчанию проверяется, что точка входа (main, режим --proxy-only и процессы прокси)
+и proxy.server не загружают aiogram, обработчики и клавиатуры бота — эти модули нужны
+только боту. Код возврата 1, если найден запрещённый модуль или превышен бюджет --max-ms.
+
+Пример:
+    python scripts/import_report.py --top 15 --max-ms 1500 --output import_report.txt
+"""
+import argparse
+import datetime
+import os
+import re
+import subprocess
+import sys
+from typing import Dict, List, Tuple
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+DEFAULT_TARGETS = ["main", "proxy.server"]
+DEFAULT_FORBIDDEN = ["aiogram", "bot.handlers", "bot.keyboards"]
+
+# import time:       123 |        456 |   package.module
+_LINE_RE = re.compile(r"^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)\s*$")
+
+
+def measure(target: str) -> List[Tuple[str, int, int, int]]:
+    """Импортирует модуль в отдельном процессе. Список (модуль, self мкс, cumulative мкс, глубина)."""
+    env = dict(os.environ)
+    # Отчёт -X importtime печатается один раз, без учёта переменной окружения
+    env.pop("PYTHONPROFILEIMPORTTIME", None)
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {target}"],
+        cwd=PROJECT_ROOT, env=env, capture_output=True, text=True,
+    )
+    if proc.returncode != 0:
+        tail = proc.stderr.strip().splitlines()[-1:] or ["?"]
+        raise RuntimeError(f"импорт {target} завершился с кодом {proc.returncode}: {tail[0]}")
+    rows = []
+    for line in proc.stderr.splitlines():
+        m = _LINE_RE.match(line)
+        if m:
+            # Отступ имени — вложенность импорта (по 2 пробела на уровень)
+            rows.append((m.group(4), int(m.group(1)), int(m.group(2)), (len(m.group(3)) - 1) // 2))
+    return rows
+
+
+def _is_forbidden(module: str, forbidden: List[str]) -> bool:
+    return any(module == name or module.startswith(name + ".") for name in forbidden)
+
+
+def report(target: str, rows: List[Tuple[str, int, int, int]], forbidden: List[str], top: int) -> Tuple[str, int, List[str]]:
+    """Текст отчёта по цели, общее время (мкс) и найденные запрещённые модули."""
+    total = sum(cumulative for _, _, cumulative, depth in rows if depth == 0)
+    by_package: Dict[str, int] = {}
+    for module, self_us, _, _ in rows:
+        package = module.split(".", 1)[0]
+        by_package[package] = by_package.get(package, 0) + self_us
+    found = sorted({module for module, _, _, _ in rows if _is_forbidden(module, forbidden)})
+    lines = [f"--- import {target}: {total / 1000:.1f} мс, модулей {len(rows)}"]
+    for package, self_us in sorted(by_package.items(), key=lambda item: item[1], reverse=True)[:top]:
+        lines.append(f"  {self_us / 1000:8.1f} мс  {package}")
+    if found:
+        shown = ", ".join(found[:10]) + (f" и ещё {len(found) - 10}" if len(found) > 10 else "")
+        lines.append(f"  ЗАПРЕЩЁННЫЕ МОДУЛИ ({len(found)}): {shown}")
+    return "\n".join(lines), total, found
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Отчёт о времени импорта (-X importtime) и проверка лишних импортов")
+    parser.add_argument("targets", nargs="*", default=DEFAULT_TARGETS, help="Импортируемые модули (по умолчанию: main, proxy.server)")
+    parser.add_argument("--forbid", action="append", default=None,
+                        help="Модуль или пакет, который цели не должны загружать (можно повторять; по умолчанию aiogram и модули бота)")
+    parser.add_argument("--top", type=int, default=10, help="Сколько самых тяжёлых пакетов показать")
+    parser.add_argument("--max-ms", type=float, default=0.0, help="Бюджет времени импорта одной цели, мс (0 — не проверять)")
+    parser.add_argument("--output", help="Дописать отчёт в файл")
+    args = parser.parse_args()
+
+    forbidden = args.forbid if args.forbid is not None else DEFAULT_FORBIDDEN
+    failed = False
+    parts = [f"=== import_report {datetime.datetime.now().isoformat(timespec='seconds')} (Python {sys.version.split()[0]}) ==="]
+    for target in args.targets:
+        try:
+            rows = measure(target)
+        except RuntimeError as e:
+            parts.append(f"--- import {target}: ошибка: {e}")
+            failed = True
+            continue
+        text, total, found = report(target, rows, forbidden, args.top)
+        parts.append(text)
+        if found:
+            failed = True
+        if args.max_ms > 0 and total / 1000 > args.max_ms:
+            parts.append(f"  ПРЕВЫШЕН БЮДЖЕТ: {total / 1000:.1f} мс > {args.max_ms:.0f} мс")
+            failed = True
+    parts.append("результат: " + ("ОШИБКА" if failed else "OK"))
+
+    text = "\n".join(parts)
+    print(text)
+    if args.output:
+        with open(args.output, "a", encoding="utf-8") as f:
+            f.write(text + "\n\n")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()